@@ -1,10 +1,11 @@
 import matplotlib.pyplot as plt
 import numpy as np
 from datetime import datetime
-from multipletau import autocorrelate
+from multipletau import MultipleTauAccumulator
+from counters import CounterDecoder
 
 file_name = "data-2018-06-12 15:42:26.npy"
-data = np.load(file_name)
+data = np.load(file_name, mmap_mode='r') #the file is read by blocks
 
 
 print(len(data))
@@ -17,7 +18,13 @@ plt.plot(data[1:]-data[:-1])
 plt.figure()
 occ,val,dummy=plt.hist(data,256,(0,256),log=True)
 """
-G = autocorrelate(data[1:]-data[:-1], normalize=True, dtype=np.float_)
+# the photon counts are decoded and correlated block by block so that
+# the memory used does not depend on the size of the acquisition
+decoder = CounterDecoder()
+acc = MultipleTauAccumulator(m=16, normalize=True)
+for i in range(0, len(data), 2**20):
+    acc.update(decoder.counts(data[i:i+2**20]))
+G = acc.get()
 plt.figure()
 plt.semilogx(G[5:,0], G[5:,1])
 plt.show()
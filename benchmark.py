@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end benchmark of wserialserv without the instrument.
+
+The server is started with a simulated source (see sources.py), then N
+clients, each in its own process, read the stream for a given duration.
+For each number of clients the benchmark reports :
+    the throughput received (MB/s, all clients together and per client)
+    the latency of the packets, from the acquisition of their last byte
+        to their reception (percentiles, ms), both ends run here so
+        they share the monotonic clock
+    the bytes dropped by the server for the clients
+    the CPU time of each thread of the server (by thread id, in the
+        order they were started) and of the clients
+Each run is appended as one JSON line to the output file, so that the
+results of successive versions can be compared.
+
+    python benchmark.py --clients 1,4,16 --duration 10
+    python benchmark.py --server wserialserv_v2.py --engine asyncio
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+from datetime import datetime
+from time import monotonic, process_time, sleep
+import numpy as np
+from protocol import (HELLO, FRAME, DATA, STREAM, PACKET, LATENCY, GIVEDATA,
+    KTHXBYE, packCommand, unpackHello, unpackFrame)
+
+HOST = 'localhost'
+PORT = 18888
+STARTUP = 10. # seconds the server has to accept connections
+PERCENTILES = (50, 90, 99, 99.9)
+MAXCREDIT = 10**8 - 1 # packets granted to the server by a stream client
+
+
+def recvExactly(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = sock.recv_into(view[got:])
+        if not k:
+            raise ConnectionError("the server closed the connection")
+        got += k
+    return buf
+
+
+def client(host, port, duration, mode, packet, latency, results):
+    """
+    Reads the stream for duration seconds and puts its measures in
+    results (multiprocessing queue).
+    """
+    sock = socket.create_connection((host, port))
+    unpackHello(recvExactly(sock, HELLO.size))
+    cpu = process_time()
+    if packet:
+        sock.sendall(packCommand(PACKET, packet))
+    if latency:
+        sock.sendall(packCommand(LATENCY, latency))
+    if mode == 'stream':
+        sock.sendall(packCommand(STREAM, MAXCREDIT))
+    latencies = []
+    received = dropped = frames = 0
+    start = monotonic()
+    while monotonic() - start < duration:
+        if mode == 'givedata':
+            sock.sendall(packCommand(GIVEDATA))
+        frame = unpackFrame(recvExactly(sock, FRAME.size))
+        recvExactly(sock, frame.length)
+        now = monotonic()
+        if frame.kind != DATA:
+            continue
+        latencies.append(now - frame.timestamp)
+        received += frame.length
+        dropped += frame.dropped
+        frames += 1
+    elapsed = monotonic() - start
+    if mode == 'stream':
+        sock.sendall(packCommand(STREAM, 0))
+    sock.close()
+    results.put({'bytes': received, 'frames': frames, 'dropped': dropped,
+                 'seconds': elapsed, 'cpu': process_time() - cpu,
+                 'latencies': latencies})
+
+
+def threadTimes(pid):
+    """
+    output : {tid: CPU seconds} of the threads of the process pid
+    """
+    tick = os.sysconf('SC_CLK_TCK')
+    times = {}
+    for tid in os.listdir('/proc/{}/task'.format(pid)):
+        try:
+            with open('/proc/{}/task/{}/stat'.format(pid, tid)) as f :
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError: # the thread ended
+            continue
+        times[int(tid)] = (int(fields[11]) + int(fields[12]))/tick # utime + stime
+    return times
+
+
+def waitServer(host, port):
+    deadline = monotonic() + STARTUP
+    while monotonic() < deadline:
+        try:
+            sock = socket.create_connection((host, port))
+        except OSError:
+            sleep(0.1)
+            continue
+        recvExactly(sock, HELLO.size) # closing before would reset it
+        sock.close()
+        return
+    raise RuntimeError("the server did not start")
+
+
+def runClients(server, n, duration, mode, packet=0, latency=0):
+    """
+    output : the measures of n clients reading at the same time
+    """
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=client,
+                                     args=(HOST, PORT, duration, mode, packet,
+                                           latency, results))
+             for i in range(n)]
+    before = threadTimes(server.pid)
+    for p in procs:
+        p.start()
+    clients = [results.get() for p in procs]
+    after = threadTimes(server.pid)
+    for p in procs:
+        p.join()
+    latencies = np.concatenate([c.pop('latencies') for c in clients])*1e3
+    seconds = max(c['seconds'] for c in clients)
+    total = sum(c['bytes'] for c in clients)
+    return {
+        'clients': n,
+        'MBps': total/seconds/1e6,
+        'MBps_per_client': [c['bytes']/c['seconds']/1e6 for c in clients],
+        'frames': sum(c['frames'] for c in clients),
+        'dropped_bytes': sum(c['dropped'] for c in clients),
+        'latency_ms': {'p{:g}'.format(q): float(np.percentile(latencies, q))
+                       for q in PERCENTILES} if len(latencies) else {},
+        'latency_max_ms': float(latencies.max()) if len(latencies) else None,
+        'server_cpu': [{'thread': 'main' if tid == server.pid else tid,
+                        'seconds': t - before.get(tid, 0.),
+                        'percent': 100*(t - before.get(tid, 0.))/seconds}
+                       for tid, t in sorted(after.items())],
+        'client_cpu_percent': [100*c['cpu']/c['seconds'] for c in clients],
+    }
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(run):
+    print("{clients:3d} clients : {MBps:7.3f} MB/s, {frames} packets, "
+          "{dropped_bytes} bytes dropped".format(**run))
+    print("    latency (ms) :", ", ".join("{} {:.1f}".format(k, v)
+          for k, v in run['latency_ms'].items()))
+    print("    server CPU (%) :", ", ".join("{} {:.1f}".format(
+          t['thread'], t['percent']) for t in run['server_cpu']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of wserialserv "
+        "with a simulated instrument")
+    parser.add_argument('--server', default='wserialserv_v2.py')
+    parser.add_argument('--engine', help="network engine of the server")
+    parser.add_argument('--source', default='sim', help="source of the "
+        "server, see sources.py")
+    parser.add_argument('--clients', default='1,4,16', help="numbers of "
+        "clients, comma separated")
+    parser.add_argument('--duration', type=float, default=10.)
+    parser.add_argument('--mode', choices=['stream', 'givedata'],
+        default='stream', help="how the clients ask for the packets")
+    parser.add_argument('--packet', type=int, default=0, help="packet size "
+        "asked for by the clients in bytes, 0 for the one of the server")
+    parser.add_argument('--latency', type=int, default=0, help="latency "
+        "target of the clients in ms, 0 for whole packets only")
+    parser.add_argument('--output', default='benchmarks.jsonl')
+    parser.add_argument('--log', default=os.devnull, help="output of the "
+        "server")
+    args = parser.parse_args()
+
+    command = [sys.executable, args.server, '--source', args.source]
+    if args.engine:
+        command += ['--engine', args.engine]
+    log = open(args.log, 'w')
+    server = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+    runs = []
+    try :
+        waitServer(HOST, PORT)
+        for n in map(int, args.clients.split(',')):
+            runs.append(runClients(server, n, args.duration, args.mode,
+                                    args.packet, args.latency))
+            report(runs[-1])
+    finally :
+        try :
+            socket.create_connection((HOST, PORT)).sendall(
+                packCommand(KTHXBYE))
+            server.wait(10)
+        except (OSError, subprocess.TimeoutExpired):
+            server.kill()
+        log.close()
+    with open(args.output, 'a') as f :
+        f.write(json.dumps({
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'commit': gitCommit(),
+            'server': args.server, 'engine': args.engine,
+            'source': args.source, 'mode': args.mode,
+            'packet': args.packet, 'latency': args.latency,
+            'duration': args.duration, 'runs': runs}) + '\n')
+    print("results appended to", args.output)
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the correlators of multipletau.
+
+    crossover : correlate_numpy with the direct method (np.correlate) and
+        with the FFT, on random float64 inputs of lengths around
+        FFT_CROSSOVER, the length from which method="auto" takes the FFT.
+        It reports the time per call of each method and the shortest
+        length from which the FFT is faster at every longer length.
+    lags : autocorrelate and correlate, which compute all the lags of a
+        level in one pass (_lag_sums) and bin the trace in place (_fold),
+        against perLagCorrelate, the former engine with one np.sum per lag,
+        on random float64 inputs of 1e5 to 1e8 elements (m=16, normalized).
+        It reports the time of each, the speed up and the peak memory
+        allocated (tracemalloc), and checks that the results agree.
+        correlate on 1e8 elements needs about 4 GB with the former engine.
+
+Each run is appended as one JSON line to the output file, as benchmark.py
+does, so that the results of successive versions can be compared.
+
+    python benchmark_multipletau.py crossover
+    python benchmark_multipletau.py lags --lengths 1e5,1e6,1e7
+"""
+
+import argparse
+import json
+import tracemalloc
+from datetime import datetime
+from time import perf_counter
+from timeit import Timer
+import numpy as np
+from benchmark import gitCommit
+from multipletau import autocorrelate, correlate, correlate_numpy
+from multipletau.core import FFT_CROSSOVER
+
+LENGTHS = {
+    'crossover': [2**k for k in range(5, 17)],
+    'lags': [10**k for k in range(5, 9)],
+    }
+M = 16 # points per level of the multiple-tau correlations
+
+
+def timePerCall(f):
+    """
+    output : the best time of one call of f over 3 measures of at least
+        0.2 s each (seconds)
+    """
+    timer = Timer(f)
+    number, _ = timer.autorange()
+    return min(timer.repeat(3, number))/number
+
+
+def crossover(lengths):
+    """
+    output : the times per call of both methods for each length, and the
+        shortest length from which the FFT is faster (None if it never is)
+    """
+    rng = np.random.default_rng(0)
+    times = []
+    for n in lengths:
+        a, v = rng.random((2, n))
+        direct = timePerCall(lambda: correlate_numpy(a, v, method="direct"))
+        fft = timePerCall(lambda: correlate_numpy(a, v, method="fft"))
+        times.append({'N': n, 'direct': direct, 'fft': fft})
+        print("N={:<7d} direct {:10.3f} ms   fft {:8.3f} ms".format(
+            n, direct*1e3, fft*1e3))
+    fastest = None
+    for t in reversed(times):
+        if t['fft'] >= t['direct']:
+            break
+        fastest = t['N']
+    print("the FFT is faster from N =", fastest, "on, FFT_CROSSOVER =",
+          FFT_CROSSOVER)
+    return {'times': times, 'crossover': fastest}
+
+
+def perLagCorrelate(a, v, m=M, deltat=1, normalize=False):
+    """
+    input : a, v (arrays) of the same length, the same one for an
+            autocorrelation, m (int) even, deltat (float), normalize (bool)
+    output : the correlation of multipletau before _lag_sums and _fold,
+        the reference of the lags benchmark and of the tests
+        Each lag is one np.sum of the product of the traces, which
+    allocates a temporary array of the size of the trace, and each
+    binning a new array.
+    """
+    dtype = np.result_type(a, v, np.float64)
+    trace1 = np.array(v, dtype=dtype)
+    trace2 = trace1 if a is v else np.array(a, dtype=dtype)
+    avg1 = np.average(trace1)
+    avg2 = np.average(trace2)
+    if dtype.kind == "c":
+        trace1 = np.conj(trace1)
+    if normalize:
+        trace1 -= np.conj(avg1)
+        if trace2 is not trace1:
+            trace2 -= avg2
+
+    N = N0 = trace1.shape[0]
+    k = int(np.floor(np.log2(N / m)))
+    lenG = m + k * m // 2 + 1
+    G = np.zeros((lenG, 2), dtype=dtype)
+    normstat = np.zeros(lenG)
+    normnump = np.zeros(lenG)
+
+    def fold(trace1, trace2, N):
+        binned = (trace1[:N:2] + trace1[1:N:2]) / 2
+        if trace2 is trace1:
+            return binned, binned
+        return binned, (trace2[:N:2] + trace2[1:N:2]) / 2
+
+    for n in range(m + 1):
+        G[n, 0] = deltat * n
+        G[n, 1] = np.sum(trace1[:N - n] * trace2[n:])
+        normstat[n] = N - n
+        normnump[n] = N
+    N -= N % 2
+    trace1, trace2 = fold(trace1, trace2, N)
+    N //= 2
+    for step in range(1, k + 1):
+        for n in range(1, m // 2 + 1):
+            npmd2 = n + m // 2
+            idx = m + n + (step - 1) * m // 2
+            if len(trace1[:N - npmd2]) == 0:
+                G = G[:idx - 1]
+                normstat = normstat[:idx - 1]
+                normnump = normnump[:idx - 1]
+                break
+            G[idx, 0] = deltat * npmd2 * 2**step
+            G[idx, 1] = np.sum(trace1[:N - npmd2] * trace2[npmd2:])
+            normstat[idx] = N - npmd2
+            normnump[idx] = N
+        N -= N % 2
+        trace1, trace2 = fold(trace1, trace2, N)
+        N //= 2
+
+    if normalize:
+        G[:, 1] /= avg1 * avg2 * normstat
+    else:
+        G[:, 1] *= N0 / normnump
+    return G
+
+
+def measure(f):
+    """
+    output : the result of f, the best time of up to 3 calls (seconds)
+        and the peak memory allocated by one call (bytes)
+    """
+    tracemalloc.start()
+    result = f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    times = []
+    while len(times) < 3 and sum(times) < 1.:
+        start = perf_counter()
+        result = f()
+        times.append(perf_counter() - start)
+    return result, min(times), peak
+
+
+def lags(lengths):
+    """
+    output : for each function and length, the times and peak memories
+        of the former and of the present engine, and the largest
+        difference of their results relative to the largest value
+    """
+    rng = np.random.default_rng(0)
+    runs = []
+    for n in lengths:
+        a = rng.random(n)
+        for name in ('autocorrelate', 'correlate'):
+            if name == 'autocorrelate':
+                v = a
+                present = lambda: autocorrelate(a, m=M, normalize=True)
+            else:
+                v = rng.random(n)
+                present = lambda: correlate(a, v, m=M, normalize=True)
+            G0, before, peak0 = measure(
+                lambda: perLagCorrelate(a, v, m=M, normalize=True))
+            G, after, peak = measure(present)
+            error = np.abs(G[:, 1] - G0[:, 1]).max()/np.abs(G0[:, 1]).max()
+            runs.append({'function': name, 'N': n, 'seconds': [before, after],
+                         'peak_bytes': [peak0, peak], 'error': error})
+            print("{:13s} N={:<9d} {:8.3f} s {:7.1f} MB -> {:8.3f} s "
+                  "{:7.1f} MB : speed up {:.1f}x, memory / {:.1f}, "
+                  "error {:.1e}".format(name, n, before, peak0/1e6, after,
+                                        peak/1e6, before/after, peak0/peak,
+                                        error))
+            del G0, G, v
+    return runs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the "
+        "correlators of multipletau")
+    parser.add_argument('mode', choices=['crossover', 'lags'])
+    parser.add_argument('--lengths', help="lengths of the inputs, comma "
+        "separated (default : {})".format(", ".join(
+            "{} for {}".format(",".join(map(str, v)), k)
+            for k, v in LENGTHS.items())))
+    parser.add_argument('--output', default='benchmarks.jsonl')
+    args = parser.parse_args()
+
+    if args.lengths :
+        lengths = [int(float(n)) for n in args.lengths.split(',')]
+    else :
+        lengths = LENGTHS[args.mode]
+    if args.mode == 'crossover' :
+        results = crossover(lengths)
+    else :
+        results = lags(lengths)
+    with open(args.output, 'a') as f :
+        f.write(json.dumps({
+            'benchmark': 'multipletau ' + args.mode,
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'commit': gitCommit(),
+            'results': results,
+            }) + '\n')
+    print("results appended to", args.output)
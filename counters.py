@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""
+Decoding of the photon counter stream.
+
+The instrument sends one value of a free-running 8-bit counter per
+sample. The number of photons counted during a sample is the difference
+with the previous value, modulo 256 : np.diff on uint8 values wraps
+exactly like the counter does. The first value of a stream has no
+previous value, it is only used as the base of the next one.
+
+The functions decode one chunk given the counter value before it
+(last), CounterDecoder keeps that state from one chunk to the next.
+
+At low count rates most samples count no photon : timeTags gives the
+sparse form of the stream, the index of each sample that counted
+photons (its time tag, in sample periods) and how many it counted.
+"""
+
+import numpy as np
+
+
+def asCounter(data):
+    """
+    input : data (bytes-like, array or list of bytes-like chunks)
+    output : the counter values as a uint8 array
+        A single buffer is not copied.
+    """
+    if isinstance(data, list):
+        chunks = [np.frombuffer(c, dtype=np.uint8) for c in data]
+        if len(chunks) == 1:
+            return chunks[0]
+        return np.concatenate(chunks) if chunks else np.zeros(0, np.uint8)
+    if isinstance(data, np.ndarray):
+        return data.astype(np.uint8, copy=False)
+    return np.frombuffer(data, dtype=np.uint8)
+
+
+def photonCounts(data, last=None):
+    """
+    input : data counter values (see asCounter),
+            last (int or None) the counter value before data
+    output : the number of photons of each sample (uint8 array)
+        Without last, the first value is only the base of the second
+    one and the result is one sample shorter.
+    """
+    data = asCounter(data)
+    if last is None:
+        return np.diff(data)
+    return np.diff(data, prepend=np.uint8(last))
+
+
+def cumulativeCounts(data, last=None, total=0):
+    """
+    input : data counter values, last (int or None) the counter value
+            before data, total (int) photons counted before data
+    output : the total number of photons after each sample (uint64 array)
+    """
+    counts = np.cumsum(photonCounts(data, last), dtype=np.uint64)
+    counts += np.uint64(total)
+    return counts
+
+
+def timeTags(data, last=None, start=0):
+    """
+    input : data counter values, last (int or None) the counter value
+            before data, start (int) index of the first sample of data
+    output : (tags, multiplicity) the indices of the samples that
+    counted photons (uint64 array) and their number of photons (uint8
+    array)
+        Without last, the first sample only serves as a base.
+    """
+    counts = photonCounts(data, last)
+    if last is None:
+        start += 1
+    tags = np.flatnonzero(counts)
+    return (tags + start).astype(np.uint64), counts[tags]
+
+
+def binCounts(data, last, binsize):
+    """
+    input : data counter values, last (int) the counter value before
+            data, binsize (int) number of samples per bin
+    output : the photon count of each complete bin (uint32 array)
+        The samples of an incomplete last bin are ignored.
+    """
+    data = asCounter(data)
+    nbins = len(data)//binsize
+    counts = photonCounts(data[:nbins*binsize], last)
+    return counts.reshape(nbins, binsize).sum(axis=1, dtype=np.uint32)
+
+
+class CounterDecoder:
+    """
+    Streaming decoder of the counter stream : it keeps the last counter
+    value, the running total and the incomplete bin from one chunk to
+    the next one.
+    """
+
+    def __init__(self, last=None):
+        """
+        input : last (int or None) the counter value before the first
+        chunk, if it is known
+        """
+        self.last = last
+        self.samples = 0 # samples received since the start
+        self.total = 0 # photons counted since the start
+        self.binsum = 0 # photons of the incomplete bin
+        self.binfill = 0 # samples of the incomplete bin
+
+    def resync(self, dropped=0):
+        """
+        input : dropped (int) number of samples lost in the gap
+        To call after a gap in the stream : the first value of the next
+        chunk is then only used as a base.
+        """
+        self.last = None
+        self.samples += dropped
+
+    def counts(self, data):
+        """
+        input : data counter values (see asCounter)
+        output : the number of photons of each sample (uint8 array)
+        """
+        data = asCounter(data)
+        if not len(data):
+            return np.zeros(0, dtype=np.uint8)
+        counts = photonCounts(data, self.last)
+        self.last = int(data[-1])
+        self.samples += len(data)
+        self.total += int(counts.sum(dtype=np.uint64))
+        return counts
+
+    def count(self, data):
+        """
+        output : the number of photons in data (int)
+        """
+        return int(self.counts(data).sum(dtype=np.uint64))
+
+    def cumulative(self, data):
+        """
+        output : the total number of photons since the start after each
+        sample of data (uint64 array)
+        """
+        total = self.total
+        counts = np.cumsum(self.counts(data), dtype=np.uint64)
+        counts += np.uint64(total)
+        return counts
+
+    def tags(self, data):
+        """
+        output : (tags, multiplicity) of data, see timeTags, the tags
+        count the samples since the start (including the dropped ones)
+        """
+        counts = self.counts(data)
+        tags = np.flatnonzero(counts)
+        start = self.samples - len(counts)
+        return (tags + start).astype(np.uint64), counts[tags]
+
+    def bins(self, data, binsize):
+        """
+        input : data counter values, binsize (int) samples per bin
+        output : the photon count of each bin completed by data (uint64
+        array), the bins run on from one chunk to the next
+        """
+        counts = self.counts(data)
+        need = binsize - self.binfill
+        if len(counts) < need:
+            self.binsum += int(counts.sum(dtype=np.uint64))
+            self.binfill += len(counts)
+            return np.zeros(0, dtype=np.uint64)
+        rest = counts[need:]
+        nbins = len(rest)//binsize
+        bins = np.empty(nbins + 1, dtype=np.uint64)
+        bins[0] = self.binsum + int(counts[:need].sum(dtype=np.uint64))
+        bins[1:] = rest[:nbins*binsize].reshape(nbins, binsize).sum(
+            axis=1, dtype=np.uint64)
+        tail = rest[nbins*binsize:]
+        self.binsum = int(tail.sum(dtype=np.uint64))
+        self.binfill = len(tail)
+        return bins
+
+
+if __name__ == "__main__":
+    # microbenchmark against the former Gui.nbPhoton on 64 KiB packets
+    from timeit import timeit
+
+    def nbPhoton(data, old_data):
+        return (data[0] - old_data) + sum(data[1:]-data[:-1])
+
+    rng = np.random.default_rng(0)
+    packet = np.cumsum(rng.poisson(0.5, 65536)).astype(np.uint8)
+    decoder = CounterDecoder(last=0)
+    n = 50
+    with np.errstate(over='ignore'):
+        old = timeit(lambda: nbPhoton(packet, packet[-1]), number=n)/n
+    new = timeit(lambda: decoder.count(packet), number=n)/n
+    print("nbPhoton : {:.3f} ms per packet".format(old*1e3))
+    print("CounterDecoder.count : {:.3f} ms per packet".format(new*1e3))
+    print("speed up : {:.0f}x".format(old/new))
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+"""
+Metrics of wserialserv.
+
+Counters, gauges and histograms are updated by the threads of the
+server as they work, a few dictionary updates per packet. They are read
+by the STATS command (snapshot(), as JSON) and, when the server is
+started with --metrics-port, in the Prometheus text format over HTTP
+(serveMetrics). A metric can have labels, the client for instance. The
+gauges that describe a state rather than an event are updated by the
+collectors, called before each read of the metrics.
+
+logLimited replaces the messages that could be printed for every packet
+: a message is printed at most once every LOG_PERIOD seconds, with the
+number of the ones left out meanwhile.
+"""
+
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+
+LOG_PERIOD = 5. # seconds between two messages of the same kind
+DURATIONS = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1., 3.)
+
+REGISTRY = [] # every metric created
+COLLECTORS = [] # callables updating gauges before the metrics are read
+
+
+def labelKey(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {} # labels (labelKey) -> value
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def remove(self, **labels):
+        with self.lock:
+            self.values.pop(labelKey(labels), None)
+
+    def items(self):
+        with self.lock:
+            return [(dict(key), self.copy(value))
+                    for key, value in self.values.items()]
+
+    def copy(self, value):
+        return value
+
+    def samples(self):
+        """
+        output : (name, labels, value) of each line of the text format
+        """
+        return [(self.name, labels, value) for labels, value in self.items()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, n=1, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[labelKey(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DURATIONS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None: # counts per bucket and +Inf, sum
+                counts = self.values[key] = [0]*(len(self.buckets) + 1) + [0.]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def copy(self, value):
+        return list(value)
+
+    def samples(self):
+        lines = []
+        for labels, counts in self.items():
+            total = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                total += n
+                lines.append((self.name + '_bucket',
+                              dict(labels, le='{:g}'.format(bound)), total))
+            lines.append((self.name + '_sum', labels, counts[-1]))
+            lines.append((self.name + '_count', labels, total))
+        return lines
+
+
+def collector(callback):
+    """
+    input : callback (callable without argument) updating gauges, it is
+    called from the thread that reads the metrics
+    """
+    COLLECTORS.append(callback)
+    return callback
+
+
+def collect():
+    for callback in COLLECTORS:
+        callback()
+
+
+def snapshot():
+    """
+    output : {name : [{'labels' : ..., 'value' : ...}]} of every metric,
+    the value of a histogram is {'count', 'sum', 'buckets' : [[bound,
+    cumulative count]]}
+    """
+    collect()
+    stats = {}
+    for metric in REGISTRY:
+        values = []
+        for labels, value in metric.items():
+            if isinstance(metric, Histogram):
+                total, buckets = 0, []
+                for bound, n in zip(metric.buckets, value):
+                    total += n
+                    buckets.append([bound, total])
+                value = {'count': sum(value[:-1]), 'sum': value[-1],
+                         'buckets': buckets}
+            values.append({'labels': labels, 'value': value})
+        stats[metric.name] = values
+    return stats
+
+
+def text():
+    """
+    output : the metrics in the Prometheus text format (string)
+    """
+    collect()
+    lines = []
+    for metric in REGISTRY:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for name, labels, value in metric.samples():
+            if labels:
+                name += '{' + ','.join('{}="{}"'.format(k, v)
+                                       for k, v in sorted(labels.items())) + '}'
+            lines.append('{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # no line per scrape
+        pass
+
+
+def serveMetrics(port):
+    """
+    input : port (int) of the HTTP listener
+    output : the HTTP server, serving from its own thread until its
+    shutdown()
+    """
+    httpd = ThreadingHTTPServer(('', port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print("Metrics on port {0}".format(port))
+    return httpd
+
+
+logged = {} # kind -> [time of the last message, messages left out]
+logLock = threading.Lock()
+
+def logLimited(kind, *args):
+    """
+    input : kind (hashable) of the message, args printed
+        Prints at most one message of each kind every LOG_PERIOD seconds.
+    """
+    now = monotonic()
+    with logLock:
+        last = logged.setdefault(kind, [-LOG_PERIOD, 0])
+        if now - last[0] < LOG_PERIOD:
+            last[1] += 1
+            return
+        skipped = last[1]
+        last[:] = [now, 0]
+    if skipped:
+        print(*args, "({} more since the last one)".format(skipped))
+    else:
+        print(*args)
+
+
+# --- metrics of the server ------------------------------------------------
+
+SERIAL_BYTES = Counter('wserialserv_serial_bytes_total',
+                       "bytes read from the instrument")
+SERIAL_READ = Histogram('wserialserv_serial_read_seconds',
+                        "duration of the reads from the instrument")
+SERIAL_WAITING = Gauge('wserialserv_serial_waiting_bytes',
+                       "bytes waiting in the link before the last read")
+SOURCE_LOST = Gauge('wserialserv_source_lost_bytes',
+                    "bytes a simulated instrument lost because they were "
+                    "not read in time")
+CLIENTS = Gauge('wserialserv_clients', "connected clients")
+SENT_BYTES = Counter('wserialserv_sent_bytes_total',
+                     "bytes of stream sent to a client")
+SENT_FRAMES = Counter('wserialserv_sent_frames_total',
+                      "frames sent to a client")
+DROPPED_BYTES = Counter('wserialserv_dropped_bytes_total',
+                        "bytes of stream a client did not get")
+RING_USED = Gauge('wserialserv_ring_used_bytes',
+                  "bytes of the ring holding intact data (head - oldest)")
+BACKLOG = Gauge('wserialserv_client_backlog_bytes',
+                "bytes acquired that a client with credit has not been "
+                "sent yet")
+SEND_TIME = Histogram('wserialserv_send_seconds',
+                      "time taken to send a frame to a client")
+PACKET_AGE = Histogram('wserialserv_packet_age_seconds',
+                       "time from the acquisition of a packet to its send")
@@ -70,8 +70,25 @@ The package is straightforward to use. Here is a quick example:
            [   4.        ,  491.85812017],
            [   8.        ,  386.39500297]])
 
+The autocorrelation of a trace that is still being acquired can be
+followed with :class:`MultipleTauAccumulator`, which is fed the
+trace chunk by chunk:
+
+    >>> acc = multipletau.MultipleTauAccumulator(m=2)
+    >>> for chunk in np.split(np.linspace(2,5,42), 6):
+    ...     acc.update(chunk)
+    >>> G = acc.get()
+
+All the auto- and cross-correlations of a set of channels are given
+by :func:`correlate_matrix`, which spreads the pairs over a pool of
+processes. At low count rates, :func:`autocorrelate_timetags` works
+on the indices of the bins holding photons instead of the whole trace.
+
 """
 from .core import autocorrelate, correlate, correlate_numpy  # noqa: F401
+from .stream import MultipleTauAccumulator  # noqa: F401
+from .matrix import correlate_matrix  # noqa: F401
+from .timetag import autocorrelate_timetags  # noqa: F401
 from ._version import version as __version__  # noqa: F401
 
 __author__ = u"Paul Müller"
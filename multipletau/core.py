@@ -38,11 +38,25 @@ from __future__ import division
 import numpy as np
 import warnings
 
+from .stream import MultipleTauAccumulator
+
 __all__ = ["autocorrelate", "correlate", "correlate_numpy"]
 
+#: length of the input from which ``correlate_numpy(method="auto")``
+#: uses the FFT
+FFT_CROSSOVER = 512
+
+#: number of elements of the trace processed at once by the lag and
+#: binning kernels
+BLOCK = 4096
+
+#: number of elements read at once by the out-of-core mode of
+#: ``autocorrelate``
+OOC_BLOCK = 2**20
+
 
 def autocorrelate(a, m=16, deltat=1, normalize=False,
-                  copy=True, dtype=None):
+                  copy=True, dtype=None, blocksize=None):
     """
     Autocorrelation of a 1-dimensional sequence on a log2-scale.
 
@@ -57,8 +71,8 @@ def autocorrelate(a, m=16, deltat=1, normalize=False,
 
     Parameters
     ----------
-    a : array-like
-        input sequence
+    a : array-like, np.memmap or str
+        input sequence, or the path of a ``.npy`` file containing it
     m : even integer
         defines the number of points on one level, must be an
         even integer
@@ -72,6 +86,10 @@ def autocorrelate(a, m=16, deltat=1, normalize=False,
     dtype : object to be converted to a data type object
         The data type of the returned array and of the accumulator
         for the multiple-tau computation.
+    blocksize : int or None
+        read the input by blocks of `blocksize` elements (out-of-core
+        mode, see notes). A path or a :py:class:`numpy.memmap` are
+        read by blocks of ``OOC_BLOCK`` elements if it is not given.
 
 
     Returns
@@ -97,6 +115,13 @@ def autocorrelate(a, m=16, deltat=1, normalize=False,
     For complex arrays, this method falls back to the method
     :func:`correlate`.
 
+    In the out-of-core mode, the input is never loaded or cast as a
+    whole: the blocks are fed to a
+    :class:`multipletau.MultipleTauAccumulator`, which only keeps
+    the running sums and the last `m` values of each level. The
+    memory used is that of a few blocks, whatever the length of
+    the input. This mode only supports real input sequences.
+
 
     Examples
     --------
@@ -111,6 +136,11 @@ def autocorrelate(a, m=16, deltat=1, normalize=False,
     assert isinstance(copy, bool)
     assert isinstance(normalize, bool)
 
+    if isinstance(a, str) or isinstance(a, np.memmap) or blocksize:
+        return _autocorrelate_blocks(a, m=m, deltat=deltat,
+                                     normalize=normalize, dtype=dtype,
+                                     blocksize=blocksize)
+
     if dtype is None:
         dtype = np.dtype(a[0].__class__)
     else:
@@ -133,6 +163,9 @@ def autocorrelate(a, m=16, deltat=1, normalize=False,
     # If copy is false and dtype is the same as the input array,
     # then this line does not have an effect:
     trace = np.array(a, dtype=dtype, copy=copy)
+    # The binned traces overwrite the trace unless it is the input
+    inplace = copy or not (isinstance(a, np.ndarray) and
+                           np.may_share_memory(trace, a))
 
     # Check parameters
     if m // 2 != m / 2:
@@ -173,10 +206,11 @@ def autocorrelate(a, m=16, deltat=1, normalize=False,
 
     # Calculate autocorrelation function for first m+1 bins
     # Discrete convolution of m elements
+    # This is the computationally intensive step
+    sums = _lag_sums(trace, trace, 0, m)
     for n in range(0, m + 1):
         G[n, 0] = deltat * n
-        # This is the computationally intensive step
-        G[n, 1] = np.sum(trace[:N - n] * trace[n:])
+        G[n, 1] = sums[n]
         normstat[n] = N - n
         normnump[n] = N
     # Now that we calculated the first m elements of G, let us
@@ -185,11 +219,14 @@ def autocorrelate(a, m=16, deltat=1, normalize=False,
     if N % 2 == 1:
         N -= 1
     # Add up every second element
-    trace = (trace[:N:2] + trace[1:N:2]) / 2
+    trace = _fold(trace, N, inplace)
+    inplace = True
     N //= 2
     # Start iteration for each m/2 values
     for step in range(1, k + 1):
         # Get the next m/2 values via correlation of the trace
+        # This is the computationally intensive step
+        sums = _lag_sums(trace, trace, m // 2 + 1, m)
         for n in range(1, m // 2 + 1):
             npmd2 = n + m // 2
             idx = m + n + (step - 1) * m // 2
@@ -218,16 +255,14 @@ def autocorrelate(a, m=16, deltat=1, normalize=False,
                 break
             else:
                 G[idx, 0] = deltat * npmd2 * 2**step
-                # This is the computationally intensive step
-                G[idx, 1] = np.sum(trace[:N - npmd2] *
-                                   trace[npmd2:])
+                G[idx, 1] = sums[n - 1]
                 normstat[idx] = N - npmd2
                 normnump[idx] = N
         # Check if len(trace) is even:
         if N % 2 == 1:
             N -= 1
         # Add up every second element
-        trace = (trace[:N:2] + trace[1:N:2]) / 2
+        trace = _fold(trace, N, inplace)
         N //= 2
 
     if normalize:
@@ -338,6 +373,9 @@ def correlate(a, v, m=16, deltat=1, normalize=False,
         dtype = np.dtype(np.float_)
 
     trace1 = np.array(v, dtype=dtype, copy=copy)
+    # The binned traces overwrite the traces unless they are the inputs
+    inplace1 = copy or not (isinstance(v, np.ndarray) and
+                            np.may_share_memory(trace1, v))
 
     # Prevent traces from overwriting each other
     if a is v:
@@ -345,6 +383,8 @@ def correlate(a, v, m=16, deltat=1, normalize=False,
         copy = True
 
     trace2 = np.array(a, dtype=dtype, copy=copy)
+    inplace2 = copy or not (isinstance(a, np.ndarray) and
+                            np.may_share_memory(trace2, a))
 
     assert trace1.shape[0] == trace2.shape[0], "`a`,`v` must have same length!"
 
@@ -386,21 +426,23 @@ def correlate(a, v, m=16, deltat=1, normalize=False,
     assert N >= 2 * m, "len(a) must be larger than 2m!"
 
     # Calculate autocorrelation function for first m+1 bins
+    sums = _lag_sums(trace1, trace2, 0, m)
     for n in range(0, m + 1):
         G[n, 0] = deltat * n
-        G[n, 1] = np.sum(trace1[:N - n] * trace2[n:])
+        G[n, 1] = sums[n]
         normstat[n] = N - n
         normnump[n] = N
     # Check if len(trace) is even:
     if N % 2 == 1:
         N -= 1
     # Add up every second element
-    trace1 = (trace1[:N:2] + trace1[1:N:2]) / 2
-    trace2 = (trace2[:N:2] + trace2[1:N:2]) / 2
+    trace1 = _fold(trace1, N, inplace1)
+    trace2 = _fold(trace2, N, inplace2)
     N //= 2
 
     for step in range(1, k + 1):
         # Get the next m/2 values of the trace
+        sums = _lag_sums(trace1, trace2, m // 2 + 1, m)
         for n in range(1, m // 2 + 1):
             npmd2 = (n + m // 2)
             idx = m + n + (step - 1) * m // 2
@@ -412,8 +454,7 @@ def correlate(a, v, m=16, deltat=1, normalize=False,
                 break
             else:
                 G[idx, 0] = deltat * npmd2 * 2**step
-                G[idx, 1] = np.sum(
-                    trace1[:N - npmd2] * trace2[npmd2:])
+                G[idx, 1] = sums[n - 1]
                 normstat[idx] = N - npmd2
                 normnump[idx] = N
 
@@ -421,8 +462,8 @@ def correlate(a, v, m=16, deltat=1, normalize=False,
         if N % 2 == 1:
             N -= 1
         # Add up every second element
-        trace1 = (trace1[:N:2] + trace1[1:N:2]) / 2
-        trace2 = (trace2[:N:2] + trace2[1:N:2]) / 2
+        trace1 = _fold(trace1, N, True)
+        trace2 = _fold(trace2, N, True)
         N //= 2
 
     if normalize:
@@ -434,7 +475,8 @@ def correlate(a, v, m=16, deltat=1, normalize=False,
 
 
 def correlate_numpy(a, v, deltat=1, normalize=False,
-                    dtype=None, copy=True):
+                    dtype=None, copy=True, method="direct",
+                    chunksize=None, m=16):
     """
     Convenience function that wraps around :py:func:`numpy.correlate` and
     returns the correlation in the same format as :func:`correlate` does.
@@ -454,6 +496,23 @@ def correlate_numpy(a, v, deltat=1, normalize=False,
         copy input array, set to ``False`` to save memory
     dtype : object to be converted to a data type object
         The data type of the returned array.
+    method : str
+        ``"direct"`` uses :py:func:`numpy.correlate`, ``"fft"`` the
+        fast Fourier transform and ``"auto"`` the fastest of the two
+        for the length of the input (``"fft"`` from
+        ``FFT_CROSSOVER`` elements on).
+    chunksize : int or None
+        with ``method="fft"``, correlate the input by blocks of
+        `chunksize` elements that are added up (overlap-add), so that
+        only a few blocks of `a` and `v` are in memory at once; `a`
+        and `v` may then be :py:class:`numpy.memmap` arrays. The
+        correlation is then only given at the lag times of
+        :func:`correlate` (see `m`).
+    m : even integer
+        with `chunksize`, the correlation is computed at the lag
+        times of :func:`correlate` with this `m` instead of at every
+        lag time, so that the memory used does not depend on the
+        length of the input.
 
 
     Returns
@@ -466,9 +525,29 @@ def correlate_numpy(a, v, deltat=1, normalize=False,
     -----
     .. versionchanged :: 0.1.6
        Removed false normalization when `normalize==False`.
+
+    Unlike :func:`correlate`, the values at the lag times of `m` are
+    those of the full-resolution correlation: the trace is not
+    binned.
+
+    The direct method is O(N²), the FFT method O(N log N) with
+    rounding errors of the order of the machine precision times the
+    largest value of the correlation.
     """
-    ab = np.array(a, dtype=dtype, copy=copy)
-    vb = np.array(v, dtype=dtype, copy=copy)
+    assert method in ["direct", "fft", "auto"], \
+        "`method` must be 'direct', 'fft' or 'auto'!"
+    if method == "auto":
+        method = "fft" if len(a) >= FFT_CROSSOVER else "direct"
+    assert chunksize is None or method == "fft", \
+        "`chunksize` needs method='fft'!"
+
+    if chunksize is None:
+        ab = np.array(a, dtype=dtype, copy=copy)
+        vb = np.array(v, dtype=dtype, copy=copy)
+    else:
+        # the blocks are cast and copied one at a time
+        ab = np.asarray(a)
+        vb = np.asarray(v)
 
     assert ab.shape[0] == vb.shape[0], "`a`,`v` must have same length!"
 
@@ -476,19 +555,225 @@ def correlate_numpy(a, v, deltat=1, normalize=False,
     vvg = np.average(vb)
 
     if normalize:
-        ab -= avg
-        vb -= vvg
         assert avg != 0, "Cannot normalize: Average of `a` is zero!"
         assert vvg != 0, "Cannot normalize: Average of `v` is zero!"
+        if chunksize is None:
+            ab -= avg
+            vb -= vvg
 
-    Gd = np.correlate(ab, vb, mode="full")[len(ab) - 1:]
+    N = ab.shape[0]
+    if chunksize is None:
+        lags = np.arange(N)
+    else:
+        if m // 2 != m / 2:
+            mold = m
+            m = np.int_((m // 2 + 1) * 2)
+            warnings.warn("Invalid value of m={}. Using m={} instead"
+                          .format(mold, m))
+        m = int(m)
+        k = max(0, int(np.floor(np.log2(N / m)))) if N else 0
+        lags = _layout(N, m, k, 1)[0].astype(np.int64)
+        lags = lags[lags < N]
+
+    if method == "direct":
+        Gd = np.correlate(ab, vb, mode="full")[len(ab) - 1:]
+    elif chunksize is None:
+        Gd = _correlate_fft(ab, vb)
+    else:
+        if normalize:
+            Gd = _correlate_fft_blocks(ab, vb, chunksize, dtype, lags,
+                                       avg, vvg)
+        else:
+            Gd = _correlate_fft_blocks(ab, vb, chunksize, dtype, lags)
 
     if normalize:
-        N = len(Gd)
-        m = N - np.arange(N)
-        Gd /= m * avg * vvg
+        Gd /= (N - lags) * avg * vvg
 
     G = np.zeros((len(Gd), 2), dtype=dtype)
     G[:, 1] = Gd
-    G[:, 0] = np.arange(len(Gd)) * deltat
+    G[:, 0] = lags * deltat
     return G
+
+
+def _autocorrelate_blocks(a, m, deltat, normalize, dtype, blocksize):
+    """
+    Out-of-core mode of :func:`autocorrelate`: the input (a path,
+    a :py:class:`numpy.memmap` or an array) is read `blocksize`
+    elements at a time.
+    """
+    if isinstance(a, str):
+        a = np.load(a, mmap_mode="r")
+    if blocksize is None:
+        blocksize = OOC_BLOCK
+    assert blocksize > 0, "`blocksize` must be positive!"
+
+    if dtype is None:
+        dtype = a.dtype
+    dtype = np.dtype(dtype)
+    assert dtype.kind != "c", "The out-of-core mode needs real data!"
+    if dtype.kind != "f":
+        warnings.warn("Input dtype is not float; casting to np.float_!")
+        dtype = np.dtype(np.float_)
+
+    if m // 2 != m / 2:
+        mold = m
+        m = np.int_((m // 2 + 1) * 2)
+        warnings.warn("Invalid value of m={}. Using m={} instead"
+                      .format(mold, m))
+
+    acc = MultipleTauAccumulator(m=m, deltat=deltat, normalize=normalize)
+    for start in range(0, a.shape[0], blocksize):
+        acc.update(a[start:start + blocksize])
+    return acc.get().astype(dtype)
+
+
+def _lag_sums(t1, t2, lo, hi):
+    """
+    Return the sums ``np.sum(t1[:N-n] * t2[n:])`` for all the lags
+    ``n = lo..hi`` at once.
+
+    The lags are computed together, block by block, as the product of
+    a block of `t1` with a sliding window view of `t2` (one column per
+    lag), so that no temporary array of the size of the trace is
+    created.
+    """
+    N = t1.shape[0]
+    nlags = hi - lo + 1
+    sums = np.zeros(nlags, dtype=np.result_type(t1, t2))
+    # every lag is defined for the elements before `full`
+    full = max(0, N - hi)
+    if full:
+        step = t2.strides[0]
+        windows = np.lib.stride_tricks.as_strided(
+            t2[lo:], shape=(full, nlags), strides=(step, step),
+            writeable=False)
+        for start in range(0, full, BLOCK):
+            stop = min(full, start + BLOCK)
+            sums += np.dot(t1[start:stop], windows[start:stop])
+    # the last elements, for which only the shorter lags are defined
+    for j, n in enumerate(range(lo, hi + 1)):
+        if N - n > full:
+            sums[j] += np.dot(t1[full:N - n], t2[full + n:N])
+    return sums
+
+
+def _fold(trace, N, inplace):
+    """
+    Return the average of every two neighboring elements of
+    ``trace[:N]`` (`N` even).
+
+    With `inplace`, the result is written over the first `N/2`
+    elements of `trace`. The blocks never overwrite elements that
+    are still to be read: block ``start:stop`` reads
+    ``2*start:2*stop`` and ``stop <= 2*start``.
+    """
+    if not inplace:
+        out = trace[:N:2] + trace[1:N:2]
+        out /= 2
+        return out
+    half = N // 2
+    start = 0
+    while start < half:
+        stop = min(half, start + max(1, min(start, BLOCK)))
+        out = trace[start:stop]
+        np.add(trace[2 * start:2 * stop:2],
+               trace[2 * start + 1:2 * stop:2], out=out)
+        out /= 2
+        start = stop
+    return trace[:half]
+
+
+def _layout(N, m, k, deltat):
+    """
+    Return the lag times and the normalization factors of
+    :func:`multipletau.correlate` for a trace of length `N`.
+    """
+    lenG = m + k * m // 2 + 1
+    lags = np.zeros(lenG)
+    normstat = np.zeros(lenG)
+    normnump = np.zeros(lenG)
+    for n in range(0, m + 1):
+        lags[n] = deltat * n
+        normstat[n] = N - n
+        normnump[n] = N
+    N -= N % 2
+    N //= 2
+    for step in range(1, k + 1):
+        for n in range(1, m // 2 + 1):
+            npmd2 = n + m // 2
+            idx = m + n + (step - 1) * m // 2
+            if N - npmd2 <= 0:
+                # same truncation as `correlate`
+                return (lags[:idx - 1], normstat[:idx - 1],
+                        normnump[:idx - 1])
+            lags[idx] = deltat * npmd2 * 2**step
+            normstat[idx] = N - npmd2
+            normnump[idx] = N
+        N -= N % 2
+        N //= 2
+    return lags, normstat, normnump
+
+
+def _fft_length(n):
+    """Smallest power of two not smaller than `n`"""
+    return 1 << int(np.ceil(np.log2(max(n, 1))))
+
+
+def _correlate_fft(ab, vb):
+    """
+    Same as ``np.correlate(ab, vb, mode="full")[len(ab)-1:]``
+    computed with the FFT.
+    """
+    N = ab.shape[0]
+    nfft = _fft_length(2 * N - 1)
+    if np.iscomplexobj(ab) or np.iscomplexobj(vb):
+        fa = np.fft.fft(ab, nfft)
+        fa *= np.conj(np.fft.fft(vb, nfft))
+        return np.fft.ifft(fa)[:N]
+    fa = np.fft.rfft(ab, nfft)
+    fa *= np.conj(np.fft.rfft(vb, nfft))
+    return np.fft.irfft(fa, nfft)[:N]
+
+
+def _correlate_fft_blocks(ab, vb, chunksize, dtype, lags, avg=0, vvg=0):
+    """
+    Same as :func:`_correlate_fft` at the lags `lags` only, with `ab`
+    and `vb` read by blocks of `chunksize` elements, from which `avg`
+    and `vvg` are subtracted. The pair of blocks ``i`` of `vb` and
+    ``j = i + o`` of `ab` contributes to the lags
+    ``o*chunksize-chunksize+1 .. o*chunksize+chunksize-1``: only the
+    pairs holding one of `lags` are correlated, and only `lags` are
+    kept, so that neither the memory nor the number of pairs grow
+    with the square of the input.
+    """
+    N = ab.shape[0]
+    B = int(chunksize)
+    assert B > 0, "`chunksize` must be positive!"
+    nfft = _fft_length(2 * B - 1)
+    cplx = (np.iscomplexobj(ab) or np.iscomplexobj(vb) or
+            (dtype is not None and np.dtype(dtype).kind == "c"))
+    if cplx:
+        fft, ifft = np.fft.fft, np.fft.ifft
+        Gd = np.zeros(lags.shape[0], dtype=np.complex_)
+    else:
+        fft, ifft = np.fft.rfft, np.fft.irfft
+        Gd = np.zeros(lags.shape[0])
+    # the lag d = o*B + s is at c[s] for the pairs o blocks apart and,
+    # when s > 0, at c[nfft-B+s] (negative shift) for the pairs o + 1
+    # blocks apart
+    o, s = np.divmod(lags, B)
+    split = s > 0
+    offsets = np.concatenate((o, o[split] + 1))
+    slots = np.concatenate((np.arange(lags.shape[0]), np.flatnonzero(split)))
+    shifts = np.concatenate((s, nfft - B + s[split]))
+    nblocks = (N + B - 1) // B
+    for offset in np.unique(offsets):
+        pick = offsets == offset
+        slot, shift = slots[pick], shifts[pick]
+        for i in range(nblocks - offset):
+            j = i + offset
+            vi = np.asarray(vb[i * B:(i + 1) * B], dtype=dtype) - vvg
+            aj = np.asarray(ab[j * B:(j + 1) * B], dtype=dtype) - avg
+            c = ifft(fft(aj, nfft) * np.conj(fft(vi, nfft)), nfft)
+            Gd[slot] += c[shift]
+    return Gd
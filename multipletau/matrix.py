@@ -0,0 +1,217 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Multiple-τ correlation of every pair of a set of channels.
+
+The binned traces of every level are computed once for all the pairs
+and placed in shared memory, where the worker processes of
+:func:`correlate_matrix` read them without the traces being pickled.
+"""
+from __future__ import division
+
+import multiprocessing
+import os
+import warnings
+
+import numpy as np
+
+from .core import _lag_sums, _layout
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8: the pairs are computed in-process
+    shared_memory = None
+
+__all__ = ["correlate_matrix"]
+
+# binned traces seen by a worker process, set by `_attach`
+_worker = {}
+
+
+def correlate_matrix(traces, m=16, deltat=1, normalize=False,
+                     dtype=None, processes=None):
+    """
+    Auto- and cross-correlations of every pair of a set of
+    1-dimensional sequences on a log2-scale.
+
+    Parameters
+    ----------
+    traces : array-like of shape (C, N)
+        the C input sequences, all of length N
+    m : even integer
+        defines the number of points on one level, must be an
+        even integer
+    deltat : float
+        distance between bins
+    normalize : bool
+        normalize the result to the square of the average input
+        signal and the factor :math:`M-k`.
+    dtype : object to be converted to a data type object
+        The data type of the returned array and of the accumulator
+        for the multiple-tau computation.
+    processes : int or None
+        number of worker processes, ``None`` for one per CPU. With
+        1 process, or without :py:mod:`multiprocessing.shared_memory`,
+        everything is computed in the calling process.
+
+    Returns
+    -------
+    correlations : ndarray of shape (C, C, L, 2)
+        ``correlations[i, j]`` is the lag time (column 1) and the
+        cross-correlation (column 2) given by
+        ``correlate(traces[i], traces[j])``, the autocorrelations
+        are on the diagonal.
+
+    Notes
+    -----
+    The traces of each level are binned once, instead of once per
+    pair, and each worker computes the lags of whole pairs.
+
+    Examples
+    --------
+    >>> from multipletau import correlate_matrix
+    >>> G = correlate_matrix([range(42), range(1, 43)], m=2,
+    ...                      dtype=np.float_)
+    >>> G[0, 1]
+    array([[  0.00000000e+00,   2.46820000e+04],
+           [  1.00000000e+00,   2.38210000e+04],
+           [  2.00000000e+00,   2.29600000e+04],
+           [  4.00000000e+00,   2.12325000e+04],
+           [  8.00000000e+00,   1.58508000e+04]])
+    """
+    assert isinstance(normalize, bool)
+    traces = np.asarray(traces)
+    assert traces.ndim == 2, "`traces` must be 2-dimensional!"
+    C, N = traces.shape
+
+    if dtype is None:
+        dtype = traces.dtype
+    dtype = np.dtype(dtype)
+    if dtype.kind not in ["c", "f"]:
+        warnings.warn("Input dtype is not float; casting to np.float_!")
+        dtype = np.dtype(np.float_)
+
+    # Check parameters
+    if m // 2 != m / 2:
+        mold = m
+        m = np.int_(m // 2 + 1) * 2
+        warnings.warn("Invalid value of m={}. Using m={} instead"
+                      .format(mold, m))
+    else:
+        m = np.int_(m)
+    m = int(m)
+
+    assert N >= 2 * m, "len(a) must be larger than 2m!"
+
+    traceavg = np.average(traces, axis=1)
+    if normalize:
+        assert np.all(traceavg != 0), \
+            "Cannot normalize: Average of a trace is zero!"
+
+    k = int(np.floor(np.log2(N / m)))
+    lags, normstat, normnump = _layout(N, m, k, deltat)
+
+    # length of the binned traces of each level
+    lengths = [N]
+    for step in range(k):
+        lengths.append(lengths[-1] // 2)
+    size = sum(C * n for n in lengths) * dtype.itemsize
+
+    pairs = [(i, j) for i in range(C) for j in range(C)]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(pairs))
+    parallel = processes > 1 and shared_memory is not None
+
+    shm = None
+    if parallel:
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        buf = shm.buf
+    else:
+        buf = bytearray(max(size, 1))
+    try:
+        levels = _level_views(buf, C, lengths, dtype)
+        _bin_levels(levels, traces, traceavg if normalize else None)
+        if parallel:
+            pool = multiprocessing.Pool(
+                processes, initializer=_attach,
+                initargs=(shm.name, C, lengths, dtype.str, m))
+            try:
+                sums = pool.map(_pair_sums_worker, pairs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            sums = [_pair_sums(levels, i, j, m) for i, j in pairs]
+    finally:
+        # the views must be released before the shared memory is closed
+        levels = None
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    L = lags.shape[0]
+    G = np.zeros((C, C, L, 2), dtype=dtype)
+    G[:, :, :, 0] = lags
+    for (i, j), s in zip(pairs, sums):
+        G[i, j, :, 1] = s[:L]
+        if normalize:
+            G[i, j, :, 1] /= traceavg[j] * traceavg[i] * normstat
+        else:
+            G[i, j, :, 1] *= N / normnump
+    return G
+
+
+def _level_views(buf, C, lengths, dtype):
+    """
+    Return the binned traces of each level, arrays of shape
+    (C, lengths[step]) placed one after the other in `buf`.
+    """
+    levels = []
+    offset = 0
+    for n in lengths:
+        levels.append(np.ndarray((C, n), dtype=dtype, buffer=buf,
+                                 offset=offset))
+        offset += C * n * dtype.itemsize
+    return levels
+
+
+def _bin_levels(levels, traces, traceavg):
+    """
+    Fill the levels with the traces (minus `traceavg` if given) and
+    their binned versions.
+    """
+    levels[0][:] = traces
+    if traceavg is not None:
+        levels[0] -= traceavg[:, np.newaxis]
+    for prev, level in zip(levels[:-1], levels[1:]):
+        n = level.shape[1]
+        np.add(prev[:, :2 * n:2], prev[:, 1:2 * n:2], out=level)
+        level /= 2
+
+
+def _pair_sums(levels, i, j, m):
+    """
+    Return the unnormalized correlation of the pair (i, j) for all the
+    lags, in the order of the result of :func:`multipletau.correlate`.
+    """
+    sums = []
+    for step, level in enumerate(levels):
+        v = level[j]
+        if np.iscomplexobj(v):
+            v = np.conj(v)
+        lo = 0 if step == 0 else m // 2 + 1
+        sums.append(_lag_sums(v, level[i], lo, m))
+    return np.concatenate(sums)
+
+
+def _attach(name, C, lengths, dtype, m):
+    """Worker initializer: map the binned traces in shared memory"""
+    shm = shared_memory.SharedMemory(name=name)
+    _worker["shm"] = shm
+    _worker["levels"] = _level_views(shm.buf, C, lengths, np.dtype(dtype))
+    _worker["m"] = m
+
+
+def _pair_sums_worker(pair):
+    return _pair_sums(_worker["levels"], pair[0], pair[1], _worker["m"])
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Streaming multiple-τ autocorrelation.
+
+:class:`MultipleTauAccumulator` is fed the trace chunk by chunk, as it
+is acquired, and gives the autocorrelation of everything received so
+far with the same lag times, normalization and result as
+:func:`multipletau.autocorrelate` run on the whole trace.
+"""
+from __future__ import division
+
+import numpy as np
+
+__all__ = ["MultipleTauAccumulator"]
+
+
+class _Level(object):
+    """
+    One level of the multiple-τ scheme: the trace binned `2**step`
+    times, of which only the running sums and a few values are kept.
+    """
+
+    def __init__(self, m):
+        self.m = m
+        # number of values of the binned trace and their sum
+        self.length = 0
+        self.total = 0.
+        # sum_i y_i y_{i+n} for the lags n = 0..m
+        self.sums = np.zeros(m + 1)
+        # first m and last m values of the binned trace
+        self.first = np.zeros(0)
+        self.last = np.zeros(0)
+        # first value of a pair that is not complete yet
+        self.pending = None
+
+    def update(self, y):
+        """Add the values `y` and return the pairs to pass on"""
+        m = self.m
+        size = y.shape[0]
+        if size == 0:
+            return y
+        ext = np.concatenate((self.last, y))
+        r = self.last.shape[0]
+        for n in range(m + 1):
+            j0 = max(0, n - r)
+            if j0 < size:
+                self.sums[n] += np.dot(y[j0:], ext[r + j0 - n:r + size - n])
+        if self.length < m:
+            self.first = np.concatenate((self.first, y[:m - self.length]))
+        self.last = ext[-m:].copy()
+        self.length += size
+        self.total += np.sum(y)
+        # bin neighboring values for the next level
+        if self.pending is not None:
+            y = np.concatenate(([self.pending], y))
+        if y.shape[0] % 2 == 1:
+            self.pending = y[-1]
+            y = y[:-1]
+        else:
+            self.pending = None
+        return (y[::2] + y[1::2]) / 2
+
+    def correlation(self, n, c):
+        """
+        Return sum_i (y_i - c)(y_{i+n} - c) over the binned trace
+        """
+        head = self.total - np.sum(self.last[self.last.shape[0] - n:])
+        tail = self.total - np.sum(self.first[:n])
+        return self.sums[n] - c * (head + tail) + c**2 * (self.length - n)
+
+
+class MultipleTauAccumulator(object):
+    """
+    Autocorrelation of a 1-dimensional sequence on a log2-scale,
+    computed while the sequence is acquired.
+
+    Each level of the multiple-τ scheme keeps the running sums of
+    the products of its lags and the last `m` values of its binned
+    trace, so that adding a sample costs O(m) per level and the
+    correlation can be read at any time without going through the
+    trace again.
+
+    Parameters
+    ----------
+    m : even integer
+        defines the number of points on one level, must be an
+        even integer
+    deltat : float
+        distance between bins
+    normalize : bool
+        normalize the result to the square of the average input
+        signal and the factor :math:`M-k`.
+
+    Notes
+    -----
+    The result of :func:`get` is that of
+    :func:`multipletau.autocorrelate` with ``dtype=np.float_`` on the
+    concatenation of all the chunks, up to the rounding errors.
+
+    Examples
+    --------
+    >>> from multipletau import MultipleTauAccumulator
+    >>> acc = MultipleTauAccumulator(m=2)
+    >>> acc.update(range(20))
+    >>> acc.update(range(20, 42))
+    >>> acc.get()
+    array([[  0.00000000e+00,   2.38210000e+04],
+           [  1.00000000e+00,   2.29600000e+04],
+           [  2.00000000e+00,   2.21000000e+04],
+           [  4.00000000e+00,   2.03775000e+04],
+           [  8.00000000e+00,   1.50612000e+04]])
+    """
+
+    def __init__(self, m=16, deltat=1, normalize=False):
+        assert isinstance(normalize, bool)
+        assert m // 2 == m / 2, "m must be an even integer!"
+        self.m = int(m)
+        self.deltat = deltat
+        self.normalize = normalize
+        self.levels = []
+        # the values are stored relative to this reference to limit
+        # the rounding errors of the running sums
+        self.reference = None
+
+    @property
+    def length(self):
+        """Number of samples received"""
+        return self.levels[0].length if self.levels else 0
+
+    def update(self, a):
+        """
+        Add the next chunk of the trace.
+
+        Parameters
+        ----------
+        a : array-like
+            the samples following the ones already added
+        """
+        y = np.asarray(a, dtype=np.float_).ravel()
+        if y.shape[0] == 0:
+            return
+        if self.reference is None:
+            self.reference = np.average(y)
+        y = y - self.reference
+        step = 0
+        while y.shape[0]:
+            if step == len(self.levels):
+                self.levels.append(_Level(self.m))
+            y = self.levels[step].update(y)
+            step += 1
+
+    def get(self):
+        """
+        Autocorrelation of the samples received so far.
+
+        Returns
+        -------
+        autocorrelation : ndarray of shape (N,2)
+            the lag time (1st column) and the autocorrelation (2nd
+            column), see :func:`multipletau.autocorrelate`.
+        """
+        m = self.m
+        N = self.length
+        assert N >= 2 * m, "len(a) must be larger than 2m!"
+        level = self.levels[0]
+        traceavg = self.reference + level.total / N
+        if self.normalize:
+            assert traceavg != 0, "Cannot normalize: Average of `a` is zero!"
+            c = traceavg - self.reference
+        else:
+            c = -self.reference
+
+        # same lags and truncation as `autocorrelate`
+        k = np.int_(np.floor(np.log2(N / m)))
+        lenG = m + k * (m // 2) + 1
+        G = np.zeros((lenG, 2))
+        normstat = np.zeros(lenG)
+        normnump = np.zeros(lenG)
+        for n in range(0, m + 1):
+            G[n, 0] = self.deltat * n
+            G[n, 1] = level.correlation(n, c)
+            normstat[n] = N - n
+            normnump[n] = N
+        for step in range(1, k + 1):
+            level = self.levels[step]
+            Ns = level.length
+            for n in range(1, m // 2 + 1):
+                npmd2 = n + m // 2
+                idx = m + n + (step - 1) * m // 2
+                if Ns - npmd2 <= 0:
+                    G = G[:idx - 1]
+                    normstat = normstat[:idx - 1]
+                    normnump = normnump[:idx - 1]
+                    break
+                G[idx, 0] = self.deltat * npmd2 * 2**step
+                G[idx, 1] = level.correlation(npmd2, c)
+                normstat[idx] = Ns - npmd2
+                normnump[idx] = Ns
+
+        if self.normalize:
+            G[:, 1] /= traceavg**2 * normstat
+        else:
+            G[:, 1] *= N / normnump
+        return G
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Multiple-τ autocorrelation of photon time tags.
+
+At low count rates most bins of a photon trace are empty. Instead of the
+dense trace, :func:`autocorrelate_timetags` takes the indices of the
+non-empty bins (the time tags) and their number of photons, and computes
+each lag by matching the tags with the tags shifted by the lag. The
+binning of the multiple-τ scheme merges the tags that fall into the
+same coarser bin. Once the binned trace is no longer sparse, the
+remaining levels are computed on the dense binned trace.
+"""
+from __future__ import division
+
+import warnings
+
+import numpy as np
+
+from .core import _lag_sums, _fold, _layout
+
+__all__ = ["autocorrelate_timetags"]
+
+#: the levels are computed on the dense binned trace once more than
+#: this fraction of its bins are tagged
+DENSE_FRACTION = 1 / 16
+
+
+def autocorrelate_timetags(tags, length, weights=None, m=16, deltat=1,
+                           normalize=False):
+    """
+    Autocorrelation of a photon trace given as time tags, on a
+    log2-scale.
+
+    The result is that of :func:`multipletau.autocorrelate` on the
+    dense trace ``trace[tags] = weights`` of `length` bins (with
+    ``dtype=np.float_``).
+
+    Parameters
+    ----------
+    tags : 1d array of int
+        sorted indices of the bins holding photons
+    length : int
+        number of bins of the trace
+    weights : 1d array or None
+        number of photons of each tag, 1 if None
+    m : even integer
+        defines the number of points on one level, must be an
+        even integer
+    deltat : float
+        distance between bins
+    normalize : bool
+        normalize the result to the square of the average input
+        signal and the factor :math:`M-k`.
+
+    Returns
+    -------
+    autocorrelation : ndarray of shape (N,2)
+        the lag time (1st column) and the autocorrelation (2nd column).
+
+    Notes
+    -----
+    A level costs O(K) for K tags, times the number of tags that
+    follow a tag within `m` bins, instead of O(length * m) for the
+    dense trace.
+
+    Examples
+    --------
+    >>> from multipletau import autocorrelate_timetags
+    >>> G = autocorrelate_timetags([3, 10, 11, 40], 64, m=4)
+    """
+    assert isinstance(normalize, bool)
+    t = np.asarray(tags, dtype=np.int64)
+    if weights is None:
+        w = np.ones(t.shape[0])
+    else:
+        w = np.asarray(weights, dtype=np.float_)
+    assert t.shape == w.shape, "`tags`,`weights` must have same length!"
+    assert np.all(np.diff(t) >= 0), "`tags` must be sorted!"
+    N = int(length)
+    assert t.shape[0] == 0 or (t[0] >= 0 and t[-1] < N), \
+        "`tags` must be in the trace!"
+    t, w = _merge(t, w)
+
+    # Check parameters
+    if m // 2 != m / 2:
+        mold = m
+        m = np.int_((m // 2 + 1) * 2)
+        warnings.warn("Invalid value of m={}. Using m={} instead"
+                      .format(mold, m))
+    m = int(m)
+    assert N >= 2 * m, "len(a) must be larger than 2m!"
+
+    traceavg = np.sum(w) / N
+    if normalize:
+        assert traceavg != 0, "Cannot normalize: Average of `a` is zero!"
+    c = traceavg if normalize else 0.
+
+    k = int(np.floor(np.log2(N / m)))
+    lags, normstat, normnump = _layout(N, m, k, deltat)
+    L = lags.shape[0]
+    G = np.zeros((L, 2))
+    G[:, 0] = lags
+
+    Ns = N
+    trace = None  # dense binned trace, once the tags are dense
+    for step in range(k + 1):
+        if trace is None and t.shape[0] > DENSE_FRACTION * Ns:
+            trace = np.zeros(Ns)
+            trace[t] = w
+            trace -= c
+        lo = 0 if step == 0 else m // 2 + 1
+        if trace is not None:
+            sums = _lag_sums(trace, trace, lo, m)
+        else:
+            sums = _tag_lag_sums(t, w, lo, m, Ns, c)
+        for n, s in zip(range(lo, m + 1), sums):
+            idx = n if step == 0 else n + step * m // 2
+            if idx < L:
+                G[idx, 1] = s
+        # bin for the next level
+        Ns -= Ns % 2
+        if trace is not None:
+            trace = _fold(trace, Ns, True)
+        else:
+            keep = t < Ns
+            t, w = _merge(t[keep] // 2, w[keep] / 2)
+        Ns //= 2
+
+    if normalize:
+        G[:, 1] /= traceavg**2 * normstat
+    else:
+        G[:, 1] *= N / normnump
+    return G
+
+
+def _merge(t, w):
+    """Add up the weights of equal sorted tags"""
+    if t.shape[0] < 2:
+        return t, w
+    starts = np.flatnonzero(np.diff(t, prepend=t[0] - 1))
+    if starts.shape[0] == t.shape[0]:
+        return t, w
+    return t[starts], np.add.reduceat(w, starts)
+
+
+def _tag_lag_sums(t, w, lo, hi, Ns, c):
+    """
+    Return sum_i (y_i - c)(y_{i+n} - c) for the lags ``n = lo..hi``
+    over the `Ns` bins of the trace y given by the unique sorted tags
+    `t` and their weights `w`.
+
+    The tag `d` places further is at least `d` bins away: the pairs
+    of tags closer than `hi` are found by comparing the tags with
+    the ones 1 to `hi` places further, and stops as soon as none is
+    close enough.
+    """
+    sums = np.zeros(hi + 1)
+    sums[0] = np.dot(w, w)
+    for d in range(1, min(hi, t.shape[0] - 1) + 1):
+        delta = t[d:] - t[:-d]
+        close = delta <= hi
+        if not close.any():
+            break
+        sums += np.bincount(delta[close], weights=(w[d:] * w[:-d])[close],
+                            minlength=hi + 1)
+    sums = sums[lo:]
+    if c:
+        n = np.arange(lo, hi + 1)
+        cumw = np.concatenate(([0.], np.cumsum(w)))
+        head = cumw[np.searchsorted(t, Ns - n)]
+        tail = cumw[-1] - cumw[np.searchsorted(t, n)]
+        sums += -c * (head + tail) + c**2 * (Ns - n)
+    return sums
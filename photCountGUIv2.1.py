@@ -22,6 +22,11 @@ from datetime import datetime
 import queue
 import threading
 import configparser
+from tracewriter import TraceWriter
+from counters import CounterDecoder
+from tracer import Tracer
+from protocol import (packCommand, STREAM, KTHXBYE, HELLO, FRAME,
+    unpackHello, unpackFrame)
 
 
 # --- parsing parameters from the parameters file ----------------------
@@ -68,12 +73,13 @@ def comThread(stat_lbl):
     This thread handles the comunication between this GUI and the server.
     It first tries to connect itself with the server and then it 
     collects the data from it and it puts it in the data_q formated as
-    a numpy array of ubyte."""
+    (acquisition time, dropped bytes, numpy array of ubyte). The 
+    acquisition time is converted from the server clock to time()."""
     global BUF
     connected = False
     while exit_q.empty():
         if not connected :
-            data_q.put(np.frombuffer(b'\x00'*BUF,dtype=np.ubyte))
+            data_q.put((time(), 0, np.frombuffer(b'\x00'*BUF,dtype=np.ubyte)))
             try :
                 sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 print("Attempting connection to ", (HOST, PORT))
@@ -92,37 +98,43 @@ def comThread(stat_lbl):
                 stat_lbl.adjustSize()
                 QApplication.processEvents()
                 sleep(1)
-            #retrieves the packet size from the server
+            #retrieves the packet size and the clock from the server
             else :
-                msg = ""
-                while "EOT" not in msg:
-                    msg += sock.recv(512).decode(encoding='ascii')
-                    if not msg :
-                        sock.close()
-                        connected = False
-                        print("Starting server")
-                        stat_lbl.setText("Status : Starting server")
-                        stat_lbl.adjustSize()
-                        QApplication.processEvents()
-                        sleep(1)
-                        break
-                if connected:
-                    BUF = int(msg.split("EOT")[0])
+                msg = recvPacketSize(sock, HELLO.size)
+                if type(msg) == int :
+                    sock.close()
+                    connected = False
+                    print("Starting server")
+                    stat_lbl.setText("Status : Starting server")
+                    stat_lbl.adjustSize()
+                    QApplication.processEvents()
+                    sleep(1)
+                else :
+                    hello = unpackHello(msg)
+                    BUF = hello.packet
+                    clockOffset = time() - hello.monotonic
                     print("NEW PACKET SIZE :: ", BUF)
                     stat_lbl.setText("Status : waiting for acquisition")
                     stat_lbl.adjustSize()
                     QApplication.processEvents()
+                    sock.sendall(packCommand(STREAM, 1)) #the server pushes the next packet as soon as it is acquired
 
         elif not data_q.full() :
-            sock.sendall("GIVEDATA".encode("ascii"))
-            data = recvPacketSize(sock, BUF)
-            if type(data) == int :
+            header = recvPacketSize(sock, FRAME.size)
+            if type(header) != int :
+                frame = unpackFrame(header)
+                data = recvPacketSize(sock, frame.length)
+            if type(header) == int or type(data) == int :
                 print("Connection broken !!")
                 connected = False
                 sock.close()
             else :
                 #print('data available:',len(data))
-                data_q.put(np.frombuffer(data,dtype=np.ubyte))
+                if frame.dropped :
+                    print("the server dropped", frame.dropped, "bytes")
+                data_q.put((frame.timestamp + clockOffset, frame.dropped,
+                            np.frombuffer(data,dtype=np.ubyte)))
+                sock.sendall(packCommand(STREAM, 1))
     if connected : 
         sock.close()
     exit()
@@ -230,11 +242,9 @@ class Gui(QWidget):
         
         # setting the tracer
         self.timer = QBasicTimer()
-        self.t = np.linspace(0, 0, N_tracer)
-        self.y = np.zeros(N_tracer)
-        self.data = np.zeros(N_tracer)
+        self.tracer = Tracer(N_tracer)
+        self.decoder = CounterDecoder() #keeps the last counter value between packets
         self.curve = p1.plot(pen='y')
-        self.curve.setData(self.t, self.y)
         p1.setLabel('left', text='Number of photons per {} ms'.format(
                         int(4e-3*BUF)))
         p1.setLabel('bottom', text='Time', units='s')
@@ -264,16 +274,13 @@ class Gui(QWidget):
         else :
             self.paused = False
 
-    def nbPhoton(self, data, old_data):
-        return (data[0] - old_data) + sum(data[1:]-data[:-1])
-
     def acquisition(self):
         """
         This function handles the acquisition mode.
         It first stops the timer so that no data is lost to it.
         Then it retrieves the data from the data_q as fast as possible
-        until it has retrieved Ncyc packets (of size BUF).
-        Then it saves it in an .npy file and finally it restarts the 
+        until it has retrieved Ncyc packets (of size BUF), writing each
+        one to the .npy file as it arrives. Finally it restarts the 
         timer.
         """
         Ncyc = int(eval(self.qle.text()))
@@ -281,16 +288,15 @@ class Gui(QWidget):
         self.stat_lbl.setText("Status : acquiring")
         self.stat_lbl.adjustSize()
         self.timer.stop()
-        Nstore = BUF*Ncyc
-        store = np.zeros(Nstore,dtype=np.ubyte)
-        for i in range(Ncyc):
-            store[i*BUF:(i+1)*BUF] = data_q.get()
-            self.pbar.setValue(int(i/Ncyc*100))
-            QApplication.processEvents()
+        name = "data-{}.npy".format(str(datetime.now()).split(".")[0])
+        with TraceWriter(name, BUF*Ncyc) as writer :
+            for i in range(Ncyc):
+                writer.write(data_q.get()[2])
+                self.pbar.setValue(int(i/Ncyc*100))
+                QApplication.processEvents()
         self.pbar.setValue(100)
         self.stat_lbl.setText("Status : acquisition complete\n data saved")
         self.stat_lbl.adjustSize()
-        np.save("data-{}".format(str(datetime.now()).split(".")[0]), store)
         self.timer.start(T_timer, self)
         
     def fixScale(self):
@@ -308,29 +314,28 @@ class Gui(QWidget):
     def timerEvent(self, e):
         """
         Handles the tracer continuous display.
-        It shifts the time and y arrays and it retrieves the new data.
-        It also updates the LCD dispaly.
+        When a new packet is there, it appends the new point to the
+        tracer at the time the packet was acquired. Only the points of
+        the visible time span are given to the plot.
+        It also updates the LCD dispaly. The view scrolls with the 
+        current time.
         This function is called every T_timer milliseconds.
         """
-        self.t[0:-1] = self.t[1:]
-        self.t[-1] = time() - self.tInit
-        old_data = self.data[-1]
-        self.y[0:-1] = self.y[1:]
+        now = time() - self.tInit
         if not data_q.empty(): #retrieves the new number of photons
-            self.data = data_q.get()
-            self.y[-1] = self.nbPhoton(self.data, old_data)
-            self.lcd.display(int(self.y[-1]/(4e-6*BUF)))
-        else : #makes a constant approximation to ensure fluidity
-            self.y[-1] = self.y[-2]
-        #print(self.y[-1])
+            stamp, dropped, data = data_q.get()
+            if dropped : #the previous value is not the one before this packet
+                self.decoder.resync()
+            count = self.decoder.count(data)
+            self.tracer.append(np.array([stamp - self.tInit]),
+                               np.array([count]))
+            self.lcd.display(int(count/(4e-6*BUF)))
         if not self.paused :
-            self.curve.setData(self.t, self.y)
-            self.viewBox.setXRange(self.t[-1]-self.timeSpan, self.t[-1])
+            t, y = self.tracer.window(now-self.timeSpan)
+            self.curve.setData(t, y)
+            self.viewBox.setXRange(now-self.timeSpan, now)
             if not self.fixedScale:
-                i = 0
-                while self.t[i] < self.t[-1]-self.timeSpan:
-                    i += 1 
-                self.viewBox.setYRange(0, max(1,max(self.y[max(0,i-15):])))
+                self.viewBox.setYRange(0, max(1, self.tracer.max()))
         
     def closeEvent(self, event):
         """
@@ -348,10 +353,8 @@ class Gui(QWidget):
                 # connects to the server to send the shutdown signal
                 sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 sock.connect((HOST, PORT))
-                sock.sendall('KTHXBYE!'.encode('ascii'))
-                msg = ""
-                while "EOT" not in msg:
-                    msg += sock.recv(512).decode(encoding='ascii')
+                sock.sendall(packCommand(KTHXBYE))
+                recvPacketSize(sock, HELLO.size)
                 print('Shuting the server down')
                 sock.close()
             print("closing success")
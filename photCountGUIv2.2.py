@@ -12,16 +12,19 @@ from PyQt5.QtWidgets import (QWidget, QHBoxLayout, QFrame,
     QSplitter, QStyleFactory, QApplication, QLineEdit, QPushButton,
     QVBoxLayout, QLabel, QProgressBar, QStatusBar, QMessageBox, 
     QLCDNumber, QSlider)
-from PyQt5.QtCore import Qt, QBasicTimer
+from PyQt5.QtCore import Qt, QBasicTimer, QThread, pyqtSignal
 import sys
 import pyqtgraph as pg
 import numpy as np
 from time import time, sleep
 import serpy as sp
 from datetime import datetime
-import queue
 import threading
 import configparser
+from tracewriter import TraceWriter
+from tracer import PointRing, Tracer, MinMaxPyramid
+from protocol import (packCommand, STREAM, PACKET, GIVERATE, KTHXBYE, DATA,
+    RATE, RATE_DTYPE, unpackHello, unpackFrame)
 
 
 # --- parsing parameters from the parameters file ----------------------
@@ -30,19 +33,100 @@ config.read('parameters.ini')
 
 HOST = config["Network"].get('IP address', 'localhost')
 PORT = int(config["Network"].get('port', '8888'))
-SERBUF = 8192 # this buffer size will be the same for sttream reads and socket transfer
-BUF = 8*SERBUF
-#BUF = int(config["Network"].get('packet size', '16000'))
+# packet size asked for, the server grants the nearest size it serves
+BUF = int(config["Network"].get('packet size', '65536'))
 
 RES = int(config["Display"].get('number of points', '500'))
 SPAN = float(config["Display"].get('time span', '10'))
 N_tracer = RES
 T_timer = SPAN/RES*1000
+PERIOD = 4e-6 # seconds per sample, until the hello of the server gives it
+RATEBIN = max(1, int(T_timer*1e-3/PERIOD)) # samples per point of the tracer
 print(T_timer)
 sleep(1)
 
 # --- functions --------------------------------------------------------
 
+class Receiver(QThread):
+    """
+    Receives all the frames of the server, so that the GUI thread never
+    waits for the network. The points of the tracer are pushed into a
+    PointRing that the GUI reads at its own pace, and the packets of an
+    acquisition are written to disk as they arrive.
+    """
+    progress = pyqtSignal(int) # percentage of the acquisition received
+    acquired = pyqtSignal(str) # path of the finished acquisition
+
+    def __init__(self, conn, rates, timeOffset):
+        """
+        input : conn (serpy connection) after the hello, rates
+                (PointRing) for the tracer, timeOffset (float) from the
+                server acquisition times to the tracer times
+        """
+        super().__init__()
+        self.conn = conn
+        self.rates = rates
+        self.timeOffset = timeOffset
+        self.rateReady = threading.Event() # set when GIVERATE was answered
+        self.writer = None # TraceWriter of the acquisition in progress
+        self.Ncyc = 0
+        self.received = 0
+        self.running = True
+
+    def startAcquisition(self, writer, Ncyc):
+        """
+        To be called before STREAM is sent.
+        input : writer (TraceWriter), Ncyc (int) number of packets
+        """
+        self.received = 0
+        self.Ncyc = Ncyc
+        self.writer = writer
+
+    def acquiring(self):
+        return self.writer is not None
+
+    def stop(self):
+        self.running = False
+        self.wait()
+        if self.writer is not None: # interrupted acquisition
+            self.writer.close()
+            self.writer = None
+
+    def run(self):
+        while self.running:
+            if not self.conn.isDataAvailable():
+                self.msleep(1)
+                continue
+            frame = unpackFrame(self.conn.getData())
+            payload = self.conn.getData()
+            if frame.kind == DATA :
+                self.onData(frame, payload)
+            elif frame.kind == RATE :
+                self.onRate(frame, payload)
+
+    def onRate(self, frame, payload):
+        counts = np.frombuffer(payload, dtype=RATE_DTYPE)
+        n = len(counts)
+        if n :
+            self.rates.push(frame.timestamp + self.timeOffset
+                            - np.arange(n-1, -1, -1)*RATEBIN*PERIOD, counts)
+        self.rateReady.set()
+
+    def onData(self, frame, payload):
+        writer = self.writer
+        if writer is None : # packet of a stream that was not asked for
+            return
+        if frame.dropped :
+            print("the server dropped", frame.dropped, "bytes")
+        writer.write(payload)
+        self.received += 1
+        self.progress.emit(int(self.received/self.Ncyc*100))
+        if self.received >= self.Ncyc :
+            self.writer = None
+            writer.close()
+            self.acquired.emit(writer.path)
+
+
 class Gui(QWidget):
     
     def __init__(self):
@@ -53,7 +137,7 @@ class Gui(QWidget):
         
     def initUI(self):
         """
-        Initialises all the widgets as well as the comThread.
+        Initialises all the widgets as well as the receiver thread.
         """
         self.tInit = time() #marks the starting time for the tracer
         hbox = QHBoxLayout(self)
@@ -140,22 +224,36 @@ class Gui(QWidget):
         vbox.addWidget(self.stat_lbl)
         topright.setLayout(vbox)
         
-        # starting the com thread
+        # starting the receiver thread
+        global BUF, PERIOD, RATEBIN
         self.conn = sp.Connection(auto_restart=True).connect(HOST, PORT)
-        self.conn.sendData(b'GIVEDATA') #asks the server to give to chunks of data in advance
-        self.conn.sendData(b'GIVEDATA')
+        self.conn.sendData(packCommand(PACKET, BUF))
+        hello = unpackHello(self.conn.getData()) #the server answers the first request with its hello
+        PERIOD = hello.period
+        RATEBIN = max(1, int(T_timer*1e-3/PERIOD))
+        self.conn.getData() #then the SETUP frame, with the packet size granted
+        BUF = unpackHello(self.conn.getData()).packet
+        print("packet size :", BUF)
+        self.conn.sendData(packCommand(GIVERATE, RATEBIN)) #the server computes the photon counts for the tracer
+        self.clockOffset = time() - hello.monotonic #converts the server acquisition times to time()
+        self.rates = PointRing(4*N_tracer)
+        self.ratePos = 0 # points of the ring already displayed
+        self.receiver = Receiver(self.conn, self.rates,
+                                 self.clockOffset - self.tInit)
+        self.receiver.progress.connect(self.pbar.setValue)
+        self.receiver.acquired.connect(self.acquisitionDone)
+        self.receiver.start()
         
         # setting the tracer
         self.timer = QBasicTimer()
-        self.t = np.linspace(0, 0, N_tracer)
-        self.y = np.zeros(N_tracer)
-        self.data = np.zeros(N_tracer)
+        self.tracer = Tracer(N_tracer)
+        self.history = MinMaxPyramid() #all the points, at several resolutions
         self.curve = p1.plot(pen='y')
-        self.curve.setData(self.t, self.y)
-        p1.setLabel('left', text='Number of photons per {} ms'.format(
-                        int(4e-3*BUF)))
+        p1.setLabel('left', text='Number of photons per {:g} ms'.format(
+                        RATEBIN*PERIOD*1e3))
         p1.setLabel('bottom', text='Time', units='s')
         self.viewBox = p1.getViewBox()
+        self.viewBox.sigXRangeChanged.connect(self.browse)
         
         self.setGeometry(0, 0, 1200, 600)
         splitter1.setSizes([1100-150, 150])
@@ -170,7 +268,7 @@ class Gui(QWidget):
         Provides a guess of the time which the acquisition would 
         take.
         """
-        self.lbl2.setText("Estimated Time : "+str(int(eval(text)*BUF*4e-6))+" s")
+        self.lbl2.setText("Estimated Time : "+str(int(eval(text)*BUF*PERIOD))+" s")
         self.lbl2.adjustSize()
         self.lbl3.setText("Weight of the acquisition : "+str(int(eval(text)*BUF/1000))+" kB")
         self.lbl3.adjustSize() 
@@ -181,35 +279,28 @@ class Gui(QWidget):
         else :
             self.paused = False
 
-    def nbPhoton(self, data, old_data):
-        return (data[0] - old_data) + sum(data[1:]-data[:-1])
-
     def acquisition(self):
         """
         This function handles the acquisition mode.
-        It first stops the timer so that no data is lost to it.
-        Then it retrieves the data from the data_q as fast as possible
-        until it has retrieved Ncyc packets (of size BUF).
-        Then it saves it in an .npy file and finally it restarts the 
-        timer.
+        It asks the server for Ncyc packets (of size BUF) and returns :
+        the receiver thread writes each one to the .npy file as it 
+        arrives, while the tracer keeps running.
         """
+        if self.receiver.acquiring():
+            return
         Ncyc = int(eval(self.qle.text()))
         print(Ncyc)
         self.stat_lbl.setText("Status : acquiring")
         self.stat_lbl.adjustSize()
-        self.timer.stop()
-        Nstore = BUF*Ncyc
-        store = np.zeros(Nstore,dtype=np.ubyte)
-        for i in range(Ncyc):
-            self.conn.sendData(b'GIVEDATA')
-            store[i*BUF:(i+1)*BUF] = np.frombuffer(self.conn.getData(),dtype=np.ubyte)
-            self.pbar.setValue(int(i/Ncyc*100))
-            QApplication.processEvents()
+        self.pbar.setValue(0)
+        name = "data-{}.npy".format(str(datetime.now()).split(".")[0])
+        self.receiver.startAcquisition(TraceWriter(name, BUF*Ncyc), Ncyc)
+        self.conn.sendData(packCommand(STREAM, Ncyc)) #the server pushes the packets without waiting for requests
+
+    def acquisitionDone(self, name):
         self.pbar.setValue(100)
         self.stat_lbl.setText("Status : acquisition complete\n data saved")
         self.stat_lbl.adjustSize()
-        np.save("data-{}".format(str(datetime.now()).split(".")[0]), store)
-        self.timer.start(T_timer, self)
         
     def fixScale(self):
         if self.fixedScale :
@@ -226,30 +317,55 @@ class Gui(QWidget):
     def timerEvent(self, e):
         """
         Handles the tracer continuous display.
-        It shifts the time and y arrays and it retrieves the new data.
-        It also updates the LCD dispaly.
+        The server sends the number of photons of each RATEBIN samples
+        acquired since the previous request, the receiver thread puts them
+        in the ring with the time they were acquired and they are 
+        appended here to the tracer. Only the points of the visible time
+        span are given to the plot, from the tracer or, for the spans
+        it does not hold anymore, from the history.
+        It also updates the LCD dispaly. The view scrolls with the 
+        current time.
         This function is called every T_timer milliseconds.
         """
-        self.t[0:-1] = self.t[1:]
-        self.t[-1] = time() - self.tInit
-        old_data = self.data[-1]
-        self.y[0:-1] = self.y[1:]
-        if self.conn.isDataAvailable(): #retrieves the new number of photons
-            self.data = np.frombuffer(self.conn.getData(),dtype=np.ubyte)
-            self.y[-1] = self.nbPhoton(self.data, old_data)
-            self.lcd.display(int(self.y[-1]/(4e-6*BUF)))
-            self.conn.sendData(b'GIVEDATA') #asks for more data
-        else : #makes a constant approximation to ensure fluidity
-            self.y[-1] = self.y[-2]
-        #print(self.y[-1])
+        now = time() - self.tInit
+        times, counts, self.ratePos = self.rates.read(self.ratePos) #the new numbers of photons
+        if len(counts) :
+            self.tracer.append(times, counts)
+            self.history.append(times, counts)
+            self.lcd.display(int(counts[-1]/(PERIOD*RATEBIN)))
+        if self.receiver.rateReady.is_set():
+            self.receiver.rateReady.clear()
+            self.conn.sendData(packCommand(GIVERATE, RATEBIN)) #asks for the next points
         if not self.paused :
-            self.curve.setData(self.t, self.y)
-            self.viewBox.setXRange(self.t[-1]-self.timeSpan, self.t[-1])
+            top = self.plotRange(now-self.timeSpan, now)
+            self.viewBox.setXRange(now-self.timeSpan, now)
             if not self.fixedScale:
-                i = 0
-                while self.t[i] < self.t[-1]-self.timeSpan:
-                    i += 1 
-                self.viewBox.setYRange(0, max(1,max(self.y[max(0,i-15):])))
+                self.viewBox.setYRange(0, max(1, top))
+
+    def plotRange(self, t0, t1):
+        """
+        Plots the points between t0 and t1 : the last ones from the 
+        tracer, the older ones from the history at the resolution of the
+        plot, so the number of points drawn does not depend on the span.
+        Returns the maximum plotted.
+        """
+        t, y = self.tracer.points()
+        if self.tracer.head <= self.tracer.size or (len(t) and t[0] <= t0):
+            t, y = self.tracer.window(t0)
+            top = self.tracer.max()
+        else :
+            t, y = self.history.view(t0, t1, max(1, int(self.viewBox.width())))
+            top = y.max() if len(y) else 0
+        self.curve.setData(t, y)
+        return top
+
+    def browse(self, viewBox, xRange):
+        """
+        When paused, the history can be zoomed and panned with the mouse :
+        the points of the new range are plotted.
+        """
+        if self.paused :
+            self.plotRange(*xRange)
         
     def closeEvent(self, event):
         """
@@ -260,10 +376,11 @@ class Gui(QWidget):
             "Do you want to shutdown the server ?", QMessageBox.Yes | 
             QMessageBox.No, QMessageBox.No)
         self.timer.stop()
+        self.receiver.stop()
         try :
             if reply == QMessageBox.Yes:
                 # connects to the server to send the shutdown signal
-                self.conn.sendData('KTHXBYE!'.encode('ascii'))
+                self.conn.sendData(packCommand(KTHXBYE))
                 self.conn.disableRestart()
                 sleep(0.2)
             self.conn.close()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+"""
+Messages exchanged between wserialserv and its clients.
+
+A request is a command of INMSGLEN ascii characters, possibly followed
+by arguments. An argument is a number written on ARGLEN ascii digits.
+The server closes a connection that sends anything else.
+
+    GIVEDATA            asks for one packet
+    STREAM  <n>         grants the server n more packets that it pushes
+                        as soon as they are acquired, n = 0 withdraws
+                        the credit left
+    PACKET  <bytes>     asks for packets of about bytes bytes instead of
+                        the packet size of the hello
+    LATENCY <ms>        the server sends the part of a packet already
+                        acquired once its first byte is ms milliseconds
+                        old, instead of waiting for the whole packet,
+                        0 (the default) for whole packets only
+    GIVERATE <binsize>  asks for the photon counts of the samples
+                        acquired since the previous GIVERATE, summed
+                        over bins of binsize samples
+    RECORD  <amount><unit><len><name>
+                        the server records the next amount BYTES (or
+                        SECONDS) of the stream to its disk as name, a
+                        file name of len ascii characters (at most
+                        MAXNAME), no reply
+    GIVEFILE<len><name> asks for the finished recording name
+    STATS               asks for the metrics of the server
+    KTHXBYE!            shuts the server down
+
+On connection the server sends a HELLO, then every reply is a frame :
+a FRAME header followed by its payload. The header carries the sequence
+number of the frame for this client, the position of the payload in the
+stream, the monotonic time at which its last byte was acquired, its
+length and the number of bytes dropped for this client since the
+previous frame. The payload of a DATA frame is the raw counter stream,
+which is shorter than a packet when it was sent to meet the latency
+of the client, the rest of the packet then comes in the next frame,
+the one of a RATE frame the photon count of each bin (RATE_DTYPE), its
+offset is the position of the first sample of the first bin and its
+time the one of the last sample of the last bin. A recording is sent as
+FILE frames of at most FILECHUNK bytes (offset : their position in the
+file) followed by an empty FILE frame, only the empty frame if the
+recording does not exist or is not finished. STATS is answered by a
+METRICS frame, the metrics as a JSON object. PACKET is answered by a
+SETUP frame whose payload is a HELLO with the packet size granted : the
+largest size up to the one asked for, within the limits of the hello,
+that divides the store of the server. From the offset of the SETUP
+frame on, the packets of the client end at multiples of that size (so
+the first one may be shorter). The stream times are those of the server
+monotonic clock, the hello gives it together with the server wall clock
+so that the clients can convert them and follow the drift.
+"""
+
+import struct
+from collections import namedtuple
+
+VERSION = 2
+MAGIC = b'WSRV'
+
+# magic, version, frame header size, packet size, smallest and largest
+# packet size, sample period (s), server monotonic time (s), server wall
+# time (s)
+HELLO = struct.Struct('!4sHHIIIddd')
+Hello = namedtuple('Hello', ['magic', 'version', 'header', 'packet',
+                             'minpacket', 'maxpacket', 'period',
+                             'monotonic', 'wall'])
+
+# kind, sequence number, stream position, acquisition time (s),
+# length, dropped bytes
+FRAME = struct.Struct('!B3xIQdII')
+Frame = namedtuple('Frame', ['kind', 'seq', 'offset', 'timestamp',
+                             'length', 'dropped'])
+DATA = 0
+RATE = 1
+FILE = 2
+METRICS = 3
+SETUP = 4
+FILECHUNK = 16*2**20
+RATE_DTYPE = '>u4'
+
+INMSGLEN = 8
+ARGLEN = 8
+
+BYTES = 0 # units of the RECORD amount
+SECONDS = 1
+
+GIVEDATA = 'GIVEDATA'
+STREAM = 'STREAM  '
+PACKET = 'PACKET  '
+LATENCY = 'LATENCY '
+GIVERATE = 'GIVERATE'
+RECORD = 'RECORD  '
+GIVEFILE = 'GIVEFILE'
+STATS = 'STATS   '
+KTHXBYE = 'KTHXBYE!'
+
+# number of arguments of the commands that have some
+NARGS = {STREAM: 1, PACKET: 1, LATENCY: 1, GIVERATE: 1, RECORD: 3,
+         GIVEFILE: 1}
+# argument giving the length of the name that follows them
+NAMED = {RECORD: 2, GIVEFILE: 0}
+MAXNAME = 255 # characters of a file name
+
+
+def packCommand(cmd, *args):
+    """
+    input : cmd (string) one of the commands, args (int) its arguments
+    output : the request (bytes) ready to be sent
+    """
+    assert len(cmd) == INMSGLEN, "commands are INMSGLEN characters long"
+    msg = cmd + ''.join('{:0{}d}'.format(a, ARGLEN) for a in args)
+    return msg.encode('ascii')
+
+
+def unpackArgs(msg, n):
+    """
+    input : msg (string) the arguments following a command, n (int)
+    output : a list of the n arguments (int)
+        Raises ValueError if an argument is not ARGLEN ascii digits.
+    """
+    args = [msg[i*ARGLEN:(i+1)*ARGLEN] for i in range(n)]
+    for arg in args:
+        if len(arg) != ARGLEN or not (arg.isascii() and arg.isdigit()):
+            raise ValueError("invalid argument {!r}".format(arg))
+    return [int(arg) for arg in args]
+
+
+def checkName(length):
+    """
+    input : length (int) of the name announced by a request
+    output : length
+        Raises ValueError if it is longer than MAXNAME.
+    """
+    if length > MAXNAME:
+        raise ValueError("name of {} characters".format(length))
+    return length
+
+
+def unpackRequest(msg):
+    """
+    input : msg (bytes-like) the bytes received from a client
+    output : (cmd, args, name, size) the first request of msg : its
+    command (string), arguments (list of int), name (string, '' if it
+    has none) and size in bytes, None if it is not complete yet
+        Raises ValueError if it is not a valid request.
+    """
+    if len(msg) < INMSGLEN:
+        return None
+    cmd = bytes(msg[:INMSGLEN]).decode('ascii')
+    size = INMSGLEN + NARGS.get(cmd, 0)*ARGLEN
+    if len(msg) < size:
+        return None
+    args = unpackArgs(bytes(msg[INMSGLEN:size]).decode('ascii'),
+                      NARGS.get(cmd, 0))
+    length = checkName(args[NAMED[cmd]]) if cmd in NAMED else 0
+    if len(msg) < size + length:
+        return None
+    name = bytes(msg[size:size + length]).decode('ascii')
+    return cmd, args, name, size + length
+
+
+def packName(cmd, *args, name):
+    """
+    input : cmd (string) RECORD or GIVEFILE, args (int) its arguments
+            before the name, name (string) ascii file name
+    output : the request (bytes) ready to be sent
+    """
+    return packCommand(cmd, *args, len(name)) + name.encode('ascii')
+
+
+def packHello(packet, minpacket, maxpacket, period, monotonic, wall):
+    return HELLO.pack(MAGIC, VERSION, FRAME.size, packet, minpacket,
+                      maxpacket, period, monotonic, wall)
+
+
+def unpackHello(msg):
+    """
+    input : msg (bytes) the HELLO.size first bytes sent by the server
+    output : a Hello
+    """
+    hello = Hello(*HELLO.unpack(msg))
+    if hello.magic != MAGIC:
+        raise ValueError("not a wserialserv hello")
+    if hello.version != VERSION:
+        raise ValueError("protocol version {} is not supported".format(
+            hello.version))
+    return hello
+
+
+def packFrame(kind, seq, offset, timestamp, length, dropped):
+    return FRAME.pack(kind, seq % 2**32, offset, timestamp, length,
+                      min(dropped, 2**32 - 1))
+
+
+def unpackFrame(msg):
+    """
+    input : msg (bytes) a FRAME.size long header
+    output : a Frame
+    """
+    return Frame(*FRAME.unpack(msg))
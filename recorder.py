@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""
+Recording of the raw stream to disk at the instrument (RECORD).
+
+Each recording is written by its own thread straight from the ring
+buffer into a .npy file of RECORD_DIR, by blocks of at least
+RECORD_BLOCK bytes. It does not depend on any client : it goes as fast
+as the serial link. The finished files can then be downloaded with
+GIVEFILE.
+"""
+
+import os
+import re
+import threading
+
+try:
+    from tracewriter import TraceWriter
+except ImportError: # numpy is only needed for RECORD
+    TraceWriter = None
+
+RECORD_DIR = 'recordings'
+RECORD_BLOCK = 256*1024 # bytes written at once (at least)
+RECORD_TIMEOUT = 0.5 # seconds after which the bytes acquired are written anyway
+
+recordings = {} # name -> Recorder, the recordings of this run
+lock = threading.Lock()
+
+
+def recordPath(name):
+    """
+    input : name (string) of a recording
+    output : its path, or None if the name is not a plain file name
+    """
+    if not re.fullmatch(r'[\w\-.]+', name) or name.startswith('.'):
+        return None
+    if not name.endswith('.npy'):
+        name += '.npy'
+    return os.path.join(RECORD_DIR, name)
+
+
+class Recorder(threading.Thread):
+    """
+    Writes the length next bytes of the ring to path.
+    """
+
+    def __init__(self, ring, path, length):
+        super().__init__(daemon=True)
+        self.ring = ring
+        self.path = path
+        self.length = length
+        self.pos = ring.head # the recording starts now
+        self.lost = 0 # bytes overwritten before they were written
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        ring = self.ring
+        with TraceWriter(self.path, self.length) as writer :
+            while not writer.done() and not self.stopped.is_set():
+                left = self.length - writer.pos
+                ring.wait(self.pos + min(RECORD_BLOCK, left), RECORD_TIMEOUT)
+                oldest = ring.oldest()
+                if self.pos < oldest:
+                    self.lost += oldest - self.pos
+                    self.pos = oldest
+                n = min(ring.head - self.pos, left)
+                for chunk in ring.chunks(self.pos, n):
+                    writer.write(chunk)
+                if self.pos < ring.oldest(): # overwritten while it was written
+                    self.lost += ring.oldest() - self.pos
+                self.pos += n
+        print("recording", self.path, "done :", writer.pos, "bytes,",
+              self.lost, "lost")
+
+
+def record(ring, name, length):
+    """
+    input : ring (RingBuffer), name (string) of the recording, length
+            (int) number of bytes to record
+    output : the Recorder started or None if it cannot be
+    """
+    path = recordPath(name)
+    if TraceWriter is None:
+        print("RECORD needs numpy")
+        return None
+    if path is None or length <= 0:
+        print("invalid recording :", name, length)
+        return None
+    with lock:
+        if path in recordings and recordings[path].is_alive():
+            print("already recording", path)
+            return None
+        os.makedirs(RECORD_DIR, exist_ok=True)
+        recorder = Recorder(ring, path, length)
+        recordings[path] = recorder
+        recorder.start()
+    print("recording", length, "bytes to", path)
+    return recorder
+
+
+def openRecording(name):
+    """
+    input : name (string) of a recording
+    output : the file of the recording opened for reading, None if it
+    does not exist or is not finished
+    """
+    path = recordPath(name)
+    if path is None:
+        return None
+    with lock:
+        if path in recordings and recordings[path].is_alive():
+            return None
+    try:
+        return open(path, 'rb')
+    except OSError:
+        return None
+
+
+def stopRecordings():
+    """
+    Stops the recordings and waits for their files to be finalised.
+    """
+    with lock:
+        running = list(recordings.values())
+    for recorder in running:
+        recorder.stop()
+    for recorder in running:
+        recorder.join()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+"""
+Circular store shared by the instrument reader and the socket side of
+wserialserv.
+
+The store is a single preallocated bytearray. The reader thread fills it
+in place (serial.Serial.readinto) and the socket thread sends packets
+straight out of it through memoryview slices, so no bytes object is
+built per read or per packet.
+The implementation only works when the total store, the serial buffer
+and the network buffer are integer multiples of each other : a packet
+then never straddles the end of the store.
+
+There is a single writer and no lock is ever held across a read or a
+send. The writer only publishes its head position, it never waits for
+the consumers and never looks at them. Each consumer (RingReader) keeps
+its own position, so every consumer sees every packet and a packet is
+sent out of the same memory to all of them. A consumer checks afterwards
+that what it has just sent was not overwritten in the meantime.
+A consumer which lags too far behind the writer is either skipped ahead
+to the latest packet or dropped (SlowReaderError), the serial port is
+never stalled.
+"""
+
+import threading
+from array import array
+from time import monotonic
+
+SLOW_POLICIES = ('skip', 'disconnect')
+
+
+class SlowReaderError(Exception):
+    """
+    Raised by a RingReader with the 'disconnect' policy when it lags
+    too far behind the writer.
+    """
+
+
+class RingBuffer:
+
+    def __init__(self, size, block, marks=None):
+        """
+        input : size (int) total size of the store in bytes,
+                block (int) maximum size of a reader write in bytes,
+                marks (int) number of commits whose time is kept, by
+                default 4 per block of the store
+        """
+        assert size % block == 0, "size must be a multiple of block"
+        self.size = size
+        self.block = block
+        self.store = bytearray(size)
+        self.view = memoryview(self.store)
+        self.head = 0 # total number of bytes written since the start
+        self.cond = threading.Condition()
+        self.callbacks = []
+        # end position and monotonic time of the last commits
+        nmarks = marks or 4*(size//block)
+        self.markpos = array('q', [0])*nmarks
+        self.marktime = array('d', [0.])*nmarks
+        self.commits = 0
+
+    def writable(self):
+        """
+        output : a memoryview on the next part of the store to fill
+            At most block bytes long, it never crosses the end of the
+        store.
+        """
+        start = self.head % self.size
+        return self.view[start:min(start + self.block, self.size)]
+
+    def commit(self, n):
+        """
+        input : n (int) number of bytes written in the last writable()
+            Publishes the n bytes to the consumers.
+        """
+        i = self.commits % len(self.markpos)
+        self.markpos[i] = self.head + n
+        self.marktime[i] = monotonic()
+        self.commits += 1
+        self.head += n # only the writer assigns head
+        with self.cond:
+            self.cond.notify_all()
+        for callback in self.callbacks:
+            callback()
+
+    def subscribe(self, callback):
+        """
+        input : callback (callable without argument)
+            The callback is called from the writer thread after each
+        commit, it must return quickly (an event loop wake up).
+        """
+        self.callbacks = self.callbacks + [callback]
+
+    def unsubscribe(self, callback):
+        self.callbacks = [c for c in self.callbacks if c is not callback]
+
+    def oldest(self):
+        """
+        output : the oldest position (int) whose byte is still intact
+            The block that the writer may be filling right now is
+        already counted as overwritten.
+        """
+        return max(0, self.head + self.block - self.size)
+
+    def wait(self, pos, timeout=None):
+        """
+        input : pos (int) position, timeout (float or None)
+        output : True if the bytes before pos have been written
+        """
+        if self.head >= pos:
+            return True
+        with self.cond:
+            return self.cond.wait_for(lambda: self.head >= pos, timeout)
+
+    def timeAt(self, pos):
+        """
+        input : pos (int) position, at most head
+        output : the monotonic time (float) at which the byte before pos
+        was committed
+            For bytes older than the commits still recorded, the oldest
+        recorded time is returned.
+        """
+        nmarks = len(self.markpos)
+        lo = max(0, self.commits - nmarks + 1)
+        hi = self.commits - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.markpos[mid % nmarks] < pos:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.marktime[lo % nmarks]
+
+    def chunks(self, pos, n):
+        """
+        input : pos (int) position, n (int) size in bytes
+        output : a list of one or two memoryviews holding the n bytes
+        starting at pos, two when they cross the end of the store
+        """
+        start = pos % self.size
+        if start + n <= self.size:
+            return [self.view[start:start + n]]
+        return [self.view[start:], self.view[:start + n - self.size]]
+
+    def chunk(self, pos, n):
+        """
+        input : pos (int) position, n (int) size in bytes
+        output : a memoryview of the n bytes starting at pos
+        """
+        start = pos % self.size
+        assert start + n <= self.size, "chunk crosses the end of the store"
+        return self.view[start:start + n]
+
+
+def fitPacket(size, packet, minimum, maximum):
+    """
+    input : size (int) of the store in bytes, packet (int) packet size
+            asked for, minimum and maximum (int) limits of the size
+    output : the largest packet size (int) up to packet, within the
+    limits, that divides size (minimum if there is none)
+    """
+    packet = max(minimum, min(packet, maximum))
+    for n in range(-(-size//packet), size//minimum + 1):
+        if size % n == 0:
+            return size//n
+    return minimum
+
+
+class RingReader:
+    """
+    Cursor of a consumer in a RingBuffer, it hands out packets of a
+    fixed size. It can also hand out the part of the current packet
+    already written (partial packet) : the packet is then completed by
+    the next one handed out, so a packet never crosses the end of the
+    store.
+    """
+
+    def __init__(self, ring, packet, latest=False, policy='skip',
+                 maxlag=None):
+        """
+        input : ring (RingBuffer), packet (int) packet size in bytes,
+                latest (bool) start from the packet being written
+                instead of the start of the stream,
+                policy (str) what to do with a slow reader : 'skip' it
+                ahead to the latest packet or 'disconnect' it,
+                maxlag (int) backlog in bytes above which the reader is
+                slow, at most (and by default) what the store can hold
+        """
+        assert ring.size % packet == 0, "size must be a multiple of packet"
+        assert policy in SLOW_POLICIES, "unknown slow reader policy"
+        self.ring = ring
+        self.packet = packet
+        self.policy = policy
+        limit = ring.size - ring.block
+        self.maxlag = limit if maxlag is None else min(maxlag, limit)
+        self.pos = ring.head - ring.head % packet if latest else 0
+        self.lost = 0 # total number of bytes given up
+        self.handed = 0 # length of the packet handed out
+
+    def backlog(self):
+        return self.ring.head - self.pos
+
+    def resize(self, packet):
+        """
+        input : packet (int) new packet size in bytes
+            The current packet then ends at the next multiple of it.
+        """
+        assert self.ring.size % packet == 0, "size must be a multiple of packet"
+        self.packet = packet
+
+    def resume(self, lag=0):
+        """
+        input : lag (int) backlog in bytes the consumer may keep
+            Moves the cursor to the latest packet if it is more than lag
+        bytes behind, without counting the bytes passed over as lost :
+        the consumer did not ask for them.
+        """
+        head = self.ring.head
+        if head - self.pos > lag:
+            self.pos = max(self.pos, head - head % self.packet)
+
+    def end(self):
+        """
+        output : the position (int) of the end of the current packet
+        """
+        return self.pos - self.pos % self.packet + self.packet
+
+    def get(self, timeout=None):
+        """
+        input : timeout (float or None)
+        output : a memoryview of the next packet or None on timeout
+            If the reader lags too far behind the writer the policy is
+        applied first. The view points inside the store, once it is sent
+        release() must be called.
+        """
+        packet = self.poll()
+        while packet is None:
+            if not self.ring.wait(self.end(), timeout):
+                return None
+            packet = self.poll()
+        return packet
+
+    def poll(self, partial=False):
+        """
+        input : partial (bool) hand out what is written of the packet
+        output : a memoryview of the next packet or None
+            Same as get() but it returns at once if the packet is not
+        complete yet, or if nothing of it is written when partial.
+        """
+        ring = self.ring
+        head = ring.head
+        if head - self.pos > self.maxlag or self.pos < ring.oldest():
+            self.slow()
+            latest = head - head % self.packet
+            self.lost += latest - self.pos
+            self.pos = latest
+        end = self.end()
+        if head < end:
+            if not partial or head == self.pos:
+                return None
+            end = head
+        self.handed = end - self.pos
+        return ring.chunk(self.pos, self.handed)
+
+    def release(self):
+        """
+        output : False if the packet given by get() was overwritten
+        while it was used (its content is then not reliable).
+            Moves the cursor to the next packet.
+        """
+        intact = self.pos >= self.ring.oldest()
+        self.pos += self.handed
+        if not intact:
+            self.lost += self.handed
+            self.slow()
+        return intact
+
+    def slow(self):
+        if self.policy == 'disconnect':
+            raise SlowReaderError("reader lags {} bytes behind".format(
+                self.ring.head - self.pos))
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+"""
+State of one client connection of wserialserv, shared by its network
+engines. The engines only do the input/output : they feed the requests
+of the client to its Session and send the frames that it hands out.
+"""
+
+import json
+import os
+import threading
+from time import monotonic
+from protocol import (DATA, RATE, FILE, METRICS, SETUP, FILECHUNK,
+    RATE_DTYPE, packFrame)
+from ringbuffer import fitPacket
+import metrics
+
+live = set() # the sessions not closed yet
+liveLock = threading.Lock()
+
+try:
+    from counters import binCounts
+except ImportError: # numpy is only needed for GIVERATE
+    binCounts = None
+
+
+class Session:
+
+    def __init__(self, reader, client=''):
+        """
+        input : reader (RingReader) the cursor of the client in the ring,
+                client (string) its name in the metrics
+        """
+        self.reader = reader
+        self.client = client
+        self.frameTime = 0. # acquisition time of the frame handed out
+        self.frameLength = 0 # and its length
+        metrics.CLIENTS.inc()
+        self.credit = 0 # number of packets the client is waiting for
+        self.latency = None # seconds after which a partial packet is sent
+        self.started = False # True once the client was granted credit
+        self.seq = 0 # sequence number of the next frame
+        self.reported = 0 # lost bytes already reported in a frame
+        self.ratepos = None # position of the next sample for GIVERATE
+        with liveLock:
+            live.add(self)
+
+    def grant(self, n):
+        """
+        input : n (int) number of packets granted, 0 withdraws the
+        credit left
+            The first stream starts at the latest packet. A client that
+        runs out of credit and asks again (GIVEDATA, STREAM 1) goes on
+        where it stopped, unless it has been idle for longer than its
+        lag limit : it then resumes at the latest packet, the offset of
+        its next frame tells where.
+        """
+        n = max(0, n)
+        if n and not self.credit:
+            reader = self.reader
+            reader.resume(reader.maxlag if self.started else 0)
+            self.started = True
+        self.credit = self.credit + n if n else 0
+
+    def resize(self, packet, minimum, maximum):
+        """
+        input : packet (int) packet size asked for by the client,
+                minimum and maximum (int) limits of the server
+        output : the packet size (int) granted
+        """
+        reader = self.reader
+        reader.resize(fitPacket(reader.ring.size, packet, minimum, maximum))
+        return reader.packet
+
+    def setupFrame(self, hello):
+        """
+        input : hello (bytes) the HELLO with the packet size granted
+        output : (header, payload) of the SETUP frame answering PACKET
+        """
+        header = packFrame(SETUP, self.seq, self.reader.pos, monotonic(),
+                           len(hello), 0)
+        self.seq += 1
+        return header, hello
+
+    def setLatency(self, ms):
+        """
+        input : ms (int) latency target in milliseconds, 0 for none
+        """
+        self.latency = ms/1000 if ms else None
+
+    def deadline(self):
+        """
+        output : the monotonic time (float) at which the part of the
+        next packet already acquired is due, None if there is none
+        """
+        reader = self.reader
+        if self.latency is None or not self.credit:
+            return None
+        if reader.ring.head <= reader.pos:
+            return None
+        return reader.ring.timeAt(reader.pos + 1) + self.latency
+
+    def nextFrame(self):
+        """
+        output : (header, payload) of the next frame or None
+            None when the client has no credit or the next packet is
+        not acquired yet. A partial packet is handed out once its
+        deadline has passed. Once the frame is sent, sent() must be
+        called.
+        """
+        if not self.credit:
+            return None
+        reader = self.reader
+        packet = reader.poll()
+        if packet is None:
+            deadline = self.deadline()
+            if deadline is None or monotonic() < deadline:
+                return None
+            packet = reader.poll(partial=True)
+            if packet is None:
+                return None
+        end = reader.pos + len(packet)
+        self.frameTime = reader.ring.timeAt(end)
+        self.frameLength = len(packet)
+        header = packFrame(DATA, self.seq, reader.pos, self.frameTime,
+                           len(packet), reader.lost - self.reported)
+        self.seq += 1 # the frames built while it is sent come after it
+        return header, packet
+
+    def rateFrame(self, binsize):
+        """
+        input : binsize (int) number of samples per bin
+        output : (header, payload) of the RATE frame answering GIVERATE
+            The bins cover the samples acquired since the previous
+        GIVERATE (since now for the first one), the samples of an 
+        incomplete last bin are kept for the next one.
+        """
+        binsize = max(1, binsize)
+        ring = self.reader.ring
+        head = ring.head
+        if binCounts is None:
+            print("GIVERATE needs numpy")
+            header = packFrame(RATE, self.seq, head, ring.timeAt(head), 0, 0)
+            self.seq += 1
+            return header, b''
+        if self.ratepos is None:
+            self.ratepos = head
+        dropped = 0
+        oldest = ring.oldest()
+        if oldest:
+            oldest += 1 # the value before the first sample is needed too
+        if self.ratepos < oldest:
+            dropped = oldest - self.ratepos
+            self.ratepos = oldest
+        pos = self.ratepos
+        n = max(0, head - pos)
+        n -= n % binsize
+        # the first sample of the stream has no value before it : it is
+        # its own base and counts no photon
+        last = ring.store[(pos - 1) % ring.size if pos else 0]
+        bins = binCounts(ring.chunks(pos, n), last, binsize)
+        if pos and pos - 1 < ring.oldest(): # overwritten while it was read
+            bins = bins[:0]
+            dropped += n
+        self.ratepos = pos + n
+        header = packFrame(RATE, self.seq, pos, ring.timeAt(pos + n),
+                           4*len(bins), dropped)
+        self.seq += 1
+        return header, bins.astype(RATE_DTYPE).tobytes()
+
+    def fileFrames(self, f):
+        """
+        input : f (file opened in binary mode or None) a recording
+        output : yields (header, offset, count) for each FILE frame
+            The engine sends the header then the count bytes of f
+        starting at offset. The last frame is empty, it is the only one
+        when f is None.
+        """
+        size = os.fstat(f.fileno()).st_size if f is not None else 0
+        offset = 0
+        while offset < size:
+            count = min(FILECHUNK, size - offset)
+            yield (packFrame(FILE, self.seq, offset, monotonic(), count, 0),
+                   offset, count)
+            self.seq += 1
+            offset += count
+        yield packFrame(FILE, self.seq, size, monotonic(), 0, 0), size, 0
+        self.seq += 1
+
+    def statsFrame(self):
+        """
+        output : (header, payload) of the METRICS frame answering STATS
+        """
+        payload = json.dumps(metrics.snapshot()).encode('utf-8')
+        head = self.reader.ring.head
+        header = packFrame(METRICS, self.seq, head, monotonic(), len(payload), 0)
+        self.seq += 1
+        return header, payload
+
+    def sent(self, duration=None):
+        """
+        input : duration (float) seconds taken to send the frame
+        output : False if the payload was overwritten while it was sent
+            Its bytes are then reported as dropped in the next frame.
+        """
+        reader = self.reader
+        client = self.client
+        now = monotonic()
+        metrics.SENT_BYTES.inc(self.frameLength, client=client)
+        metrics.SENT_FRAMES.inc(client=client)
+        if reader.lost != self.reported:
+            metrics.DROPPED_BYTES.inc(reader.lost - self.reported,
+                                      client=client)
+            metrics.logLimited(('lost', client), client, "losing data :",
+                               reader.lost, "bytes in all")
+        if duration is not None:
+            metrics.SEND_TIME.observe(duration, client=client)
+        metrics.PACKET_AGE.observe(now - self.frameTime)
+        self.reported = reader.lost
+        # STREAM 0 may have withdrawn the credit while the frame was sent
+        self.credit = max(0, self.credit - 1)
+        return reader.release()
+
+    def close(self):
+        """
+        Removes the client from the metrics, once it is disconnected.
+        """
+        with liveLock: # no backlog is set for it once it is removed
+            live.discard(self)
+            metrics.CLIENTS.inc(-1)
+            for metric in (metrics.SENT_BYTES, metrics.SENT_FRAMES,
+                           metrics.DROPPED_BYTES, metrics.BACKLOG,
+                           metrics.SEND_TIME):
+                metric.remove(client=self.client)
+
+
+@metrics.collector
+def updateBacklogs():
+    """
+    The backlog of a client grows while it takes nothing : it is
+    measured when the metrics are read. A client without credit is not
+    owed anything until it asks again (see Session.grant).
+    """
+    with liveLock:
+        for session in live:
+            reader = session.reader
+            metrics.BACKLOG.set(reader.backlog() if session.credit else 0,
+                                client=session.client)
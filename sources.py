@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sources of the counter stream read by the servers.
+
+A source is opened with open(), then readinto(buf) fills buf with the
+next bytes of the stream, waiting at most its timeout, and returns the
+number of bytes read, in_waiting is the number of bytes that can be read
+without waiting and close() releases it. The simulated sources also
+count the bytes they lost because they were not read in time (lost).
+The --source option of the servers chooses one :
+
+    serial[:device]   the instrument on a serial port (default DEVICE)
+    sim[:rate]        a simulated instrument generating rate counter
+                      values per second in the server itself
+    pty[:rate]        the simulated instrument behind a pseudo-terminal,
+                      read through pyserial like the real one
+
+The simulated instrument is a free-running 8-bit counter of Poisson
+photons, paced by the clock. Like a serial link it holds at most
+SIM_BACKLOG bytes not read yet : the older ones are lost, the counter
+then jumps by the photons they counted.
+
+ReadSizer chooses the size of each read : about READ_PERIOD seconds of
+stream at the rate measured, so that the bytes do not wait long in the
+buffer of the link, and everything that is waiting when the reader is
+late, up to the block of the ring.
+"""
+
+import os
+import threading
+from time import monotonic, sleep
+
+try:
+    import numpy as np
+except ImportError: # numpy is only needed for the simulated instrument
+    np = None
+
+DEVICE = '/dev/ttyUSB0'
+BPS = 3000000
+TIMEOUT = 3 # seconds a read waits at most
+SAMPLE_RATE = 250000 # counter values per second, one every 4 us
+PHOTON_RATE = 20000. # photons per second of the simulated instrument
+SIM_BACKLOG = 4096 # bytes held by the simulated link (FTDI buffer)
+READ_PERIOD = 0.005 # seconds of stream per read when the reader keeps up
+MIN_READ = 256 # bytes
+RATE_SMOOTHING = 0.1 # weight of the last read in the rate measured
+
+
+class SerialSource:
+    """
+    The instrument on a serial port.
+    """
+
+    def __init__(self, dev=DEVICE, bps=BPS, timeout=TIMEOUT):
+        self.dev = dev
+        self.bps = bps
+        self.timeout = timeout
+        self.ser = None
+
+    def __str__(self):
+        return "serial port {} at {} bps".format(self.dev, self.bps)
+
+    def open(self):
+        import serial
+        self.ser = serial.Serial(port=self.dev, baudrate=self.bps,
+                                 timeout=self.timeout)
+        self.ser.read(self.ser.in_waiting) # clears what was sent before
+
+    @property
+    def in_waiting(self):
+        return self.ser.in_waiting
+
+    def readinto(self, buf):
+        return self.ser.readinto(buf)
+
+    def close(self):
+        if self.ser is not None:
+            self.ser.close()
+
+
+class SimulatedSource:
+    """
+    Simulated instrument in the server : the counter values are
+    generated when they are read, at the time they would have arrived.
+    """
+
+    def __init__(self, rate=SAMPLE_RATE, photons=PHOTON_RATE,
+                 timeout=TIMEOUT, backlog=SIM_BACKLOG, seed=None):
+        """
+        input : rate (float) counter values per second, photons (float)
+                photons per second, timeout (float) seconds a read waits
+                at most, backlog (int) bytes held before they are lost,
+                seed of the random generator
+        """
+        if np is None:
+            raise RuntimeError("the simulated instrument needs numpy")
+        self.rate = rate
+        self.photons = photons
+        self.timeout = timeout
+        self.backlog = backlog
+        self.seed = seed
+        self.lost = 0 # bytes lost because they were not read in time
+
+    def __str__(self):
+        return "simulated instrument at {:g} values/s, {:g} photons/s".format(
+            self.rate, self.photons)
+
+    def open(self):
+        self.rng = np.random.default_rng(self.seed)
+        self.counter = 0
+        self.sent = 0 # bytes generated since open (read or lost)
+        self.t0 = monotonic()
+
+    def due(self):
+        return int((monotonic() - self.t0)*self.rate) - self.sent
+
+    def overflow(self):
+        """
+        Loses the bytes that arrived beyond the backlog of the link.
+        """
+        skipped = self.due() - self.backlog
+        if skipped > 0:
+            self.counter = (self.counter + self.rng.poisson(
+                self.photons/self.rate*skipped)) % 256
+            self.sent += skipped
+            self.lost += skipped
+
+    @property
+    def in_waiting(self):
+        self.overflow()
+        return self.due()
+
+    def generate(self, n):
+        """
+        output : the n next counter values (from 0 to 255)
+        """
+        counts = self.rng.poisson(self.photons/self.rate, n)
+        values = (self.counter + np.cumsum(counts)) % 256
+        if n:
+            self.counter = int(values[-1])
+        self.sent += n
+        return values.astype(np.uint8)
+
+    def readinto(self, buf):
+        n = len(buf)
+        self.overflow()
+        wait = self.t0 + (self.sent + n)/self.rate - monotonic()
+        if wait > 0:
+            sleep(min(wait, self.timeout))
+        n = min(n, self.due()) # the bytes arriving during the read are read
+        if n > 0:
+            buf[:n] = self.generate(n)
+        return max(n, 0)
+
+    def close(self):
+        pass
+
+
+class PtyInstrument:
+    """
+    Simulated instrument writing to the master end of a pseudo-terminal,
+    the server reads the slave end (port) as a serial port.
+    """
+
+    def __init__(self, block=4096, **kwargs):
+        """
+        input : block (int) bytes written at once, kwargs given to the
+                SimulatedSource
+        """
+        import tty
+        self.source = SimulatedSource(**kwargs)
+        self.block = block
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave) # no echo nor translation of the bytes
+        self.port = os.ttyname(self.slave)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.source.open()
+        self.thread.start()
+
+    def run(self):
+        buf = bytearray(self.block)
+        while not self.stopped.is_set():
+            n = self.source.readinto(memoryview(buf))
+            try:
+                os.write(self.master, buf[:n]) # blocks while the pty is full
+            except OSError:
+                break
+
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class PtySource(SerialSource):
+    """
+    The simulated instrument read through a pseudo-terminal.
+    """
+
+    def __init__(self, rate=SAMPLE_RATE, timeout=TIMEOUT, **kwargs):
+        self.instrument = PtyInstrument(rate=rate, **kwargs)
+        super().__init__(self.instrument.port, timeout=timeout)
+
+    def __str__(self):
+        return "{} on {}".format(self.instrument.source, self.dev)
+
+    @property
+    def lost(self):
+        return self.instrument.source.lost
+
+    def open(self):
+        self.instrument.start()
+        super().open()
+
+    def close(self):
+        super().close()
+        self.instrument.stop()
+
+
+class ReadSizer:
+    """
+    Size of the reads of a source.
+    """
+
+    def __init__(self, cap, period=READ_PERIOD, minimum=MIN_READ):
+        """
+        input : cap (int) largest read in bytes, period (float) seconds
+                of stream per read, minimum (int) smallest read in bytes
+        """
+        self.cap = cap
+        self.period = period
+        self.minimum = min(minimum, cap)
+        self.rate = 0. # bytes per second
+        self.last = None # time of the end of the previous read
+
+    def size(self, waiting):
+        """
+        input : waiting (int) bytes waiting in the link
+        output : number of bytes (int) to read next
+        """
+        target = max(int(self.rate*self.period), waiting, self.minimum)
+        return min(target, self.cap)
+
+    def update(self, n):
+        """
+        input : n (int) number of bytes the last read returned
+        """
+        now = monotonic()
+        if self.last is not None and now > self.last:
+            self.rate += RATE_SMOOTHING*(n/(now - self.last) - self.rate)
+        self.last = now
+
+
+def openSource(spec):
+    """
+    input : spec (string) serial[:device], sim[:rate] or pty[:rate]
+    output : the source, opened
+    """
+    kind, _, arg = spec.partition(':')
+    if kind == 'serial':
+        source = SerialSource(arg or DEVICE)
+    elif kind == 'sim':
+        source = SimulatedSource(float(arg or SAMPLE_RATE))
+    elif kind == 'pty':
+        source = PtySource(float(arg or SAMPLE_RATE))
+    else:
+        raise ValueError("unknown source {}".format(spec))
+    source.open()
+    return source
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""
+The decoder of the counter stream against the simulated instrument,
+which knows the photons behind the values it generates.
+"""
+
+import numpy as np
+
+from counters import photonCounts, binCounts, timeTags, CounterDecoder
+from sources import SimulatedSource
+
+
+def simulated(n, photons, seed=0):
+    """
+    output : (values, counts) n counter values of the simulated
+    instrument and the photon counts that generated them
+    """
+    source = SimulatedSource(photons=photons, seed=seed)
+    source.open()
+    values = source.generate(n)
+    counts = np.random.default_rng(seed).poisson(source.photons/source.rate,
+                                                 n)
+    return values, counts
+
+
+def test_wrap():
+    values = np.array([254, 255, 0, 2, 2, 10], dtype=np.uint8)
+    assert photonCounts(values, last=253).tolist() == [1, 1, 1, 2, 0, 8]
+    assert photonCounts(values).tolist() == [1, 1, 2, 0, 8]
+
+
+def test_simulated():
+    # 8 photons per sample : the counter wraps every 32 samples or so
+    values, counts = simulated(10**6, photons=2e6)
+    assert values.min() == 0
+    decoded = photonCounts(values, last=0) # the counter starts at 0
+    assert np.array_equal(decoded, counts)
+
+
+def test_simulated_low_rate():
+    values, counts = simulated(10**6, photons=20000.)
+    assert np.array_equal(photonCounts(values, last=0), counts)
+
+
+def test_streaming():
+    values, counts = simulated(100000, photons=2e6, seed=1)
+    decoder = CounterDecoder(last=0)
+    decoded = [decoder.counts(values[i:i+4099]) # chunks cut anywhere
+               for i in range(0, len(values), 4099)]
+    assert np.array_equal(np.concatenate(decoded), counts)
+    assert decoder.total == counts.sum()
+
+
+def test_bins_and_tags():
+    values, counts = simulated(100000, photons=50000., seed=2)
+    bins = binCounts(values, 0, 1000)
+    assert np.array_equal(bins, counts.reshape(-1, 1000).sum(axis=1))
+    tags, multiplicity = timeTags(values, last=0)
+    assert np.array_equal(tags, np.flatnonzero(counts))
+    assert np.array_equal(multiplicity, counts[counts > 0])
+    decoder = CounterDecoder(last=0)
+    streamed = np.concatenate([decoder.bins(values[i:i+777], 1000)
+                               for i in range(0, len(values), 777)])
+    assert np.array_equal(streamed, bins)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the engines of multipletau against their plain versions : the
+FFT of correlate_numpy against np.correlate, and the lags of autocorrelate
+and correlate computed in one pass against the former engine, one np.sum
+per lag (perLagCorrelate of benchmark_multipletau.py), and the other
+ways to get the same correlations against autocorrelate and correlate :
+MultipleTauAccumulator fed the trace chunk by chunk, the out-of-core mode
+of autocorrelate reading an array, a memmap or a .npy file by blocks,
+correlate_matrix in one or several processes, and autocorrelate_timetags
+on the time tags of sparse and dense traces.
+"""
+
+import numpy as np
+import pytest
+
+from benchmark_multipletau import perLagCorrelate
+from multipletau import (autocorrelate, correlate, correlate_numpy,
+    correlate_matrix, autocorrelate_timetags, MultipleTauAccumulator)
+from multipletau.core import BLOCK, FFT_CROSSOVER
+
+LENGTHS = [1, 2, 7, 64, FFT_CROSSOVER - 1, FFT_CROSSOVER, 1000, 4097]
+BLOCKED = 1001 # length of the input correlated by blocks
+CHUNKSIZES = [7, 64, 1000, BLOCKED, 5000]
+TOLERANCE = 1e-12 # of the largest value of the correlation
+MULTIPLETAU_LENGTHS = [32, 33, 1000, BLOCK + 17, 70001]
+STREAM_CHUNKS = [1, 7, 1000, 100000] # samples fed at once to the accumulator
+
+
+def signals(n, kind, seed=0):
+    """
+    output : two random signals of length n, of positive average, complex
+        ones if kind is 'complex'
+    """
+    rng = np.random.default_rng(seed)
+    a, v = rng.random((2, n)) + 0.5
+    if kind == 'complex':
+        a = a + 1j*rng.random(n)
+        v = v - 1j*rng.random(n)
+    return a, v
+
+
+def assertClose(G, reference):
+    assert G.shape == reference.shape
+    np.testing.assert_array_equal(G[:, 0], reference[:, 0])
+    scale = np.abs(reference[:, 1]).max()
+    np.testing.assert_allclose(G[:, 1], reference[:, 1], rtol=0,
+                               atol=TOLERANCE*scale)
+
+
+@pytest.mark.parametrize('normalize', [False, True])
+@pytest.mark.parametrize('kind', ['real', 'complex'])
+@pytest.mark.parametrize('n', LENGTHS)
+def test_fft(n, kind, normalize):
+    a, v = signals(n, kind)
+    direct = correlate_numpy(a, v, deltat=2, normalize=normalize,
+                             dtype=a.dtype)
+    for method in ('fft', 'auto'):
+        assertClose(correlate_numpy(a, v, deltat=2, normalize=normalize,
+                                    dtype=a.dtype, method=method), direct)
+
+
+@pytest.mark.parametrize('normalize', [False, True])
+@pytest.mark.parametrize('kind', ['real', 'complex'])
+@pytest.mark.parametrize('chunksize', CHUNKSIZES)
+def test_fft_blocks(chunksize, kind, normalize):
+    a, v = signals(BLOCKED, kind)
+    direct = correlate_numpy(a, v, normalize=normalize, dtype=a.dtype)
+    for m in (2, 16):
+        G = correlate_numpy(a, v, normalize=normalize, dtype=a.dtype,
+                            method='fft', chunksize=chunksize, m=m)
+        lags = correlate(a, v, m=m)[:, 0].real
+        np.testing.assert_array_equal(G[:, 0], lags)
+        assertClose(G, direct[lags.astype(int)])
+
+
+def test_fft_memmap(tmp_path):
+    rng = np.random.default_rng(1)
+    trace = rng.integers(1, 255, 3000, dtype=np.uint8)
+    path = tmp_path / 'trace.npy'
+    np.save(path, trace)
+    mapped = np.load(path, mmap_mode='r')
+    direct = correlate_numpy(trace, trace, normalize=True, dtype=np.float64)
+    G = correlate_numpy(mapped, mapped, normalize=True, dtype=np.float64,
+                        method='fft', chunksize=256)
+    assertClose(G, direct[G[:, 0].astype(int)])
+
+
+@pytest.mark.parametrize('normalize', [False, True])
+@pytest.mark.parametrize('m', [2, 16, 32])
+@pytest.mark.parametrize('n', MULTIPLETAU_LENGTHS)
+def test_autocorrelate_lags(n, m, normalize):
+    if n < 2*m:
+        pytest.skip("len(a) must be larger than 2m")
+    a, _ = signals(n, 'real')
+    reference = perLagCorrelate(a, a, m=m, deltat=2, normalize=normalize)
+    assertClose(autocorrelate(a, m=m, deltat=2, normalize=normalize),
+                reference)
+
+
+@pytest.mark.parametrize('normalize', [False, True])
+@pytest.mark.parametrize('kind', ['real', 'complex'])
+@pytest.mark.parametrize('m', [2, 16])
+@pytest.mark.parametrize('n', MULTIPLETAU_LENGTHS)
+def test_correlate_lags(n, m, kind, normalize):
+    a, v = signals(n, kind)
+    reference = perLagCorrelate(a, v, m=m, deltat=2, normalize=normalize)
+    G = correlate(a, v, m=m, deltat=2, normalize=normalize)
+    assertClose(G, reference)
+    np.testing.assert_array_equal(a, signals(n, kind)[0]) # left untouched
+
+
+@pytest.mark.parametrize('normalize', [False, True])
+@pytest.mark.parametrize('chunk', STREAM_CHUNKS)
+@pytest.mark.parametrize('n', [32, 33, 1000, BLOCK + 17])
+def test_accumulator(n, chunk, normalize):
+    a, _ = signals(n, 'real')
+    accumulator = MultipleTauAccumulator(m=16, deltat=2, normalize=normalize)
+    for start in range(0, n, chunk):
+        accumulator.update(a[start:start+chunk])
+    assert accumulator.length == n
+    assertClose(accumulator.get(),
+                autocorrelate(a, m=16, deltat=2, normalize=normalize))
+
+
+@pytest.mark.parametrize('normalize', [False, True])
+@pytest.mark.parametrize('blocksize', [7, 1000, BLOCK + 17, None])
+def test_out_of_core(blocksize, normalize, tmp_path):
+    rng = np.random.default_rng(2)
+    trace = rng.integers(0, 256, 10001, dtype=np.uint8)
+    path = tmp_path / 'trace.npy'
+    np.save(path, trace)
+    reference = autocorrelate(trace, m=16, deltat=2, normalize=normalize,
+                              dtype=np.float64)
+    for a in (trace, np.load(path, mmap_mode='r'), str(path)):
+        if blocksize is None and a is trace:
+            continue # an array is only read by blocks with a blocksize
+        assertClose(autocorrelate(a, m=16, deltat=2, normalize=normalize,
+                                  dtype=np.float64, blocksize=blocksize),
+                    reference)
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+@pytest.mark.parametrize('normalize', [False, True])
+@pytest.mark.parametrize('kind', ['real', 'complex'])
+def test_matrix(kind, normalize, processes):
+    traces = np.array(signals(1000, kind) + signals(1000, kind, seed=1)[:1])
+    G = correlate_matrix(traces, m=16, deltat=2, normalize=normalize,
+                         processes=processes)
+    assert G.shape[:2] == (3, 3)
+    for i, a in enumerate(traces):
+        for j, v in enumerate(traces):
+            assertClose(G[i, j], correlate(a, v, m=16, deltat=2,
+                                           normalize=normalize))
+
+
+@pytest.mark.parametrize('normalize', [False, True])
+@pytest.mark.parametrize('weighted', [False, True])
+@pytest.mark.parametrize('photons', [0.002, 0.05, 2.]) # per bin
+@pytest.mark.parametrize('n', [1000, 70001])
+def test_timetags(n, photons, weighted, normalize):
+    counts = np.random.default_rng(3).poisson(photons, n)
+    if not weighted:
+        counts = np.minimum(counts, 1)
+    tags = np.flatnonzero(counts)
+    weights = counts[tags] if weighted else None
+    G = autocorrelate_timetags(tags, n, weights, m=16, deltat=2,
+                               normalize=normalize)
+    assertClose(G, autocorrelate(counts, m=16, deltat=2, normalize=normalize,
+                                 dtype=np.float64))
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""
+Parsing of the requests of the clients, as the select engine does it on
+the bytes received so far.
+"""
+
+import pytest
+
+from protocol import (GIVEDATA, STREAM, RECORD, GIVEFILE, BYTES, MAXNAME,
+    packCommand, packName, unpackRequest)
+
+
+def test_pieces():
+    msg = (packCommand(STREAM, 10) + packName(GIVEFILE, name='run.trc')
+           + packCommand(GIVEDATA))
+    requests = []
+    received = bytearray()
+    for byte in msg: # one byte at a time
+        received.append(byte)
+        request = unpackRequest(received)
+        if request is not None:
+            requests.append(request[:3])
+            del received[:request[3]]
+    assert requests == [(STREAM, [10], ''), (GIVEFILE, [7], 'run.trc'),
+                        (GIVEDATA, [], '')]
+    assert not received
+
+
+def test_record():
+    msg = packName(RECORD, 1000, BYTES, name='a.trc') + b'GIVE'
+    assert unpackRequest(msg) == (RECORD, [1000, BYTES, 5], 'a.trc',
+                                  len(msg) - 4)
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        unpackRequest(b'STREAM  0000001x')
+    with pytest.raises(ValueError):
+        unpackRequest(b'GIVEDAT\xff')
+    with pytest.raises(ValueError): # before the name arrives
+        unpackRequest(packCommand(GIVEFILE, MAXNAME + 1))
+    assert unpackRequest(packCommand(GIVEFILE, MAXNAME)) is None
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""
+The state of a client connection, without sockets : a Session and its
+RingReader are driven over a RingBuffer filled by hand, as the serial
+thread and the engines would.
+"""
+
+import time
+
+import pytest
+
+from protocol import unpackFrame
+from ringbuffer import RingBuffer, RingReader, SlowReaderError, fitPacket
+from session import Session
+
+SIZE = 32*1024 # bytes of the store
+BLOCK = 256 # bytes per commit
+PACKET = 1024
+MAXLAG = 4*PACKET
+
+
+def fill(ring, n, value=1):
+    """
+    Commits n bytes of value, BLOCK bytes at a time.
+    """
+    while n > 0:
+        chunk = ring.writable()[:min(n, BLOCK)]
+        chunk[:] = bytes([value])*len(chunk)
+        ring.commit(len(chunk))
+        n -= len(chunk)
+
+
+@pytest.fixture
+def ring():
+    return RingBuffer(SIZE, BLOCK)
+
+
+@pytest.fixture
+def newSession(ring):
+    """
+    output : a function making a Session on ring, closed after the test
+    """
+    sessions = []
+    def make(**kwargs):
+        session = Session(RingReader(ring, PACKET, latest=True, **kwargs),
+                          'test')
+        sessions.append(session)
+        return session
+    yield make
+    for session in sessions:
+        session.close()
+
+
+def send(session):
+    """
+    output : the Frame and the length of the payload handed out by
+    session, which is then sent
+    """
+    header, payload = session.nextFrame()
+    length = len(payload)
+    session.sent()
+    return unpackFrame(header), length
+
+
+def test_grant_and_withdraw(ring, newSession):
+    session = newSession()
+    fill(ring, 3*PACKET)
+    assert session.nextFrame() is None # no credit yet
+    session.grant(2) # the first stream starts at the latest packet
+    assert session.reader.pos == 3*PACKET
+    fill(ring, 3*PACKET)
+    frame, length = send(session)
+    assert (frame.seq, frame.offset, length) == (0, 3*PACKET, PACKET)
+    frame, length = send(session)
+    assert (frame.seq, frame.offset, length) == (1, 4*PACKET, PACKET)
+    assert session.credit == 0
+    assert session.nextFrame() is None # the credit is spent
+    session.grant(1)
+    session.grant(2) # the credits add up
+    assert session.credit == 3
+    session.grant(0)
+    assert session.credit == 0
+    assert session.nextFrame() is None
+    session.grant(-1)
+    assert session.credit == 0
+
+
+def test_withdraw_while_sending(ring, newSession):
+    session = newSession()
+    session.grant(10)
+    fill(ring, 2*PACKET)
+    assert session.nextFrame() is not None
+    session.grant(0) # STREAM 0 while the frame is sent
+    session.sent()
+    assert session.credit == 0
+    assert session.nextFrame() is None
+
+
+def test_resume_after_idle(ring, newSession):
+    session = newSession(maxlag=MAXLAG)
+    session.grant(1)
+    fill(ring, PACKET)
+    send(session)
+    # idle for less than the lag limit : it goes on where it stopped
+    fill(ring, 2*PACKET)
+    session.grant(1)
+    frame, length = send(session)
+    assert frame.offset == PACKET
+    # idle for longer : it resumes at the latest packet, nothing is lost
+    fill(ring, MAXLAG + 2*PACKET)
+    session.grant(1)
+    assert session.reader.pos == ring.head
+    fill(ring, PACKET)
+    frame, length = send(session)
+    assert frame.offset == ring.head - PACKET
+    assert frame.dropped == 0
+    assert session.reader.lost == 0
+
+
+def test_slow_skip(ring, newSession):
+    session = newSession(maxlag=MAXLAG)
+    session.grant(10)
+    fill(ring, MAXLAG + 2*PACKET + 100)
+    assert session.nextFrame() is None # skipped to the packet being written
+    assert session.reader.pos == MAXLAG + 2*PACKET
+    assert session.reader.lost == MAXLAG + 2*PACKET
+    fill(ring, PACKET)
+    frame, length = send(session)
+    assert frame.offset == MAXLAG + 2*PACKET
+    assert frame.dropped == MAXLAG + 2*PACKET
+    fill(ring, PACKET)
+    frame, length = send(session)
+    assert frame.dropped == 0 # reported once
+
+
+def test_slow_disconnect(ring, newSession):
+    session = newSession(policy='disconnect', maxlag=MAXLAG)
+    session.grant(10)
+    fill(ring, MAXLAG + 2*PACKET)
+    with pytest.raises(SlowReaderError):
+        session.nextFrame()
+
+
+def test_partial_packet(ring, newSession):
+    session = newSession()
+    session.grant(10)
+    session.setLatency(60000)
+    fill(ring, BLOCK + 44)
+    assert session.nextFrame() is None # not due yet
+    session.setLatency(50)
+    time.sleep(0.1)
+    frame, length = send(session)
+    assert (frame.offset, length) == (0, BLOCK + 44)
+    # the next frame completes the packet
+    fill(ring, PACKET)
+    frame, length = send(session)
+    assert (frame.offset, length) == (BLOCK + 44, PACKET - BLOCK - 44)
+    assert session.nextFrame() is None # the part left is not due yet
+    time.sleep(0.1)
+    frame, length = send(session)
+    assert (frame.offset, length) == (PACKET, BLOCK + 44)
+
+
+def test_resize(ring, newSession):
+    session = newSession()
+    session.grant(10)
+    fill(ring, PACKET + PACKET//2)
+    send(session)
+    assert session.resize(4*PACKET, BLOCK, 8*PACKET) == 4*PACKET
+    # the current packet ends at the next multiple of the new size
+    fill(ring, 4*PACKET - ring.head)
+    frame, length = send(session)
+    assert (frame.offset, length) == (PACKET, 3*PACKET)
+    fill(ring, 4*PACKET)
+    frame, length = send(session)
+    assert (frame.offset, length) == (4*PACKET, 4*PACKET)
+    # the size is cut down to one that divides the store
+    assert session.resize(3*PACKET, BLOCK, 8*PACKET) == 2*PACKET
+    assert session.resize(10, BLOCK, 8*PACKET) == BLOCK
+    assert session.resize(SIZE, BLOCK, 8*PACKET) == 8*PACKET
+
+
+def test_fitPacket():
+    assert fitPacket(SIZE, 3000, BLOCK, 8*PACKET) == 2048
+    assert fitPacket(30*PACKET, 4*PACKET, BLOCK, 8*PACKET) == 3840
+    assert fitPacket(30*PACKET, 7*PACKET, BLOCK, 8*PACKET) == 6*PACKET
+    assert fitPacket(SIZE, 1, BLOCK, 8*PACKET) == BLOCK
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+Stress test of the server : the simulated instrument runs at full rate
+while a client reads slowly. The instrument must lose nothing and the
+clients that keep up must get every byte, whatever the slow one does.
+The test lasts until the server skips the slow client ahead, which takes
+some seconds : the kernel buffers of its connection must fill first.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+from time import monotonic, sleep
+
+import pytest
+
+from benchmark import HOST, recvExactly, waitServer
+from protocol import (HELLO, FRAME, DATA, METRICS, STREAM, STATS, KTHXBYE,
+    packCommand, unpackHello, unpackFrame)
+from sources import SAMPLE_RATE
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RATE = SAMPLE_RATE # bytes per second, the rate of the instrument
+TIMEOUT = 60. # seconds the server has to skip the slow client
+SLOW_PERIOD = 1. # seconds the slow client sleeps after each packet
+MAXLAG = 4 # packets behind which a client is skipped ahead
+SLOW_RCVBUF = 4096 # bytes
+MAXCREDIT = 10**6
+# the link holds 16 ms of stream : with a single CPU for the server
+# threads and the clients, the thread of the instrument is not always
+# scheduled in time, whatever the engines do
+MIN_CPUS = 2
+
+
+def cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def freePort():
+    """
+    output : a free TCP port (int), so that the test does not need the
+    port of the server nor talk to another server left running
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def connect(port, rcvbuf=None):
+    """
+    input : port (int) of the server, rcvbuf (int) size of the receive
+            buffer, None for the default
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if rcvbuf is not None: # or the kernel buffers absorb the lag
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.connect((HOST, port))
+    unpackHello(recvExactly(sock, HELLO.size))
+    return sock
+
+
+def read(port, results, name, pause, stop):
+    """
+    Reads the stream of the server on port until stop (threading.Event)
+    is set or for TIMEOUT seconds, sleeping pause seconds after each
+    packet, and puts its name in the server, its frames and how long it
+    read in results.
+    """
+    sock = connect(port, SLOW_RCVBUF if pause else None)
+    sock.sendall(packCommand(STREAM, MAXCREDIT))
+    result = results[name] = {'client': "{}:{}".format(*sock.getsockname()),
+                              'frames': []}
+    start = monotonic()
+    while not stop.is_set() and monotonic() - start < TIMEOUT:
+        frame = unpackFrame(recvExactly(sock, FRAME.size))
+        recvExactly(sock, frame.length)
+        if frame.kind == DATA:
+            result['frames'].append(frame)
+        sleep(pause)
+    result['seconds'] = monotonic() - start
+    sock.close()
+
+
+def stats(port):
+    """
+    output : the metrics of the server on port, as sent for STATS
+    """
+    sock = connect(port)
+    sock.sendall(packCommand(STATS))
+    frame = unpackFrame(recvExactly(sock, FRAME.size))
+    assert frame.kind == METRICS
+    metrics = json.loads(recvExactly(sock, frame.length).decode('utf-8'))
+    sock.close()
+    return metrics
+
+
+@pytest.mark.parametrize('engine', ['select', 'asyncio'])
+def test_slow_client(engine, tmp_path):
+    log = open(tmp_path / 'server.log', 'w')
+    port = freePort()
+    server = subprocess.Popen([sys.executable, 'wserialserv_v2.py',
+                               '--port', str(port),
+                               '--engine', engine, '--slow-policy', 'skip',
+                               '--max-lag', str(MAXLAG),
+                               '--source', 'sim:{}'.format(RATE)],
+                              cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        waitServer(HOST, port)
+        results = {}
+        stop = threading.Event()
+        readers = [threading.Thread(target=read, args=(port, results, 'slow',
+                                                       SLOW_PERIOD, stop)),
+                   threading.Thread(target=read, args=(port, results, 'fast',
+                                                       0, stop))]
+        for reader in readers:
+            reader.start()
+        # the drops of the slow client are counted by the server long
+        # before it reads them, so they are asked while it is connected
+        dropped = 0
+        while not dropped and readers[0].is_alive():
+            sleep(0.5)
+            slow = results.get('slow', {}).get('client')
+            dropped = sum(value['value'] for value
+                          in stats(port)['wserialserv_dropped_bytes_total']
+                          if value['labels']['client'] == slow)
+        stop.set()
+        for reader in readers:
+            reader.join()
+        metrics = stats(port)
+        connect(port).sendall(packCommand(KTHXBYE))
+        server.wait(10)
+    finally:
+        if server.poll() is None:
+            server.kill()
+        log.close()
+
+    fast = results['fast']['frames']
+    assert sum(f.length for f in fast) >= RATE*results['fast']['seconds']/2
+    assert sum(f.dropped for f in fast) == 0
+    for previous, frame in zip(fast, fast[1:]): # every byte, in order
+        assert frame.offset == previous.offset + previous.length
+    # the slow client was skipped ahead, without holding up the others
+    assert dropped > 0
+    if cpus() < MIN_CPUS:
+        pytest.skip("the losses of the instrument are only checked with at "
+                    "least {} CPUs".format(MIN_CPUS))
+    lost = metrics['wserialserv_source_lost_bytes']
+    assert [value['value'] for value in lost] == [0]
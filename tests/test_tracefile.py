@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+Round trips of the three codecs of tracefile.py, with chunks and ranges
+that cross the edges of the blocks.
+"""
+
+import numpy as np
+import pytest
+
+from tracefile import CODECS, TraceFile, TraceFileWriter, fromNpy, toNpy
+
+BLOCK = 1000 # samples per block of the small files
+
+
+def counter(n, photons=0.08, seed=0):
+    """
+    output : n values of the counter (uint8, 0 to 255) for a mean number of
+        photons per sample
+    """
+    rng = np.random.default_rng(seed)
+    return np.cumsum(rng.poisson(photons, n)).astype(np.uint8)
+
+
+def write(path, data, codec, block=BLOCK, chunk=BLOCK//3 + 1):
+    with TraceFileWriter(path, codec, block) as writer:
+        for start in range(0, len(data), chunk):
+            writer.write(data[start:start+chunk])
+
+
+@pytest.mark.parametrize('n', [0, 1, BLOCK - 1, BLOCK, BLOCK + 1,
+                               3*BLOCK + 17])
+@pytest.mark.parametrize('codec', CODECS)
+def test_round_trip(codec, n, tmp_path):
+    data = counter(n)
+    path = tmp_path / 'trace.trc'
+    write(path, data, codec)
+    with TraceFile(path) as trace:
+        assert trace.codec == codec
+        assert len(trace) == n
+        np.testing.assert_array_equal(trace.read(), data)
+        for edge in range(0, n + 1, BLOCK): # ranges across each edge
+            for start, stop in ((edge - 1, edge + 1), (edge, edge + BLOCK),
+                                (edge - BLOCK//2, edge + BLOCK//2)):
+                np.testing.assert_array_equal(trace.read(start, stop),
+                                              data[max(0, start):stop])
+                np.testing.assert_array_equal(
+                    trace[max(0, start):stop], data[max(0, start):stop])
+
+
+@pytest.mark.parametrize('codec', CODECS)
+@pytest.mark.parametrize('data', [
+    np.full(2*BLOCK + 5, 7, dtype=np.uint8), # no photon at all
+    np.random.default_rng(1).integers(0, 256, 2*BLOCK + 5, dtype=np.uint8),
+    counter(2*BLOCK + 5, photons=3.),
+    ], ids=['constant', 'random', 'bright'])
+def test_round_trip_contents(codec, data, tmp_path):
+    path = tmp_path / 'trace.trc'
+    write(path, data, codec, chunk=BLOCK + 1)
+    with TraceFile(path) as trace:
+        np.testing.assert_array_equal(trace.read(), data)
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_long_gaps(codec, tmp_path):
+    # photons far apart, so that their distances take 3 byte varints
+    data = np.ones(2**16 + 10, dtype=np.uint8)
+    data[20000:] = 2
+    data[60000:] = 4
+    path = tmp_path / 'trace.trc'
+    write(path, data, codec, block=2**16, chunk=4096)
+    with TraceFile(path) as trace:
+        np.testing.assert_array_equal(trace.read(), data)
+        np.testing.assert_array_equal(trace.read(59999, 2**16 + 1),
+                                      data[59999:2**16 + 1])
+
+
+def test_read_time(tmp_path):
+    data = counter(5*BLOCK)
+    path = tmp_path / 'trace.trc'
+    write(path, data, 'delta')
+    with TraceFile(path) as trace:
+        period = trace.period
+        np.testing.assert_array_equal(
+            trace.readTime(BLOCK*period, 2.5*BLOCK*period),
+            data[BLOCK:int(np.ceil(2.5*BLOCK))])
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_npy(codec, tmp_path):
+    data = counter(3*BLOCK + 17)
+    np.save(tmp_path / 'in.npy', data)
+    fromNpy(str(tmp_path / 'in.npy'), str(tmp_path / 'trace.trc'), codec,
+            BLOCK)
+    toNpy(str(tmp_path / 'trace.trc'), str(tmp_path / 'out.npy'))
+    np.testing.assert_array_equal(np.load(tmp_path / 'out.npy'), data)
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compressed container for the counter stream (.trc files).
+
+The stream is cut into blocks of a fixed number of samples that are
+compressed independently, so that reading a range only decompresses the
+blocks it overlaps. Layout :
+
+    HEADER      magic, version, codec, samples per block, number of
+                samples, sample period (s)
+    blocks      the compressed blocks one after the other
+    index       offset of each block in the file (uint64), followed by
+                the offset of the index itself
+    FOOTER      offset of the index, number of blocks, magic
+
+Codecs : zlib and lzma from the standard library, and delta, written with
+numpy for this stream : most samples do not count any photon, so only the
+non-zero photon counts of the block are kept, each with the distance to
+the previous one as a varint. The first value of a block is stored as is.
+
+Running this file converts a .npy acquisition to .trc and back :
+    python tracefile.py data.npy [codec]  ->  data.trc
+    python tracefile.py data.trc          ->  data.npy
+or benchmarks the codecs (compression ratio, write and read throughput,
+time of a short random read) on an acquisition or on a simulated one :
+    python tracefile.py --bench [data.npy]
+"""
+
+import lzma
+import os
+import struct
+import tempfile
+import zlib
+from time import perf_counter
+import numpy as np
+from tracewriter import TraceWriter
+
+MAGIC = b'PHTR'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIQd') # magic, version, codec, block, length, period
+FOOTER = struct.Struct('<QQ4s') # index offset, number of blocks, magic
+
+CODECS = ('zlib', 'lzma', 'delta')
+BLOCK = 2**16 # samples per block
+SAMPLE_PERIOD = 4e-6
+
+
+# --- delta codec -------------------------------------------------------
+
+def packVarints(values):
+    """
+    input : values (array of non-negative int)
+    output : the values as LEB128 varints (bytes)
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    if not len(values):
+        return b''
+    nbytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        nbytes += rest > 0
+        rest >>= np.uint64(7)
+    owner = np.repeat(np.arange(len(values)), nbytes)
+    starts = np.cumsum(nbytes) - nbytes
+    rank = np.arange(len(owner)) - starts[owner] # byte rank in its varint
+    out = (values[owner] >> (np.uint64(7)*rank.astype(np.uint64))) & np.uint64(0x7f)
+    out = out.astype(np.uint8)
+    out[rank < nbytes[owner] - 1] |= 0x80
+    return out.tobytes()
+
+
+def unpackVarints(data, count):
+    """
+    input : data (bytes-like) starting with count varints
+    output : (values (uint64 array), number of bytes read)
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    if not count:
+        return np.zeros(0, dtype=np.uint64), 0
+    ends = np.flatnonzero(data < 0x80)[:count]
+    used = int(ends[-1]) + 1
+    data = data[:used]
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    owner = np.repeat(np.arange(count), ends - starts + 1)
+    rank = (np.arange(used) - starts[owner]).astype(np.uint64)
+    parts = (data & 0x7f).astype(np.uint64) << (np.uint64(7)*rank)
+    return np.add.reduceat(parts, starts), used
+
+
+def packDelta(block):
+    counts = np.diff(block)
+    nonzero = np.flatnonzero(counts)
+    gaps = np.diff(nonzero, prepend=-1)
+    return (bytes(block[:1]) + packVarints([len(nonzero)]) + packVarints(gaps)
+            + counts[nonzero].tobytes())
+
+
+def unpackDelta(data, n):
+    data = memoryview(data)
+    (count,), used = unpackVarints(data[1:], 1)
+    count = int(count)
+    gaps, used2 = unpackVarints(data[1+used:], count)
+    start = 1 + used + used2
+    counts = np.zeros(n, dtype=np.uint8)
+    counts[0] = data[0]
+    counts[1 + np.cumsum(gaps) - 1] = np.frombuffer(data[start:start+count],
+                                                   dtype=np.uint8)
+    return np.cumsum(counts, dtype=np.uint8)
+
+
+def compress(block, codec):
+    if codec == 'zlib':
+        return zlib.compress(block.tobytes(), 6)
+    if codec == 'lzma':
+        return lzma.compress(block.tobytes(), preset=6)
+    return packDelta(block)
+
+
+def decompress(data, codec, n):
+    if codec == 'zlib':
+        return np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+    if codec == 'lzma':
+        return np.frombuffer(lzma.decompress(data), dtype=np.uint8)
+    return unpackDelta(data, n)
+
+
+# --- files -------------------------------------------------------------
+
+class TraceFileWriter:
+    """
+    Writes a .trc file from the stream, given in chunks of any size.
+    """
+
+    def __init__(self, path, codec='delta', block=BLOCK,
+                 period=SAMPLE_PERIOD):
+        """
+        input : path (string), codec (one of CODECS), block (int) samples
+                per block, period (float) sample period in seconds
+        """
+        if codec not in CODECS:
+            raise ValueError("unknown codec {}".format(codec))
+        self.codec = codec
+        self.block = block
+        self.period = period
+        self.f = open(path, 'wb')
+        self.f.write(HEADER.pack(MAGIC, VERSION, CODECS.index(codec), block,
+                                 0, period))
+        self.offsets = []
+        self.length = 0
+        self.pending = np.zeros(0, dtype=np.uint8) # incomplete block
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def writeBlock(self, block):
+        self.offsets.append(self.f.tell())
+        self.f.write(compress(block, self.codec))
+        self.length += len(block)
+
+    def write(self, data):
+        """
+        input : data (bytes-like or uint8 array) the next samples
+        """
+        if not isinstance(data, np.ndarray):
+            data = np.frombuffer(data, dtype=np.uint8)
+        if len(self.pending):
+            data = np.concatenate((self.pending, data))
+        full = len(data) - len(data) % self.block
+        for start in range(0, full, self.block):
+            self.writeBlock(data[start:start+self.block])
+        self.pending = data[full:].copy()
+
+    def close(self):
+        """
+        Writes the last block, the index and the number of samples.
+        """
+        if self.f is None:
+            return
+        if len(self.pending):
+            self.writeBlock(self.pending)
+        index = self.f.tell()
+        self.f.write(np.array(self.offsets + [index], dtype='<u8').tobytes())
+        self.f.write(FOOTER.pack(index, len(self.offsets), MAGIC))
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, VERSION, CODECS.index(self.codec),
+                                 self.block, self.length, self.period))
+        self.f.close()
+        self.f = None
+
+
+class TraceFile:
+    """
+    Reads a .trc file, only decompressing the blocks of the samples
+    asked for.
+    """
+
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        magic, version, codec, self.block, self.length, self.period = \
+            HEADER.unpack(self.f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("{} is not a trace file".format(path))
+        if version != VERSION:
+            raise ValueError("trace file version {} is not supported".format(
+                version))
+        self.codec = CODECS[codec]
+        self.f.seek(-FOOTER.size, 2)
+        index, nblocks, magic = FOOTER.unpack(self.f.read(FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError("{} is not finished".format(path))
+        self.f.seek(index)
+        self.offsets = np.frombuffer(self.f.read(8*(nblocks + 1)), dtype='<u8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.length
+
+    def close(self):
+        self.f.close()
+
+    def readBlock(self, i):
+        start = int(self.offsets[i])
+        self.f.seek(start)
+        data = self.f.read(int(self.offsets[i+1]) - start)
+        return decompress(data, self.codec,
+                          min(self.block, self.length - i*self.block))
+
+    def read(self, start=0, stop=None):
+        """
+        input : start, stop (int) sample positions
+        output : the samples start to stop (uint8 array)
+        """
+        stop = self.length if stop is None else min(stop, self.length)
+        start = max(0, start)
+        if stop <= start:
+            return np.zeros(0, dtype=np.uint8)
+        first, last = start//self.block, (stop - 1)//self.block
+        data = np.concatenate([self.readBlock(i)
+                               for i in range(first, last + 1)])
+        return data[start - first*self.block:stop - first*self.block]
+
+    def readTime(self, t0, t1):
+        """
+        input : t0, t1 (float) times in seconds from the first sample
+        output : the samples acquired between t0 and t1
+        """
+        return self.read(int(t0/self.period), int(np.ceil(t1/self.period)))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice) and key.step in (None, 1):
+            start, stop, _ = key.indices(self.length)
+            return self.read(start, stop)
+        raise TypeError("only contiguous slices of samples can be read")
+
+
+def fromNpy(npy, path, codec='delta', block=BLOCK, period=SAMPLE_PERIOD):
+    """
+    input : npy (string) path of a .npy acquisition, path (string) of
+            the .trc file to write, codec, block, period
+        The .npy file is read by blocks (memory map).
+    """
+    data = np.load(npy, mmap_mode='r')
+    with TraceFileWriter(path, codec, block, period) as writer :
+        for start in range(0, len(data), 16*block):
+            writer.write(np.asarray(data[start:start+16*block],
+                                    dtype=np.uint8))
+
+
+def toNpy(path, npy):
+    """
+    input : path (string) of a .trc file, npy (string) path of the .npy
+            file to write
+    """
+    with TraceFile(path) as trace, TraceWriter(npy, len(trace)) as writer :
+        for i in range(len(trace.offsets) - 1):
+            writer.write(trace.readBlock(i))
+
+
+def benchmark(data, reads=100, span=0.01):
+    """
+    input : data (uint8 array) the samples, reads (int) number of random
+            reads, span (float) seconds of stream per random read
+    output : {codec: measures}
+        Writes data with each codec to a temporary file, then reads it
+    whole and at reads random positions.
+    """
+    rng = np.random.default_rng(0)
+    size = int(span/SAMPLE_PERIOD)
+    starts = rng.integers(0, max(1, len(data) - size), reads)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp :
+        for codec in CODECS:
+            path = os.path.join(tmp, codec + '.trc')
+            t = perf_counter()
+            with TraceFileWriter(path, codec) as writer :
+                for start in range(0, len(data), 16*BLOCK):
+                    writer.write(np.asarray(data[start:start+16*BLOCK],
+                                            dtype=np.uint8))
+            write = perf_counter() - t
+            with TraceFile(path) as trace :
+                t = perf_counter()
+                assert np.array_equal(trace.read(), data)
+                read = perf_counter() - t
+                t = perf_counter()
+                for start in starts:
+                    trace.read(int(start), int(start) + size)
+                random = (perf_counter() - t)/reads
+            results[codec] = {'ratio': len(data)/os.path.getsize(path),
+                              'write MB/s': len(data)/write/1e6,
+                              'read MB/s': len(data)/read/1e6,
+                              'random read ms': random*1e3}
+            print("{:6s} ratio {ratio:7.1f}   write {write MB/s:7.1f} MB/s   "
+                  "read {read MB/s:7.1f} MB/s   {:g} ms read in "
+                  "{random read ms:.2f} ms".format(codec, span*1e3,
+                                                    **results[codec]))
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+    name = sys.argv[1]
+    if name == '--bench':
+        if len(sys.argv) > 2:
+            data = np.load(sys.argv[2], mmap_mode='r')
+        else: # a minute of stream at 20000 photons/s
+            rng = np.random.default_rng(0)
+            counts = rng.poisson(20000*SAMPLE_PERIOD, int(60/SAMPLE_PERIOD))
+            data = np.cumsum(counts).astype(np.uint8)
+        print(len(data), "samples,", len(data)*SAMPLE_PERIOD, "s")
+        benchmark(data)
+    elif name.endswith('.trc'):
+        toNpy(name, name[:-4] + '.npy')
+    else:
+        fromNpy(name, name.rsplit('.', 1)[0] + '.trc',
+                *sys.argv[2:3])
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+"""
+Buffers of the points of the tracer, shared by the thread that receives
+them and the GUI that displays them.
+"""
+
+from collections import deque
+import numpy as np
+
+PYRAMID_SIZE = 4096 # buckets kept by each level of the history
+PYRAMID_FACTOR = 4 # buckets of a level grouped in one of the next level
+PYRAMID_LEVELS = 8 # the last one covers SIZE*FACTOR**7 points (15 days at 50/s)
+
+
+class PointRing:
+    """
+    Ring of (time, value) points written by one thread and read by
+    others without lock : the writer fills the arrays first and then
+    publishes the new head, a reader copies the points up to the head it
+    saw and drops those that were overwritten while it copied them.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.t = np.zeros(size)
+        self.y = np.zeros(size)
+        self.head = 0 # number of points ever pushed
+
+    def push(self, t, y):
+        """
+        input : t, y (arrays) times and values of the new points
+        (writer thread only)
+        """
+        t, y = t[-self.size:], y[-self.size:]
+        idx = (self.head + np.arange(len(t))) % self.size
+        self.t[idx] = t
+        self.y[idx] = y
+        self.head += len(t) # publishes the points
+
+    def read(self, pos):
+        """
+        input : pos (int) number of points already read
+        output : (t, y, new pos) the points pushed since pos that are
+        still in the ring (copies)
+        """
+        head = self.head
+        pos = max(pos, head - self.size)
+        idx = np.arange(pos, head) % self.size
+        t = self.t[idx]
+        y = self.y[idx]
+        lost = self.head - self.size - pos # overwritten during the copy
+        if lost > 0:
+            t, y = t[lost:], y[lost:]
+        return t, y, head
+
+
+class Tracer:
+    """
+    The last size points of the tracer, for display.
+
+    Each point is written twice, at i and i+size of arrays twice as
+    long, so that the points in the ring are always a contiguous view
+    whatever the position of the head : appending is O(1) per point and
+    the visible window is handed to pyqtgraph without copy. The window
+    is found with np.searchsorted (the times are increasing), and the
+    minimum and maximum of the window are kept by monotonic deques of
+    (point number, value).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.t = np.zeros(2*size)
+        self.y = np.zeros(2*size)
+        self.head = 0 # number of points ever appended
+        self.start = 0 # number of the first point of the window
+        self.maxq = deque() # decreasing values of the window
+        self.minq = deque() # increasing values of the window
+
+    def __len__(self):
+        return min(self.head, self.size)
+
+    def append(self, t, y):
+        """
+        input : t, y (arrays) times and values of the new points, t
+        increasing and after the times already appended
+        """
+        t, y = t[-self.size:], y[-self.size:]
+        head = self.head
+        for pos, v in enumerate(y.tolist(), head):
+            while self.maxq and self.maxq[-1][1] <= v:
+                self.maxq.pop()
+            self.maxq.append((pos, v))
+            while self.minq and self.minq[-1][1] >= v:
+                self.minq.pop()
+            self.minq.append((pos, v))
+        idx = (head + np.arange(len(t))) % self.size
+        self.t[idx] = t
+        self.t[idx + self.size] = t
+        self.y[idx] = y
+        self.y[idx + self.size] = y
+        self.head = head + len(t)
+        self.evict(max(self.start, self.head - self.size))
+
+    def evict(self, start):
+        self.start = start
+        while self.maxq and self.maxq[0][0] < start:
+            self.maxq.popleft()
+        while self.minq and self.minq[0][0] < start:
+            self.minq.popleft()
+
+    def points(self):
+        """
+        output : (t, y) views of all the points of the ring
+        """
+        n = len(self)
+        first = (self.head - n) % self.size
+        return self.t[first:first+n], self.y[first:first+n]
+
+    def window(self, t0):
+        """
+        input : t0 (float) time of the left of the view
+        output : (t, y) views of the points from t0 on, which become the
+        window of min() and max()
+        """
+        t, y = self.points()
+        i = int(np.searchsorted(t, t0))
+        start = self.head - len(t) + i
+        if start < self.start: # the window grew : the deques are rebuilt
+            self.rebuild(start, y[i:])
+        else:
+            self.evict(start)
+        return t[i:], y[i:]
+
+    def rebuild(self, start, y):
+        self.start = start
+        # a value stays in the deques if it is above (below) all the
+        # values after it
+        above = np.append(np.maximum.accumulate(y[::-1])[::-1][1:], -np.inf)
+        below = np.append(np.minimum.accumulate(y[::-1])[::-1][1:], np.inf)
+        self.maxq = self.monotonic(start, y, y > above)
+        self.minq = self.monotonic(start, y, y < below)
+
+    @staticmethod
+    def monotonic(start, y, keep):
+        return deque(zip((start + np.flatnonzero(keep)).tolist(),
+                         y[keep].tolist()))
+
+    def max(self, default=0.):
+        return self.maxq[0][1] if self.maxq else default
+
+    def min(self, default=0.):
+        return self.minq[0][1] if self.minq else default
+
+
+class Level:
+    """
+    Ring of the last size buckets of a level of the pyramid : time of
+    their first and last point, minimum and maximum. Written twice like
+    the Tracer so that it is always a contiguous view.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.data = np.zeros((4, 2*size)) # tfirst, tlast, ymin, ymax
+        self.head = 0 # number of buckets ever pushed
+
+    def __len__(self):
+        return min(self.head, self.size)
+
+    def push(self, buckets):
+        """
+        input : buckets (array of shape (4, n))
+        """
+        buckets = buckets[:, -self.size:]
+        idx = (self.head + np.arange(buckets.shape[1])) % self.size
+        self.data[:, idx] = buckets
+        self.data[:, idx + self.size] = buckets
+        self.head += buckets.shape[1]
+
+    def buckets(self):
+        n = len(self)
+        first = (self.head - n) % self.size
+        return self.data[:, first:first+n]
+
+    def complete(self):
+        """
+        output : True if the level still holds all the buckets pushed
+        """
+        return self.head <= self.size
+
+
+class MinMaxPyramid:
+    """
+    History of the tracer at several resolutions, in bounded memory.
+
+    The level 0 holds the last points, each bucket of the level k+1 the
+    minimum and maximum of factor buckets of the level k, so the coarse
+    levels go back further in time. The buckets are made as the points
+    arrive. A view is drawn from the finest level that covers it with
+    no more buckets than pixels, plus the newest buckets of the finer
+    levels that are not grouped yet.
+    """
+
+    def __init__(self, size=PYRAMID_SIZE, factor=PYRAMID_FACTOR,
+                 levels=PYRAMID_LEVELS):
+        self.factor = factor
+        self.levels = [Level(size) for k in range(levels)]
+        self.pending = [np.zeros((4, 0)) for k in range(levels - 1)]
+
+    def append(self, t, y):
+        """
+        input : t, y (arrays) times and values of the new points
+        """
+        buckets = np.array((t, t, y, y), dtype=float)
+        for k, level in enumerate(self.levels):
+            level.push(buckets)
+            if k == len(self.pending):
+                break
+            buckets = np.concatenate((self.pending[k], buckets), axis=1)
+            full = buckets.shape[1] - buckets.shape[1] % self.factor
+            self.pending[k] = buckets[:, full:]
+            if not full:
+                break
+            groups = buckets[:, :full].reshape(4, -1, self.factor)
+            buckets = np.array((groups[0, :, 0], groups[1, :, -1],
+                                groups[2].min(axis=1), groups[3].max(axis=1)))
+
+    def level(self, t0, t1, pixels):
+        """
+        output : the number of the level to draw [t0, t1] with
+        """
+        for k, level in enumerate(self.levels):
+            tfirst, tlast = level.buckets()[:2]
+            if not level.complete() and tfirst[0] > t0:
+                continue # older than the level
+            n = (np.searchsorted(tfirst, t1, 'right')
+                 - np.searchsorted(tlast, t0))
+            if n <= pixels:
+                return k
+        return len(self.levels) - 1
+
+    def view(self, t0, t1, pixels):
+        """
+        input : t0, t1 (float) times of the view, pixels (int) its width
+        output : (t, y) points to plot, two per bucket (its minimum and
+        maximum at its middle time) except for the points of the level 0
+        """
+        ts, ys = [], []
+        after = -np.inf # time of the last point already taken
+        for k in range(self.level(t0, t1, pixels), -1, -1):
+            tfirst, tlast, ymin, ymax = self.levels[k].buckets()
+            lo = max(np.searchsorted(tlast, t0),
+                     np.searchsorted(tfirst, after, 'right'))
+            hi = np.searchsorted(tfirst, t1, 'right')
+            if hi <= lo:
+                continue
+            if k == 0:
+                ts.append(tfirst[lo:hi])
+                ys.append(ymin[lo:hi])
+            else:
+                ts.append(np.repeat((tfirst[lo:hi] + tlast[lo:hi])/2, 2))
+                ys.append(np.stack((ymin[lo:hi], ymax[lo:hi]), 1).ravel())
+            after = tlast[hi-1]
+        if not ts:
+            return np.zeros(0), np.zeros(0)
+        return np.concatenate(ts), np.concatenate(ys)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+Writing of an acquisition to disk while it is acquired.
+
+The samples go straight into a .npy file preallocated to the length of
+the acquisition (np.lib.format.open_memmap), so the memory used does not
+depend on that length. The file is synced every SYNC_PERIOD seconds : if
+the acquisition is interrupted, what was synced is on disk, followed by
+zeros. close() finalises the file : when fewer samples than announced
+were written, its header is rewritten with the actual length and the
+end is cut off.
+"""
+
+import os
+from time import monotonic
+import numpy as np
+
+SYNC_PERIOD = 1. # seconds between two syncs of the file
+
+
+class TraceWriter:
+
+    def __init__(self, path, length, dtype=np.uint8, syncperiod=SYNC_PERIOD):
+        """
+        input : path (string) of the .npy file, length (int) number of
+                samples of the acquisition, dtype of the samples,
+                syncperiod (float) seconds between two syncs, None to
+                only sync on close
+        """
+        self.path = path
+        self.length = length
+        self.syncperiod = syncperiod
+        self.store = np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                               shape=(length,))
+        self.pos = 0 # number of samples written
+        self.lastsync = monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def done(self):
+        return self.pos >= self.length
+
+    def write(self, data):
+        """
+        input : data (bytes-like or array) the next samples
+        output : number of samples written, data is cut at the end
+        of the acquisition
+        """
+        if not isinstance(data, np.ndarray):
+            data = np.frombuffer(data, dtype=self.store.dtype)
+        n = min(len(data), self.length - self.pos)
+        self.store[self.pos:self.pos+n] = data[:n]
+        self.pos += n
+        if (self.syncperiod is not None
+                and monotonic() - self.lastsync >= self.syncperiod):
+            self.sync()
+        return n
+
+    def sync(self):
+        """
+        Writes the samples to disk.
+        """
+        self.store.flush()
+        with open(self.path, 'rb') as f :
+            os.fsync(f.fileno())
+        self.lastsync = monotonic()
+
+    def close(self):
+        """
+        Syncs the file and gives it the length actually written.
+        """
+        if self.store is None:
+            return
+        self.sync()
+        offset = self.store.offset
+        dtype = self.store.dtype
+        self.store = None # unmaps the file
+        if self.pos < self.length:
+            with open(self.path, 'r+b') as f :
+                np.lib.format.write_array_header_1_0(f, {
+                    'descr': np.lib.format.dtype_to_descr(dtype),
+                    'fortran_order': False,
+                    'shape': (self.pos,)})
+                if f.tell() != offset:
+                    raise RuntimeError("the header of {} cannot be "
+                                       "rewritten".format(self.path))
+                f.truncate(offset + self.pos*dtype.itemsize)
+                f.flush()
+                os.fsync(f.fileno())
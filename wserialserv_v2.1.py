@@ -6,113 +6,217 @@
 # the total store, the serial buffer and the network buffer are integer multiples
 # of each other
 
-import serial
 import select
 import serpy as sp
 import queue
 import threading
-from time import sleep
+import weakref
+import argparse
+from collections import deque
+from functools import partial
+from time import sleep, time, monotonic
+from ringbuffer import RingBuffer, RingReader, SlowReaderError
+from protocol import (INMSGLEN, ARGLEN, GIVEDATA, STREAM, PACKET, LATENCY,
+    GIVERATE, RECORD, GIVEFILE, STATS, KTHXBYE, BYTES, unpackArgs,
+    checkName, packHello)
+from session import Session
+from recorder import record, openRecording, stopRecordings
+from sources import openSource, ReadSizer, MIN_READ
+import metrics
+from metrics import logLimited, serveMetrics
 
 PORT = 18888
 STIMEOUT = 0.020 # timeout for select  (but also for sstream read!)
+SEND_TIMEOUT = 2. # seconds a client may keep its socket full before it is slow
 SERBUF = 8192 # this buffer size will be the same for sttream reads and socket transfer
-BUF = 8*SERBUF
-INMSGLEN = 8
-NSTORE = 4*BUF
+BUF = 8*SERBUF # packet size of a client until it asks for another one
+SAMPLE_PERIOD = 4e-6 # one counter value every 4 us
+NSTORE = 32*BUF
+SLOW_POLICY = 'skip' # 'skip' a client lagging behind or 'disconnect' it
+MAXLAG = NSTORE//2 # lag in bytes above which a client is too slow
+MINPACKET = 512 # packet sizes a client can ask for (PACKET)
+MAXPACKET = NSTORE//8 # at most MAXLAG//2
+SOURCE = 'serial' # the instrument, see sources.py
+METRICS_PORT = None # port of the Prometheus listener, None for none
 
 def serialReader():
     """
-    This thread handles the connection to the serial port as well as the
-    retrieval of data from it. It puts the data insiside de data queue
-    (data_q) and if this queue is full it void the first element of the
-    queue and then place the new element.
+    This thread handles the connection to the instrument (SOURCE, the
+    serial port or a simulation of it) as well as the retrieval of data
+    from it. It reads the data directly inside the ring buffer (ring),
+    what is waiting in the link up to SERBUF bytes at once (ReadSizer),
+    so a read may be shorter than SERBUF. It never waits for the socket 
+    side : if the latter is too slow it loses the oldest packets.
     """
-    # SET UP SERIAL READER
-    #dev = '/dev/ttyACM0'
-    dev = '/dev/ttyUSB0'
-    # bps=57600   # On arduino we use prescaler 16 for BPS 57600
-    # below is exact
-    
-    PRESCALER = 2
-    #bps = 2*(1000000/(PRESCALER+1)) #double speed 2* TODO do we need integers?
-    bps = 3000000
-    print('bps exact',bps)
-    # Nbuf = BUF # Nbuf = 4096 
-    # 2048 seems to work slightly better than 1024 
-    # 4096 seems to work better than 2048 (on my system)
-    # Tsleep = STIMEOUT # Tsleep = 0.040 # shorter sleep to be safe
-    # different successful combinations
-    # Nbuf=4096; Tsleep = 0.056 (guess that limit is at 0.060)
-    # Nbuf=2048; Tsleep = 0.028 (0.030 is near limit)
-    try:
-        ser.close()
-    except:
-        pass
     try :
-        ser = serial.Serial(port=dev, baudrate=bps, timeout=3) 
-        w=ser.inWaiting()
-        rbuf = ser.read(w)
-        print('serial port open and cleared')
-    except :
-        print("Serial connection is not ready !")
+        ser = openSource(SOURCE)
+        print(ser, 'open and cleared')
+    except Exception as e :
+        print("Serial connection is not ready :", e)
         exit_q.put(None)
         exit()
+    sizer = ReadSizer(SERBUF)
     while exit_q.empty():
-        #w=ser.inWaiting()
-        #print('waiting:',w)
-        lock.acquire()
+        start = ring.head % NSTORE
+        t = monotonic()
         try:
-            rbuf = ser.read(SERBUF)
+            waiting = ser.in_waiting
+            Nread = ser.readinto(ring.writable()[:sizer.size(waiting)])
         except:
             print("Serial Connection Error")
             exit_q.put(None) #closes the server
-            pack_q.put(b'\x00'*SERBUF)
-            lock.release()
-            print("Lock realeased")
             #ser.close()
             break
-        else: 
-            lock.release()
-        if 0 in rbuf : print("0 detected")
-        Nread = len(rbuf)
-        if Nread!=SERBUF:
-            print("Serial Connection Error")
-            exit_q.put(None) #closes the server
-            ser.close()
-            #server_socket.close()
-            #raise RuntimeError('Serial read was not OK')
-        #rbuf = b'\x09'*SERBUF
-        if data_q.full() : 
-            data_q.get()
-            print("losing data")
-        data_q.put(rbuf)
-    print('close serial port')
+        metrics.SERIAL_READ.observe(monotonic() - t)
+        metrics.SERIAL_WAITING.set(waiting)
+        if hasattr(ser, 'lost') : # simulated instrument
+            metrics.SOURCE_LOST.set(ser.lost)
+        metrics.SERIAL_BYTES.inc(Nread)
+        sizer.update(Nread)
+        if not Nread : #timeout
+            logLimited('nodata', "no data from the instrument")
+            continue
+        if (not hasattr(ser, 'lost') # the simulated counter wraps through 0
+                and ring.store.find(0, start, start+Nread) != -1) :
+            logLimited('zero', "0 detected")
+        ring.commit(Nread)
+        metrics.RING_USED.set(ring.head - ring.oldest())
+    print('close', ser)
     ser.close()
     exit()
 
-def packagingThread():
+def startRecording(amount, unit, name):
     """
-    This thread retrieves the data inside the data queue and assembles
-    with it packets of size BUF bytes. Those packets are then put inside
-    packet queue (pack_q).
+    input : amount (int) of unit (BYTES or SECONDS), name (string)
+        Starts the recording asked for by RECORD, its thread writes the
+    stream to disk whatever the clients do.
     """
-    package = bytes()
-    temp = bytes()
-    while exit_q.empty():
+    length = amount if unit == BYTES else int(round(amount/SAMPLE_PERIOD))
+    record(ring, name, length)
+
+class FilePart:
+    """
+    count bytes of the file f starting at offset, part of an Outbox.
+    """
+    
+    def __init__(self, f, offset, count):
+        self.f = f
+        self.offset = offset
+        self.count = count
+
+class Outbox:
+    """
+    Messages queued for a client. serpy sends a message as a whole and
+    only returns once the kernel took it, so each client has its own
+    thread that sends its messages : a client that stops reading only
+    holds up that thread, never the others. A part can be bytes, a 
+    FilePart, read by the thread when its turn comes, or a callable, 
+    called by the thread once the parts before it are sent (to close a
+    file). then() registers a callable for the socket thread instead,
+    flush() calls it once the messages queued before it are sent.
+    """
+    
+    def __init__(self, c):
+        self.conn = weakref.ref(c) # serpy drops c when the client leaves
+        self.parts = queue.Queue()
+        self.callbacks = deque() # (messages queued before it, callable)
+        self.queued = 0 # messages queued
+        self.sent = 0 # messages sent, only the thread assigns it
+        self.since = monotonic() # time of the last progress
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    def __bool__(self):
+        return self.sent < self.queued or bool(self.callbacks)
+    
+    def put(self, *parts):
+        for part in parts :
+            if not callable(part) :
+                if not self :
+                    self.since = monotonic()
+                self.queued += 1
+            self.parts.put(part)
+    
+    def then(self, callback):
+        self.callbacks.append((self.queued, callback))
+    
+    def flush(self):
+        """
+        Calls the callables of then() whose messages are sent.
+            Raises OSError if the connection is broken.
+        """
+        if self.error is not None :
+            raise OSError(self.error)
+        while self.callbacks and self.callbacks[0][0] <= self.sent :
+            self.callbacks.popleft()[1]()
+    
+    def stalled(self):
+        """
+        output : True if the client took nothing for SEND_TIMEOUT 
+        seconds while messages wait
+        """
+        return self.sent < self.queued and monotonic() - self.since > SEND_TIMEOUT
+    
+    def run(self):
         try :
-            temp = data_q.get(timeout=1)
-            remaining_space = BUF-len(package)
-            if len(temp) <= remaining_space:
-                package += temp
-            else :
-                package += temp[:remaining_space]
-            if len(package) >= BUF :
-                pack_q.put(package)
-                package = temp[remaining_space:]
-        except queue.Empty:
-            pass
-    exit()
-        
+            while True :
+                part = self.parts.get()
+                if part is None :
+                    return
+                if callable(part) :
+                    part()
+                    continue
+                c = self.conn()
+                if c is None :
+                    return
+                if isinstance(part, FilePart) :
+                    part.f.seek(part.offset)
+                    part = part.f.read(part.count)
+                c.sendData(part)
+                del c
+                self.since = monotonic()
+                self.sent += 1
+        except Exception as e : # whatever serpy raises when the link breaks
+            self.error = e
+        finally :
+            self.drain()
+    
+    def drain(self):
+        """
+        Calls the callables left (closes the files), once the thread is
+        stopped.
+        """
+        while True :
+            try :
+                part = self.parts.get_nowait()
+            except queue.Empty :
+                return
+            if callable(part) :
+                part()
+    
+    def close(self):
+        self.callbacks.clear()
+        self.parts.put(None)
+        if not self.thread.is_alive() :
+            self.drain()
+
+def sendFile(outbox, session, name):
+    """
+    input : outbox (Outbox) of the client, session (Session), name 
+            (string) of a recording
+        Queues the answer to GIVEFILE, each frame is sent as two 
+    messages.
+    """
+    f = openRecording(name)
+    for header, offset, count in session.fileFrames(f):
+        outbox.put(header, FilePart(f, offset, count) if count else b'')
+    if f is not None :
+        outbox.put(f.close)
+
+def hello(packet=BUF):
+    return packHello(packet, MINPACKET, MAXPACKET, SAMPLE_PERIOD, monotonic(),
+                     time())
 
 def socketCom():
     """
@@ -120,44 +224,142 @@ def socketCom():
         This thread handles the comunication between this server and the
     client which is part of the GUI.
     It handles new connections and then it serves those connections by 
-    giving them the data they request.
+    giving them the data they request. Each connection has its own 
+    session : its cursor in the ring so that every client gets every 
+    byte, in packets of the size it asked for (PACKET), and its credit
+    of packets (one per GIVEDATA, n per STREAM) which are pushed as soon
+    as they are acquired. GIVERATE is answered at once with the photon
+    counts computed here, RECORD starts a recording thread, GIVEFILE
+    sends a recording and STATS the metrics. A connection gets the hello
+    when its first request comes in, then each frame is sent as two
+    messages : the header and the payload. The messages go through the
+    Outbox of the client, so a client that stops reading never holds up
+    the others, and one that takes nothing for SEND_TIMEOUT seconds is
+    slow.
     """
     s = sp.Server('', PORT, nb_conn=1).start()
+    sessions = weakref.WeakKeyDictionary()
+    outboxes = weakref.WeakKeyDictionary()
+    def closeConnection(c):
+        c.close()
+        del sessions[c]
+        outboxes.pop(c).close()
+    def sent(session, t):
+        session.sent(monotonic() - t)
     while exit_q.empty():
         for c in s.readableConnections() :
-            data = c.getData().decode('ascii')
-            if data.startswith('KTHXBYE!'):
-                print("CLOSING SERVER")
-                exit_q.put(None)
+            if c not in sessions :
+                sessions[c] = Session(RingReader(ring, BUF, latest=True,
+                                      policy=SLOW_POLICY, maxlag=MAXLAG),
+                                      str(id(c)))
+                outboxes[c] = Outbox(c)
+                weakref.finalize(c, sessions[c].close)
+                weakref.finalize(c, outboxes[c].close)
+                outboxes[c].put(hello())
+            try :
+                data = c.getData().decode('ascii')
+                if data.startswith(KTHXBYE):
+                    print("CLOSING SERVER")
+                    exit_q.put(None)
+            
+                elif data.startswith(GIVEDATA):
+                    sessions[c].grant(1)
+            
+                elif data.startswith(STREAM):
+                    sessions[c].grant(*unpackArgs(data[INMSGLEN:], 1))
+            
+                elif data.startswith(LATENCY):
+                    sessions[c].setLatency(*unpackArgs(data[INMSGLEN:], 1))
+            
+                elif data.startswith(PACKET):
+                    packet = sessions[c].resize(*unpackArgs(data[INMSGLEN:], 1),
+                                                MINPACKET, MAXPACKET)
+                    outboxes[c].put(*sessions[c].setupFrame(hello(packet)))
             
-            elif data.startswith('GIVEDATA'):
-                packet = pack_q.get()
-                #packet = b'\x09'*BUF
-                print("in buffer", pack_q.qsize()+data_q.qsize())
-                c.sendData(packet)
+                elif data.startswith(GIVERATE):
+                    binsize, = unpackArgs(data[INMSGLEN:], 1)
+                    outboxes[c].put(*sessions[c].rateFrame(binsize))
+            
+                elif data.startswith(RECORD):
+                    amount, unit, length = unpackArgs(data[INMSGLEN:], 3)
+                    start = INMSGLEN + 3*ARGLEN
+                    name = data[start:start+checkName(length)]
+                    startRecording(amount, unit, name)
+            
+                elif data.startswith(GIVEFILE):
+                    length, = unpackArgs(data[INMSGLEN:], 1)
+                    start = INMSGLEN + ARGLEN
+                    name = data[start:start+checkName(length)]
+                    sendFile(outboxes[c], sessions[c], name)
+            
+                elif data.startswith(STATS):
+                    outboxes[c].put(*sessions[c].statsFrame())
+            except ValueError as e : # not a valid request
+                print("Invalid request :", e)
+                closeConnection(c)
+        
+        for c in list(sessions.keys()) :
+            session = sessions[c]
+            outbox = outboxes[c]
+            reader = session.reader
+            try :
+                outbox.flush()
+                if outbox : # its previous frame is not sent yet
+                    if (outbox.stalled() or (session.credit
+                            and reader.backlog() > reader.maxlag)) :
+                        reader.slow()
+                    continue
+                frame = session.nextFrame()
+                if frame is None :
+                    continue
+                outbox.put(*frame)
+                outbox.then(partial(sent, session, monotonic()))
+            except SlowReaderError as e :
+                print("Client too slow, disconnected :", e)
+                closeConnection(c)
+            except OSError :
+                print("Connection broken !!")
+                closeConnection(c)
         sleep(0.01)
 
     s.closeServer()
     exit()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serial data server")
+    parser.add_argument('--slow-policy', choices=['skip', 'disconnect'],
+        default=SLOW_POLICY, help="what to do with a client lagging too "
+        "far behind : skip it ahead to the latest packet or disconnect it")
+    parser.add_argument('--max-lag', type=int, default=MAXLAG//BUF,
+        help="lag in packets above which a client is too slow")
+    parser.add_argument('--source', default=SOURCE, help="the instrument : "
+        "serial[:device], or a simulated one, sim[:rate] in the server or "
+        "pty[:rate] behind a pseudo-terminal (rate in values per second)")
+    parser.add_argument('--port', type=int, default=PORT,
+        help="port on which the clients connect")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+        help="port on which the metrics are served over HTTP in the "
+        "Prometheus text format")
+    args = parser.parse_args()
+    PORT = args.port
+    SOURCE = args.source
+    METRICS_PORT = args.metrics_port
+    SLOW_POLICY = args.slow_policy
+    MAXLAG = args.max_lag*BUF
+    MAXPACKET = min(MAXPACKET, MAXLAG//2)
+    httpd = serveMetrics(METRICS_PORT) if METRICS_PORT else None
     exit_q = queue.Queue(10)
-    data_q = queue.Queue(32)
-    pack_q = queue.Queue(16)
-    lock = threading.Lock()
+    ring = RingBuffer(NSTORE, SERBUF, marks=NSTORE//MIN_READ)
     tSer = threading.Thread(target=serialReader)
     tSer.start()
     tSoc = threading.Thread(target=socketCom)
     tSoc.start()
-    tPac = threading.Thread(target=packagingThread)
-    tPac.start()
     sleep(2)
     tSer.join()
     tSoc.join()
-    while not pack_q.empty():
-        pack_q.get_nowait()
-    print("pack_q emptied")
-    tPac.join()
+    stopRecordings()
+    if httpd is not None :
+        httpd.shutdown()
     try :
         server_socket.close()
     except :
@@ -6,131 +6,251 @@
 # the total store, the serial buffer and the network buffer are integer multiples
 # of each other
 
-import serial
+import os
 import select
 import socket
 import queue
 import threading
-from time import sleep
+import asyncio
+import argparse
+from collections import deque
+from functools import partial
+from time import sleep, time, monotonic
+from ringbuffer import RingBuffer, RingReader, SlowReaderError
+from protocol import (INMSGLEN, ARGLEN, GIVEDATA, STREAM, PACKET, LATENCY,
+    GIVERATE, RECORD, GIVEFILE, STATS, KTHXBYE, BYTES, unpackArgs,
+    unpackRequest, checkName, packHello)
+from session import Session
+from recorder import record, openRecording, stopRecordings
+from sources import openSource, ReadSizer, MIN_READ
+import metrics
+from metrics import logLimited, serveMetrics
 
 PORT = 18888
 STIMEOUT = 0.020 # timeout for select  (but also for sstream read!)
+SEND_TIMEOUT = 2. # seconds a client may keep its socket full before it is slow
 SERBUF = 8192 # this buffer size will be the same for sttream reads and socket transfer
-BUF = 8*SERBUF
-INMSGLEN = 8
-NSTORE = 4*BUF
+BUF = 8*SERBUF # packet size of a client until it asks for another one
+FILESTEP = 4*BUF # bytes of a recording sent at once
+SAMPLE_PERIOD = 4e-6 # one counter value every 4 us
+NSTORE = 32*BUF
+BACKLOG = 16 # pending connections allowed by listen()
+SLOW_POLICY = 'skip' # 'skip' a client lagging behind or 'disconnect' it
+MAXLAG = NSTORE//2 # lag in bytes above which a client is too slow
+MINPACKET = 512 # packet sizes a client can ask for (PACKET)
+MAXPACKET = NSTORE//8 # at most MAXLAG//2
+SOURCE = 'serial' # the instrument, see sources.py
+METRICS_PORT = None # port of the Prometheus listener, None for none
 
 def serialReader():
     """
-    This thread handles the connection to the serial port as well as the
-    retrieval of data from it. It puts the data insiside de data queue
-    (data_q) and if this queue is full it void the first element of the
-    queue and then place the new element.
-    """
-    # SET UP SERIAL READER
-    #dev = '/dev/ttyACM0'
-    dev = '/dev/ttyUSB0'
-    # bps=57600   # On arduino we use prescaler 16 for BPS 57600
-    # below is exact
-    
-    PRESCALER = 2
-    #bps = 2*(1000000/(PRESCALER+1)) #double speed 2* TODO do we need integers?
-    bps = 3000000
-    print('bps exact',bps)
-    # Nbuf = BUF # Nbuf = 4096 
-    # 2048 seems to work slightly better than 1024 
-    # 4096 seems to work better than 2048 (on my system)
-    # Tsleep = STIMEOUT # Tsleep = 0.040 # shorter sleep to be safe
-    # different successful combinations
-    # Nbuf=4096; Tsleep = 0.056 (guess that limit is at 0.060)
-    # Nbuf=2048; Tsleep = 0.028 (0.030 is near limit)
-    try:
-        ser.close()
-    except:
-        pass
+    This thread handles the connection to the instrument (SOURCE, the
+    serial port or a simulation of it) as well as the retrieval of data
+    from it. It reads the data directly inside the ring buffer (ring),
+    what is waiting in the link up to SERBUF bytes at once (ReadSizer),
+    so a read may be shorter than SERBUF. It never waits for the socket 
+    side : if the latter is too slow it loses the oldest packets.
+    """
     try :
-        ser = serial.Serial(port=dev, baudrate=bps, timeout=3) 
-        w=ser.inWaiting()
-        rbuf = ser.read(w)
-        print('serial port open and cleared')
-    except :
-        print("Serial connection is not ready !")
+        ser = openSource(SOURCE)
+        print(ser, 'open and cleared')
+    except Exception as e :
+        print("Serial connection is not ready :", e)
         exit_q.put(None)
         exit()
+    sizer = ReadSizer(SERBUF)
     while exit_q.empty():
-        #w=ser.inWaiting()
-        #print('waiting:',w)
-        lock.acquire()
+        start = ring.head % NSTORE
+        t = monotonic()
         try:
-            rbuf = ser.read(SERBUF)
+            waiting = ser.in_waiting
+            Nread = ser.readinto(ring.writable()[:sizer.size(waiting)])
         except:
             print("Serial Connection Error")
             exit_q.put(None) #closes the server
-            pack_q.put(b'\x00'*SERBUF)
-            lock.release()
-            print("Lock realeased")
             #ser.close()
             break
-        else: 
-            lock.release()
-        if 0 in rbuf : print("0 detected")
-        Nread = len(rbuf)
-        if Nread!=SERBUF:
-            print("Serial Connection Error")
-            exit_q.put(None) #closes the server
-            ser.close()
-            #server_socket.close()
-            #raise RuntimeError('Serial read was not OK')
-        #rbuf = b'\x09'*SERBUF
-        if data_q.full() : 
-            data_q.get()
-            print("losing data")
-        data_q.put(rbuf)
-    print('close serial port')
+        metrics.SERIAL_READ.observe(monotonic() - t)
+        metrics.SERIAL_WAITING.set(waiting)
+        if hasattr(ser, 'lost') : # simulated instrument
+            metrics.SOURCE_LOST.set(ser.lost)
+        metrics.SERIAL_BYTES.inc(Nread)
+        sizer.update(Nread)
+        if not Nread : #timeout
+            logLimited('nodata', "no data from the instrument")
+            continue
+        if (not hasattr(ser, 'lost') # the simulated counter wraps through 0
+                and ring.store.find(0, start, start+Nread) != -1) :
+            logLimited('zero', "0 detected")
+        ring.commit(Nread)
+        metrics.RING_USED.set(ring.head - ring.oldest())
+    print('close', ser)
     ser.close()
     exit()
 
-def packagingThread():
+class Inbox:
     """
-    This thread retrieves the data inside the data queue and assembles
-    with it packets of size BUF bytes. Those packets are then put inside
-    packet queue (pack_q).
+    Bytes received from a client of the select engine. Its socket is
+    non blocking : receive() takes what the kernel holds and requests()
+    hands out the requests once they are complete, so a client that
+    sends a request piece by piece never holds up the others.
     """
-    package = bytes()
-    temp = bytes()
-    while exit_q.empty():
+    
+    def __init__(self, conn):
+        self.conn = conn
+        self.data = bytearray()
+    
+    def receive(self):
+        """
+        output : False if the connection is broken
+        """
         try :
-            temp = data_q.get(timeout=1)
-            remaining_space = BUF-len(package)
-            if len(temp) <= remaining_space:
-                package += temp
-            else :
-                package += temp[:remaining_space]
-            if len(package) >= BUF :
-                pack_q.put(package)
-                package = temp[remaining_space:]
-        except queue.Empty:
-            pass
-    exit()
-        
-def recvPacketSize(conn, size):
+            chunk = self.conn.recv(4096)
+        except (BlockingIOError, InterruptedError) :
+            return True
+        except OSError : # reset by the client
+            return False
+        self.data += chunk
+        return bool(chunk)
+    
+    def requests(self):
+        """
+        output : yields (cmd, args, name) for each complete request
+            Raises ValueError if a request is not valid.
+        """
+        while True :
+            request = unpackRequest(self.data)
+            if request is None :
+                return
+            cmd, args, name, size = request
+            del self.data[:size]
+            yield cmd, args, name
+
+class FilePart:
     """
-    input : conn (a connected socket object), size (int) in bytes
-    output : message (string)
-        This function retrieves from the connecion (conn) a message of 
-    lenght (size) in bytes and returns it decoded (encoding='ascii')
+    count bytes of the file f starting at offset, part of an Outbox.
     """
-    data = []
-    bytesRecv = 0
-    while bytesRecv < size :
-        chunk = conn.recv(min(size - bytesRecv, 4096))
-        bytesRecv += len(chunk)
-        if chunk :
-            data.append(chunk)
-        else :
-            print("Connection broken !!")
-            return -1
-    return (b''.join(data)).decode(encoding='ascii')
+    
+    def __init__(self, f, offset, count):
+        self.f = f
+        self.offset = offset
+        self.count = count
+
+class Outbox:
+    """
+    Frames queued for a client of the select engine. Its socket is non
+    blocking : flush() sends what the kernel takes and keeps the rest
+    until select says that the socket is writable again, so a client
+    that stops reading never holds up the others. A part can also be a
+    callable, called once the parts before it are sent, or a FilePart,
+    sent by the kernel (sendfile) FILESTEP bytes per flush() so that a
+    download does not hold up the other clients either.
+    """
+    
+    def __init__(self, conn):
+        self.conn = conn
+        self.parts = deque()
+        self.since = None # time of the last progress while parts wait
+    
+    def __bool__(self):
+        return bool(self.parts)
+    
+    def put(self, *parts):
+        if not self.parts :
+            self.since = monotonic()
+        self.parts.extend(parts)
+    
+    def flush(self):
+        """
+        output : True once every part is sent
+            Raises OSError if the connection is broken.
+        """
+        parts = self.parts
+        while parts :
+            part = parts[0]
+            if callable(part) :
+                parts.popleft()
+                part()
+                continue
+            if isinstance(part, FilePart) :
+                try :
+                    n = os.sendfile(self.conn.fileno(), part.f.fileno(),
+                                    part.offset, min(part.count, FILESTEP))
+                except (BlockingIOError, InterruptedError) :
+                    return False
+                if not n :
+                    raise OSError("the recording is shorter than announced")
+                self.since = monotonic()
+                part.offset += n
+                part.count -= n
+                if part.count : # the next step on the next flush
+                    return False
+                parts.popleft()
+                continue
+            try :
+                n = self.conn.send(part)
+            except (BlockingIOError, InterruptedError) :
+                return False
+            self.since = monotonic()
+            if n < len(part) : # the socket is full
+                parts[0] = memoryview(part)[n:]
+                return False
+            parts.popleft()
+        return True
+    
+    def close(self):
+        """
+        Closes the files of the parts left, once the connection is.
+        """
+        for part in self.parts :
+            if isinstance(part, FilePart) :
+                part.f.close()
+        self.parts.clear()
+    
+    def stalled(self):
+        """
+        output : True if the socket took nothing for SEND_TIMEOUT
+        seconds while parts wait
+        """
+        return bool(self.parts) and monotonic() - self.since > SEND_TIMEOUT
+
+def newSession(addr):
+    """
+    input : addr the address of the client
+    output : a Session for a new connection
+        Its cursor starts at the latest packet and follows the slow 
+    client policy of the server.
+    """
+    return Session(RingReader(ring, BUF, latest=True, policy=SLOW_POLICY,
+                              maxlag=MAXLAG), "{}:{}".format(*addr))
+
+def hello(packet=BUF):
+    return packHello(packet, MINPACKET, MAXPACKET, SAMPLE_PERIOD, monotonic(),
+                     time())
+
+def startRecording(amount, unit, name):
+    """
+    input : amount (int) of unit (BYTES or SECONDS), name (string)
+        Starts the recording asked for by RECORD, its thread writes the
+    stream to disk whatever the clients do.
+    """
+    length = amount if unit == BYTES else int(round(amount/SAMPLE_PERIOD))
+    record(ring, name, length)
+
+def sendFile(outbox, session, name):
+    """
+    input : outbox (Outbox) of the client, session (Session), name
+            (string) of a recording
+        Queues the answer to GIVEFILE, the file is then sent in steps
+    as the socket of the client takes it.
+    """
+    f = openRecording(name)
+    for header, offset, count in session.fileFrames(f):
+        outbox.put(header)
+        if count :
+            outbox.put(FilePart(f, offset, count))
+    if f is not None :
+        outbox.put(f.close)
 
 def socketCom(read_list):
     """
@@ -138,73 +258,470 @@ def socketCom(read_list):
         This thread handles the comunication between this server and the
     client which is part of the GUI.
     It handles new connections and then it serves those connections by 
-    giving them the data they request.
+    giving them the data they request. Each connection has its own 
+    session : its cursor in the ring so that every client gets every 
+    byte, in packets of the size it asked for (PACKET), and its credit
+    of packets (one per GIVEDATA, n per STREAM). GIVERATE is answered at
+    once with the photon counts computed here, RECORD starts a recording
+    thread and GIVEFILE queues a recording before anything else, STATS
+    the metrics. The packets are pushed as soon as they are acquired :
+    the serial thread wakes select up at each commit. Connections with
+    credit are served in turn, one frame each, so that none of them
+    holds up the others. The sockets are non-blocking : a request is
+    handled once its Inbox holds all of it, what a client does not take
+    waits in its Outbox, and a client whose socket stays full is slow.
     """
+    sessions = {}
+    outboxes = {}
+    inboxes = {}
+    wake_r, wake_w = socket.socketpair()
+    wake_r.setblocking(False)
+    wake_w.setblocking(False)
+    def onCommit():
+        try :
+            wake_w.send(b'\x00')
+        except OSError : # the pair is already full of wake ups
+            pass
+    def closeConnection(s):
+        s.close()
+        read_list.remove(s)
+        inboxes.pop(s, None)
+        outbox = outboxes.pop(s, None)
+        if outbox is not None :
+            outbox.close()
+        session = sessions.pop(s, None)
+        if session is not None :
+            session.close()
+    def send(s, *parts):
+        """
+        Queues the parts for s and sends what its socket takes.
+        output : False if the connection was closed
+        """
+        outbox = outboxes[s]
+        outbox.put(*parts)
+        try :
+            outbox.flush()
+        except SlowReaderError as e : # raised by Session.sent
+            print("Client too slow, disconnected :", e)
+            closeConnection(s)
+            return False
+        except OSError :
+            print("Connection broken !!")
+            closeConnection(s)
+            return False
+        return True
+    def sent(session, t):
+        session.sent(monotonic() - t)
+    ring.subscribe(onCommit)
+    read_list.append(wake_r)
+    timeout = STIMEOUT
     while exit_q.empty():
-        readable, writable, errored = select.select(read_list, [], [], STIMEOUT)
+        waiting = [s for s, outbox in outboxes.items() if outbox]
+        readable, writable, errored = select.select(read_list, waiting, [],
+                                                    timeout)
+        for s in writable :
+            if s in outboxes :
+                send(s)
         for s in readable :
             if s is read_list[0] :
                 conn, addr = s.accept()
                 print("Connection to ", addr, " accepted")
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                conn.setblocking(False)
                 read_list.append(conn)
-                conn.sendall(str(BUF).encode('ascii'))
-                conn.sendall("EOT".encode('ascii'))
-            else :
-                lock.acquire()
-                data = recvPacketSize(s, 8)
-                lock.release()
-                if data is -1 :
-                    s.close()
-                    read_list.remove(s)
-                    
-                elif data.startswith('KTHXBYE!'):
-                    print("CLOSING SERVER")
-                    exit_q.put(None)
-                
-                elif data.startswith('GIVEDATA'):
-                    packet = pack_q.get()
-                    #packet = b'\x09'*BUF
-                    print("in buffer", pack_q.qsize()+data_q.qsize())
-                    try :
-                        #print(len(packet))
-                        lock.acquire()
-                        s.sendall(packet)
-                        lock.release()
-                    except :
-                        print("Connection broken !!")
-                        s.close()
-                        read_list.remove(s)
-                    
+                sessions[conn] = newSession(addr)
+                outboxes[conn] = Outbox(conn)
+                inboxes[conn] = Inbox(conn)
+                send(conn, hello())
+            elif s is wake_r :
+                try :
+                    wake_r.recv(4096)
+                except OSError :
+                    pass
+            elif s in sessions :
+                if not inboxes[s].receive() :
+                    print("Connection broken !!")
+                    closeConnection(s)
+                    continue
+                try :
+                    for cmd, args, name in inboxes[s].requests() :
+                        if s not in sessions : # closed by a send
+                            break
+                        
+                        elif cmd == KTHXBYE:
+                            print("CLOSING SERVER")
+                            exit_q.put(None)
+                        
+                        elif cmd == GIVEDATA:
+                            sessions[s].grant(1)
+                        
+                        elif cmd == STREAM:
+                            sessions[s].grant(*args)
+                        
+                        elif cmd == LATENCY:
+                            sessions[s].setLatency(*args)
+                        
+                        elif cmd == PACKET:
+                            session = sessions[s]
+                            packet = session.resize(*args, MINPACKET, MAXPACKET)
+                            send(s, *session.setupFrame(hello(packet)))
+                        
+                        elif cmd == GIVERATE:
+                            send(s, *sessions[s].rateFrame(*args))
+                        
+                        elif cmd == RECORD:
+                            amount, unit, length = args
+                            startRecording(amount, unit, name)
+                        
+                        elif cmd == GIVEFILE:
+                            sendFile(outboxes[s], sessions[s], name)
+                            send(s)
+                        
+                        elif cmd == STATS:
+                            send(s, *sessions[s].statsFrame())
+                except ValueError as e : # not a valid request
+                    print("Invalid request :", e)
+                    closeConnection(s)
+        
+        timeout = STIMEOUT
+        for s in list(sessions) :
+            session = sessions[s]
+            reader = session.reader
+            try :
+                if outboxes[s] : # its previous frame is not sent yet
+                    if (outboxes[s].stalled() or (session.credit
+                            and reader.backlog() > reader.maxlag)) :
+                        reader.slow()
+                    continue
+                frame = session.nextFrame()
+            except SlowReaderError as e :
+                print("Client too slow, disconnected :", e)
+                closeConnection(s)
+                continue
+            if frame is None :
+                continue
+            if send(s, *frame, partial(sent, session, monotonic())) :
+                if not outboxes[s] :
+                    timeout = 0 # other packets may be ready already
+        now = monotonic()
+        for s, session in sessions.items() :
+            if outboxes[s] : # select wakes up once its frame is sent
+                continue
+            deadline = session.deadline()
+            if deadline is not None : #wakes up for the partial packet
+                timeout = max(0, min(timeout, deadline - now))
+    
+    ring.unsubscribe(onCommit)
+    wake_w.close()
     for s in read_list:
         s.close()
         print("Connection", s, "closed")
         read_list.remove(s)
     exit()
 
+async def recvPacketSizeAsync(conn, size):
+    """
+    input : conn (a connected non-blocking socket object), size (int)
+    output : message (string), -1 if the connection is broken
+        This coroutine retrieves from the connection (conn) a message
+    of length (size) in bytes and returns it decoded (encoding='ascii')
+    """
+    loop = asyncio.get_running_loop()
+    data = []
+    bytesRecv = 0
+    while bytesRecv < size :
+        try :
+            chunk = await loop.sock_recv(conn, min(size - bytesRecv, 4096))
+        except OSError : # reset by the client
+            chunk = b''
+        bytesRecv += len(chunk)
+        if chunk :
+            data.append(chunk)
+        else :
+            print("Connection broken !!")
+            return -1
+    return (b''.join(data)).decode(encoding='ascii')
+
+class AsyncClient:
+    """
+    Serves one client of the asyncio engine. The client has its own
+    session so that it gets every packet whatever the other clients do.
+    One task reads the requests, grants credit and answers PACKET,
+    GIVERATE, GIVEFILE and STATS, another one pushes frames while there
+    is credit. They wait for the ring without blocking the other clients
+    and sock_sendall only returns once the kernel took the data. A frame
+    is sent as a whole before the other task may send one. A client that
+    has not taken a frame after SEND_TIMEOUT seconds is slow.
+    """
+    
+    def __init__(self, conn, addr, pulse):
+        """
+        input : conn (an accepted non-blocking socket object), addr,
+                pulse (a list holding the asyncio.Event set at each 
+                commit)
+        """
+        self.conn = conn
+        self.addr = addr
+        self.pulse = pulse
+        self.session = newSession(addr)
+        self.granted = asyncio.Event()
+        self.sending = asyncio.Lock()
+    
+    def grant(self, n):
+        self.session.grant(n)
+        if self.session.credit :
+            self.granted.set()
+    
+    async def readRequests(self):
+        while exit_q.empty():
+            try :
+                data = await recvPacketSizeAsync(self.conn, INMSGLEN)
+                if data == -1 :
+                    return
+            
+                elif data.startswith(KTHXBYE):
+                    print("CLOSING SERVER")
+                    exit_q.put(None)
+            
+                elif data.startswith(GIVEDATA):
+                    self.grant(1)
+            
+                elif data.startswith(STREAM):
+                    arg = await recvPacketSizeAsync(self.conn, ARGLEN)
+                    if arg == -1 :
+                        return
+                    self.grant(*unpackArgs(arg, 1))
+            
+                elif data.startswith(LATENCY):
+                    arg = await recvPacketSizeAsync(self.conn, ARGLEN)
+                    if arg == -1 :
+                        return
+                    self.session.setLatency(*unpackArgs(arg, 1))
+            
+                elif data.startswith(PACKET):
+                    arg = await recvPacketSizeAsync(self.conn, ARGLEN)
+                    if arg == -1 :
+                        return
+                    packet = self.session.resize(*unpackArgs(arg, 1), MINPACKET,
+                                                 MAXPACKET)
+                    await self.sendFrame(self.session.setupFrame, hello(packet))
+            
+                elif data.startswith(GIVERATE):
+                    arg = await recvPacketSizeAsync(self.conn, ARGLEN)
+                    if arg == -1 :
+                        return
+                    await self.sendFrame(self.session.rateFrame,
+                                         *unpackArgs(arg, 1))
+            
+                elif data.startswith(RECORD):
+                    arg = await recvPacketSizeAsync(self.conn, 3*ARGLEN)
+                    if arg == -1 :
+                        return
+                    amount, unit, length = unpackArgs(arg, 3)
+                    name = await recvPacketSizeAsync(self.conn,
+                                                     checkName(length))
+                    if name == -1 :
+                        return
+                    startRecording(amount, unit, name)
+            
+                elif data.startswith(GIVEFILE):
+                    arg = await recvPacketSizeAsync(self.conn, ARGLEN)
+                    if arg == -1 :
+                        return
+                    length, = unpackArgs(arg, 1)
+                    name = await recvPacketSizeAsync(self.conn,
+                                                     checkName(length))
+                    if name == -1 :
+                        return
+                    await self.sendFile(name)
+            
+                elif data.startswith(STATS):
+                    await self.sendFrame(self.session.statsFrame)
+            except ValueError as e : # not a valid request
+                print("Invalid request :", e)
+                return
+    
+    async def sendAll(self, data):
+        """
+        sock_sendall applying the slow client policy every SEND_TIMEOUT
+        seconds that data waits
+        """
+        loop = asyncio.get_running_loop()
+        send = loop.create_task(loop.sock_sendall(self.conn, data))
+        try :
+            while True :
+                done, pending = await asyncio.wait([send], timeout=SEND_TIMEOUT)
+                if done :
+                    return send.result()
+                self.session.reader.slow()
+        finally :
+            send.cancel()
+    
+    async def sendFrame(self, build, *args):
+        """
+        input : build (a method of the session returning a frame), args
+            The frame is built once the other task is done sending, so
+        that the frames go out in the order of their sequence numbers.
+        """
+        async with self.sending :
+            for part in build(*args) :
+                await self.sendAll(part)
+    
+    async def sendFile(self, name):
+        loop = asyncio.get_running_loop()
+        f = openRecording(name)
+        try :
+            async with self.sending :
+                for header, offset, count in self.session.fileFrames(f):
+                    await loop.sock_sendall(self.conn, header)
+                    if count :
+                        await loop.sock_sendfile(self.conn, f, offset, count)
+        finally :
+            if f is not None :
+                f.close()
+    
+    async def pushFrame(self):
+        """
+        output : True if a DATA frame was ready and sent
+        """
+        async with self.sending :
+            frame = self.session.nextFrame()
+            if frame is None :
+                return False
+            t = monotonic()
+            for part in frame :
+                await self.sendAll(part)
+        self.session.sent(monotonic() - t)
+        return True
+    
+    async def pushFrames(self):
+        while True :
+            while not self.session.credit :
+                self.granted.clear()
+                await self.granted.wait()
+            event = self.pulse[0]
+            if await self.pushFrame() :
+                continue
+            deadline = self.session.deadline()
+            if deadline is None :
+                await event.wait()
+                continue
+            try : #wakes up for the partial packet
+                await asyncio.wait_for(event.wait(),
+                                       max(0, deadline - monotonic()))
+            except asyncio.TimeoutError :
+                pass
+    
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        try :
+            await self.sendAll(hello())
+            tasks = [loop.create_task(self.readRequests()),
+                     loop.create_task(self.pushFrames())]
+            try :
+                done, pending = await asyncio.wait(tasks,
+                    return_when=asyncio.FIRST_COMPLETED)
+            finally :
+                for task in tasks :
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            for task in done :
+                task.result()
+        except SlowReaderError as e :
+            print("Client too slow, disconnected :", e)
+        except OSError :
+            print("Connection broken !!")
+        finally :
+            self.conn.close()
+            self.session.close()
+            print("Connection", self.addr, "closed")
+
+async def asyncSocketCom(server_socket):
+    """
+    input : the binded socket object of the server
+        asyncio engine : each connection is served by its own task, so a
+    client waiting for data or reading slowly does not hold up the
+    others.
+    """
+    loop = asyncio.get_running_loop()
+    pulse = [asyncio.Event()]
+    def wake():
+        event = pulse[0]
+        pulse[0] = asyncio.Event()
+        event.set()
+    def onCommit():
+        loop.call_soon_threadsafe(wake)
+    ring.subscribe(onCommit)
+    server_socket.setblocking(False)
+    tasks = set()
+    try :
+        while exit_q.empty():
+            try :
+                conn, addr = await asyncio.wait_for(
+                    loop.sock_accept(server_socket), 1)
+            except asyncio.TimeoutError :
+                continue
+            print("Connection to ", addr, " accepted")
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn.setblocking(False)
+            task = loop.create_task(AsyncClient(conn, addr, pulse).serve())
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally :
+        ring.unsubscribe(onCommit)
+        for task in tasks :
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serial data server")
+    parser.add_argument('--engine', choices=['select', 'asyncio'],
+        default='select', help="network engine : 'select' serves the "
+        "clients one at a time, 'asyncio' serves each client with its own "
+        "task")
+    parser.add_argument('--slow-policy', choices=['skip', 'disconnect'],
+        default=SLOW_POLICY, help="what to do with a client lagging too "
+        "far behind : skip it ahead to the latest packet or disconnect it")
+    parser.add_argument('--max-lag', type=int, default=MAXLAG//BUF,
+        help="lag in packets above which a client is too slow")
+    parser.add_argument('--source', default=SOURCE, help="the instrument : "
+        "serial[:device], or a simulated one, sim[:rate] in the server or "
+        "pty[:rate] behind a pseudo-terminal (rate in values per second)")
+    parser.add_argument('--port', type=int, default=PORT,
+        help="port on which the clients connect")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+        help="port on which the metrics are served over HTTP in the "
+        "Prometheus text format")
+    args = parser.parse_args()
+    PORT = args.port
+    SOURCE = args.source
+    METRICS_PORT = args.metrics_port
+    SLOW_POLICY = args.slow_policy
+    MAXLAG = args.max_lag*BUF
+    MAXPACKET = min(MAXPACKET, MAXLAG//2)
     exit_q = queue.Queue(10)
-    data_q = queue.Queue(32)
-    pack_q = queue.Queue(16)
+    ring = RingBuffer(NSTORE, SERBUF, marks=NSTORE//MIN_READ)
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind(('', PORT))
-    server_socket.listen(1)
+    server_socket.listen(BACKLOG)
     print("Listening on port {0}".format(PORT))
     read_list = [server_socket]
-    lock = threading.Lock()
+    httpd = serveMetrics(METRICS_PORT) if METRICS_PORT else None
     tSer = threading.Thread(target=serialReader)
     tSer.start()
-    tSoc = threading.Thread(target=socketCom, args=(read_list,))
+    if args.engine == 'asyncio':
+        tSoc = threading.Thread(target=asyncio.run,
+                                args=(asyncSocketCom(server_socket),))
+    else :
+        tSoc = threading.Thread(target=socketCom, args=(read_list,))
     tSoc.start()
-    tPac = threading.Thread(target=packagingThread)
-    tPac.start()
     sleep(2)
     tSer.join()
     tSoc.join()
-    while not pack_q.empty():
-        pack_q.get_nowait()
-    print("pack_q emptied")
-    tPac.join()
+    stopRecordings()
+    if httpd is not None :
+        httpd.shutdown()
     try :
         server_socket.close()
     except :